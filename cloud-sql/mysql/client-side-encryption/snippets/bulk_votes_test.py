@@ -0,0 +1,82 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+import sqlalchemy
+import tink
+from tink import aead
+
+from snippets.bulk_votes import encrypt_and_insert_votes, query_and_decrypt_votes
+from snippets.caching_env_aead import CachingEnvelopeAead
+
+table_name = "votes"
+
+
+@pytest.fixture(name="pool")
+def setup_pool(tmp_path: os.PathLike) -> sqlalchemy.engine.Engine:
+    # A local SQLite database stands in for Cloud SQL.
+    pool = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/votes.db")
+    with pool.begin() as conn:
+        conn.execute(
+            sqlalchemy.text(
+                f"CREATE TABLE {table_name} "
+                "( vote_id INTEGER PRIMARY KEY, time_cast timestamp NOT NULL, "
+                "team VARCHAR(6) NOT NULL, voter_email BLOB )"
+            )
+        )
+
+    yield pool
+
+    pool.dispose()
+
+
+@pytest.fixture(name="env_aead")
+def setup_key() -> CachingEnvelopeAead:
+    # A local key stands in for the key in Cloud KMS.
+    aead.register()
+    key_template = aead.aead_key_templates.AES256_GCM
+    remote_aead = tink.new_keyset_handle(key_template).primitive(aead.Aead)
+
+    yield CachingEnvelopeAead(key_template, remote_aead, max_messages_per_key=100)
+
+
+def test_bulk_votes(
+    pool: sqlalchemy.engine.Engine, env_aead: CachingEnvelopeAead
+) -> None:
+    votes = [
+        ("TABS" if i % 3 else "SPACES", f"voter{i}@example.com") for i in range(2500)
+    ]
+
+    assert (
+        encrypt_and_insert_votes(
+            pool, env_aead, table_name, iter(votes), batch_size=300
+        )
+        == 2500
+    )
+
+    # Decrypts with the data keys unwrapped again.
+    env_aead = CachingEnvelopeAead(env_aead.key_template, env_aead.remote_aead)
+    output = list(
+        query_and_decrypt_votes(
+            pool, env_aead, table_name, batch_size=200, max_workers=3
+        )
+    )
+    assert [(team, email) for team, email, _ in output] == votes
+
+    with pytest.raises(ValueError):
+        encrypt_and_insert_votes(
+            pool, env_aead, table_name, [("ROWS", "hello@example.com")]
+        )
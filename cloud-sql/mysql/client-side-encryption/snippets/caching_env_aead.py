@@ -0,0 +1,230 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+from collections.abc import Iterable
+from concurrent import futures
+import logging
+import struct
+import threading
+import time
+
+import tink
+from tink import aead
+from tink import core
+from tink.integration import gcpkms
+from tink.proto import tink_pb2
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes the length of the wrapped data key is encoded in
+DEK_LEN_BYTES = 4
+# Max length of a wrapped data key, as in KmsEnvelopeAead
+MAX_ENCRYPTED_DEK_LEN = 4096
+
+
+class CachingEnvelopeAead(aead.Aead):
+    """
+    An envelope AEAD primitive that reuses data keys instead of asking Cloud
+    KMS to wrap and unwrap a data key for every message.
+
+    KmsEnvelopeAead generates a new data key (DEK) for every encrypted message
+    and wraps it with the key encryption key in Cloud KMS, so every encrypt
+    and every decrypt is a remote call. This primitive encrypts up to
+    max_messages_per_key messages, for up to max_key_age seconds, with the
+    same data key, and keeps the most recently used unwrapped data keys in
+    memory, keyed by their wrapped bytes.
+
+    The ciphertexts have the same format as the ones of KmsEnvelopeAead, so
+    the two primitives can decrypt each other's ciphertexts.
+
+    All the messages encrypted with a data key are exposed if that key is
+    compromised, so keep the limits as low as the data allows.
+    """
+
+    def __init__(
+        self,
+        key_template: tink_pb2.KeyTemplate,
+        remote_aead: aead.Aead,
+        max_messages_per_key: int = 10000,
+        max_key_age: float = 300.0,
+        max_cached_keys: int = 1000,
+        max_workers: int = 8,
+    ) -> None:
+        """
+        Creates the primitive.
+
+        Args:
+            key_template: The template of the data keys.
+            remote_aead: The AEAD primitive of the key encryption key in Cloud KMS.
+            max_messages_per_key: The max number of messages encrypted with a
+                data key.
+            max_key_age: The max time in seconds a data key is used to encrypt.
+            max_cached_keys: The max number of unwrapped data keys kept in memory.
+            max_workers: The max number of data keys unwrapped at once by
+                decrypt_many.
+        """
+        self.key_template = key_template
+        self.remote_aead = remote_aead
+        self.max_messages_per_key = max_messages_per_key
+        self.max_key_age = max_key_age
+        self.max_cached_keys = max_cached_keys
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._current_key = None
+        self._current_key_created = 0.0
+        self._current_key_messages = 0
+        self._keys = collections.OrderedDict()
+
+    def _cache_key_locked(self, encrypted_dek: bytes, dek_aead: aead.Aead) -> None:
+        self._keys[encrypted_dek] = dek_aead
+        self._keys.move_to_end(encrypted_dek)
+        while len(self._keys) > self.max_cached_keys:
+            self._keys.popitem(last=False)
+
+    def _encryption_key(self) -> tuple[bytes, aead.Aead]:
+        """
+        Returns the header and the AEAD primitive of the data key to encrypt
+        the next message with, creating a new data key if needed.
+        """
+        with self._lock:
+            if (
+                self._current_key is None
+                or self._current_key_messages >= self.max_messages_per_key
+                or time.monotonic() - self._current_key_created >= self.max_key_age
+            ):
+                # The lock is held while the data key is wrapped so that
+                # concurrent callers don't each wrap their own key.
+                dek = core.Registry.new_key_data(self.key_template)
+                dek_aead = core.Registry.primitive(dek, aead.Aead)
+                encrypted_dek = self.remote_aead.encrypt(dek.value, b"")
+                if len(encrypted_dek) > MAX_ENCRYPTED_DEK_LEN:
+                    raise tink.TinkError("length of encrypted DEK too large")
+                header = struct.pack(">I", len(encrypted_dek)) + encrypted_dek
+                self._current_key = (header, dek_aead)
+                self._cache_key_locked(encrypted_dek, dek_aead)
+                self._current_key_created = time.monotonic()
+                self._current_key_messages = 0
+            self._current_key_messages += 1
+            return self._current_key
+
+    def _split(self, ciphertext: bytes) -> tuple[bytes, bytes]:
+        """
+        Splits the ciphertext into the wrapped data key and the payload.
+        """
+        if len(ciphertext) < DEK_LEN_BYTES:
+            raise tink.TinkError("ciphertext too short")
+        dek_len = struct.unpack(">I", ciphertext[:DEK_LEN_BYTES])[0]
+        if dek_len > MAX_ENCRYPTED_DEK_LEN or dek_len > len(ciphertext) - DEK_LEN_BYTES:
+            raise tink.TinkError("length of encrypted DEK too large")
+        end = DEK_LEN_BYTES + dek_len
+        return ciphertext[DEK_LEN_BYTES:end], ciphertext[end:]
+
+    def _decryption_key(self, encrypted_dek: bytes) -> aead.Aead:
+        """
+        Returns the AEAD primitive of the wrapped data key, unwrapping it with
+        Cloud KMS if it isn't cached.
+        """
+        with self._lock:
+            dek_aead = self._keys.get(encrypted_dek)
+            if dek_aead is not None:
+                self._keys.move_to_end(encrypted_dek)
+                return dek_aead
+        dek = tink_pb2.KeyData(
+            type_url=self.key_template.type_url,
+            value=self.remote_aead.decrypt(encrypted_dek, b""),
+            key_material_type=tink_pb2.KeyData.SYMMETRIC,
+        )
+        dek_aead = core.Registry.primitive(dek, aead.Aead)
+        with self._lock:
+            self._cache_key_locked(encrypted_dek, dek_aead)
+        return dek_aead
+
+    def encrypt(self, plaintext: bytes, associated_data: bytes) -> bytes:
+        header, dek_aead = self._encryption_key()
+        return header + dek_aead.encrypt(plaintext, associated_data)
+
+    def decrypt(self, ciphertext: bytes, associated_data: bytes) -> bytes:
+        encrypted_dek, payload = self._split(ciphertext)
+        return self._decryption_key(encrypted_dek).decrypt(payload, associated_data)
+
+    def encrypt_many(self, messages: Iterable[tuple[bytes, bytes]]) -> list[bytes]:
+        """
+        Encrypts the (plaintext, associated_data) pairs, e.g. the rows of a
+        multi-row insert. Returns the ciphertexts in the same order.
+        """
+        return [self.encrypt(plaintext, ad) for plaintext, ad in messages]
+
+    def decrypt_many(self, messages: Iterable[tuple[bytes, bytes]]) -> list[bytes]:
+        """
+        Decrypts the (ciphertext, associated_data) pairs, e.g. the rows of a
+        query. Returns the plaintexts in the same order.
+
+        Every distinct data key that isn't cached is unwrapped once, and the
+        keys are unwrapped concurrently.
+        """
+        messages = [(self._split(ciphertext), ad) for ciphertext, ad in messages]
+        with self._lock:
+            missing = list(
+                {
+                    encrypted_dek
+                    for (encrypted_dek, _), _ in messages
+                    if encrypted_dek not in self._keys
+                }
+            )
+        keys = {}
+        if missing:
+            with futures.ThreadPoolExecutor(
+                min(self.max_workers, len(missing))
+            ) as executor:
+                keys.update(zip(missing, executor.map(self._decryption_key, missing)))
+
+        plaintexts = []
+        for (encrypted_dek, payload), ad in messages:
+            if encrypted_dek not in keys:
+                keys[encrypted_dek] = self._decryption_key(encrypted_dek)
+            plaintexts.append(keys[encrypted_dek].decrypt(payload, ad))
+        return plaintexts
+
+
+def init_tink_caching_env_aead(
+    key_uri: str,
+    credentials: str,
+    max_messages_per_key: int = 10000,
+    max_key_age: float = 300.0,
+    max_cached_keys: int = 1000,
+    max_workers: int = 8,
+) -> CachingEnvelopeAead:
+    """
+    Initiates a CachingEnvelopeAead object using the KMS credentials. See
+    CachingEnvelopeAead for the other arguments.
+    """
+    aead.register()
+
+    try:
+        gcp_client = gcpkms.GcpKmsClient(key_uri, credentials)
+        gcp_aead = gcp_client.get_aead(key_uri)
+    except tink.TinkError as e:
+        logger.error("Error initializing GCP client: %s", e)
+        raise e
+
+    key_template = aead.aead_key_templates.AES256_GCM
+    return CachingEnvelopeAead(
+        key_template,
+        gcp_aead,
+        max_messages_per_key=max_messages_per_key,
+        max_key_age=max_key_age,
+        max_cached_keys=max_cached_keys,
+        max_workers=max_workers,
+    )
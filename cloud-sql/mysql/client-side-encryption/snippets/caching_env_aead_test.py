@@ -0,0 +1,84 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import tink
+from tink import aead
+
+from snippets.caching_env_aead import CachingEnvelopeAead
+
+KEY_TEMPLATE = aead.aead_key_templates.AES256_GCM
+
+
+class CountingAead(aead.Aead):
+    """
+    A local AEAD primitive that stands in for the key in Cloud KMS and counts
+    the data keys it wraps and unwraps.
+    """
+
+    def __init__(self) -> None:
+        aead.register()
+        handle = tink.new_keyset_handle(KEY_TEMPLATE)
+        self.primitive = handle.primitive(aead.Aead)
+        self.encrypted = 0
+        self.decrypted = 0
+
+    def encrypt(self, plaintext: bytes, associated_data: bytes) -> bytes:
+        self.encrypted += 1
+        return self.primitive.encrypt(plaintext, associated_data)
+
+    def decrypt(self, ciphertext: bytes, associated_data: bytes) -> bytes:
+        self.decrypted += 1
+        return self.primitive.decrypt(ciphertext, associated_data)
+
+
+@pytest.fixture(name="remote_aead")
+def setup_remote_aead() -> CountingAead:
+    yield CountingAead()
+
+
+def test_caching_env_aead_reuses_data_keys(remote_aead: CountingAead) -> None:
+    env_aead = CachingEnvelopeAead(KEY_TEMPLATE, remote_aead, max_messages_per_key=10)
+    messages = [(f"voter{i}@example.com".encode(), b"TABS") for i in range(25)]
+
+    ciphertexts = env_aead.encrypt_many(messages)
+    assert remote_aead.encrypted == 3
+
+    # The data keys are still cached after encrypting.
+    assert env_aead.decrypt_many(zip(ciphertexts, [ad for _, ad in messages])) == [
+        plaintext for plaintext, _ in messages
+    ]
+    assert remote_aead.decrypted == 0
+
+    # A new instance unwraps every data key once.
+    env_aead = CachingEnvelopeAead(KEY_TEMPLATE, remote_aead)
+    assert env_aead.decrypt_many(zip(ciphertexts, [ad for _, ad in messages])) == [
+        plaintext for plaintext, _ in messages
+    ]
+    assert env_aead.decrypt(ciphertexts[0], b"TABS") == messages[0][0]
+    assert remote_aead.decrypted == 3
+
+    with pytest.raises(tink.TinkError):
+        env_aead.decrypt(ciphertexts[0], b"SPACES")
+
+
+def test_caching_env_aead_is_compatible(remote_aead: CountingAead) -> None:
+    kms_env_aead = aead.KmsEnvelopeAead(KEY_TEMPLATE, remote_aead)
+    env_aead = CachingEnvelopeAead(KEY_TEMPLATE, remote_aead)
+
+    ciphertext = kms_env_aead.encrypt(b"hello@example.com", b"TABS")
+    assert env_aead.decrypt(ciphertext, b"TABS") == b"hello@example.com"
+
+    ciphertext = env_aead.encrypt(b"hello@example.com", b"SPACES")
+    assert kms_env_aead.decrypt(ciphertext, b"SPACES") == b"hello@example.com"
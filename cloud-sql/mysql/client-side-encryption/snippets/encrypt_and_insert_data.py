@@ -20,7 +20,7 @@ import os
 import sqlalchemy
 import tink
 
-from .cloud_kms_env_aead import init_tink_env_aead
+from .caching_env_aead import init_tink_caching_env_aead
 from .cloud_sql_connection_pool import init_db
 
 logger = logging.getLogger(__name__)
@@ -54,7 +54,7 @@ def main() -> None:
     team = "TABS"
     email = "hello@example.com"
 
-    env_aead = init_tink_env_aead(key_uri, credentials)
+    env_aead = init_tink_caching_env_aead(key_uri, credentials)
     db = init_db(
         db_user,
         db_pass,
@@ -70,14 +70,14 @@ def main() -> None:
 
 def encrypt_and_insert_data(
     db: sqlalchemy.engine.base.Engine,
-    env_aead: tink.aead.KmsEnvelopeAead,
+    env_aead: tink.aead.Aead,
     table_name: str,
     team: str,
     email: str,
 ) -> None:
     """
     Inserts a vote into the database with email address previously encrypted using
-    a KmsEnvelopeAead object.
+    an envelope AEAD object.
     """
     time_cast = datetime.datetime.now(tz=datetime.timezone.utc)
     # Use the envelope AEAD primitive to encrypt the email, using the team name as
@@ -21,7 +21,9 @@ import pymysql
 import sqlalchemy
 
 
-def connect_with_connector() -> sqlalchemy.engine.base.Engine:
+def connect_with_connector(
+    pool_size: int = 5, poolclass: type = sqlalchemy.pool.QueuePool
+) -> sqlalchemy.engine.base.Engine:
     """
     Initializes a connection pool for a Cloud SQL instance of MySQL.
 
@@ -57,8 +59,10 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
         "mysql+pymysql://",
         creator=getconn,
         # [START_EXCLUDE]
+        # The pool class, e.g. one that records metrics of the pool.
+        poolclass=poolclass,
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
+        pool_size=pool_size,
         # Temporarily exceeds the set pool_size if no connections are available.
         max_overflow=2,
         # The total number of concurrent connections for your application will be
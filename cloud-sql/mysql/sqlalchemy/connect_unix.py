@@ -18,7 +18,9 @@ import os
 import sqlalchemy
 
 
-def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
+def connect_unix_socket(
+    pool_size: int = 5, poolclass: type = sqlalchemy.pool.QueuePool
+) -> sqlalchemy.engine.base.Engine:
     """Initializes a Unix socket connection pool for a Cloud SQL instance of MySQL."""
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
@@ -42,8 +44,10 @@ def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
             query={"unix_socket": unix_socket_path},
         ),
         # [START_EXCLUDE]
+        # The pool class, e.g. one that records metrics of the pool.
+        poolclass=poolclass,
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
+        pool_size=pool_size,
         # Temporarily exceeds the set pool_size if no connections are available.
         max_overflow=2,
         # The total number of concurrent connections for your application will be
@@ -0,0 +1,142 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sizes, warms up and measures the connection pool of the app."""
+
+from __future__ import annotations
+
+from concurrent import futures
+import os
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy.pool import QueuePool
+
+# The pool size of the connect_* functions, if the concurrency is unknown
+DEFAULT_POOL_SIZE = 5
+# The upper bounds in seconds of the buckets of the checkout wait histogram
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+
+class PoolMetrics:
+    """Counts the checkouts of a connection pool and how long they waited."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.wait_sum = 0.0
+        self.wait_buckets = [0] * len(WAIT_BUCKETS)
+
+    def record_checkout(self, wait: float, overflow: bool) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.overflow_checkouts += overflow
+            self.wait_sum += wait
+            for i, bound in enumerate(WAIT_BUCKETS):
+                if wait <= bound:
+                    self.wait_buckets[i] += 1
+
+    def record_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+    def render(self, pool: sqlalchemy.pool.Pool) -> str:
+        """Returns the metrics and the state of the pool in the Prometheus
+        text format."""
+        with self._lock:
+            lines = [
+                "# TYPE db_pool_checkouts_total counter",
+                f"db_pool_checkouts_total {self.checkouts}",
+                "# TYPE db_pool_overflow_checkouts_total counter",
+                f"db_pool_overflow_checkouts_total {self.overflow_checkouts}",
+                "# TYPE db_pool_timeouts_total counter",
+                f"db_pool_timeouts_total {self.timeouts}",
+                "# TYPE db_pool_wait_seconds histogram",
+            ]
+            for bound, count in zip(WAIT_BUCKETS, self.wait_buckets):
+                lines.append(f'db_pool_wait_seconds_bucket{{le="{bound}"}} {count}')
+            lines += [
+                f'db_pool_wait_seconds_bucket{{le="+Inf"}} {self.checkouts}',
+                f"db_pool_wait_seconds_sum {self.wait_sum}",
+                f"db_pool_wait_seconds_count {self.checkouts}",
+            ]
+        if isinstance(pool, QueuePool):
+            lines += [
+                "# TYPE db_pool_size gauge",
+                f"db_pool_size {pool.size()}",
+                "# TYPE db_pool_checked_out gauge",
+                f"db_pool_checked_out {pool.checkedout()}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+class _InstrumentedPoolMixin:
+    # Set after the engine is created, and copied when the pool is recreated.
+    metrics: PoolMetrics | None = None
+
+    def connect(self) -> sqlalchemy.pool.PoolProxiedConnection:
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except sqlalchemy.exc.TimeoutError:
+            if self.metrics:
+                self.metrics.record_timeout()
+            raise
+        if self.metrics:
+            self.metrics.record_checkout(
+                time.perf_counter() - started, self.checkedout() > self.size()
+            )
+        return connection
+
+    def recreate(self) -> QueuePool:
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class InstrumentedQueuePool(_InstrumentedPoolMixin, QueuePool):
+    """A QueuePool that records its checkouts in PoolMetrics.
+
+    Pass it as the `poolclass` of `sqlalchemy.create_engine`, then set the
+    `metrics` of the engine's pool.
+    """
+
+
+def pool_size(concurrency: int | None, default: int) -> int:
+    """Returns the pool size for the number of requests an instance of the
+    app serves at once, or default if that's unknown.
+
+    Every request holds at most one connection, so a pool as large as the
+    concurrency never makes requests wait. DB_POOL_SIZE overrides it.
+    """
+    if os.environ.get("DB_POOL_SIZE"):
+        return int(os.environ["DB_POOL_SIZE"])
+    return concurrency or default
+
+
+def warm_up_pool(db: sqlalchemy.engine.base.Engine, connections: int) -> None:
+    """Opens the connections concurrently and returns them to the pool, so
+    that the first requests don't wait for connections to be opened."""
+    with futures.ThreadPoolExecutor(connections) as executor:
+        pending = [executor.submit(db.connect) for _ in range(connections)]
+    try:
+        for future in pending:
+            future.result()
+    finally:
+        for future in pending:
+            if not future.exception():
+                future.result().close()
@@ -60,6 +60,20 @@ def test_cast_vote(client: FlaskClient) -> None:
     assert text in body
 
 
+def test_vote_counts(client: FlaskClient) -> None:
+    before = app.get_index_context(app.db)
+    test_cast_vote(client)
+    after = app.get_index_context(app.db)
+    assert after["space_count"] == before["space_count"] + 1
+    assert after["tab_count"] == before["tab_count"]
+
+
+def test_metrics(client: FlaskClient) -> None:
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "db_pool_checkouts_total" in response.text
+
+
 def test_unix_connection(client: FlaskClient) -> None:
     del os.environ["INSTANCE_HOST"]
     app.db = app.init_connection_pool()
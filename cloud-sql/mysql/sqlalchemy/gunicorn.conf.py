@@ -0,0 +1,26 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Gunicorn loads this file from its working directory when it starts, see
+# https://docs.gunicorn.org/en/stable/settings.html
+
+from gunicorn.workers.base import Worker
+
+
+def post_worker_init(worker: Worker) -> None:
+    """Connects to the database when a worker starts, instead of on its first
+    request, with a connection for each of the worker's threads."""
+    import app
+
+    app.start_db(worker.cfg.threads)
@@ -18,7 +18,7 @@ import os
 import sqlalchemy
 import tink
 
-from .cloud_kms_env_aead import init_tink_env_aead
+from .caching_env_aead import init_tink_caching_env_aead
 from .cloud_sql_connection_pool import init_db
 from .encrypt_and_insert_data import encrypt_and_insert_data
 
@@ -51,7 +51,7 @@ def main() -> None:
     team = "TABS"
     email = "hello@example.com"
 
-    env_aead = init_tink_env_aead(key_uri, credentials)
+    env_aead = init_tink_caching_env_aead(key_uri, credentials)
     db = init_db(
         db_user,
         db_pass,
@@ -68,11 +68,11 @@ def main() -> None:
 
 def query_and_decrypt_data(
     db: sqlalchemy.engine.base.Engine,
-    env_aead: tink.aead.KmsEnvelopeAead,
+    env_aead: tink.aead.Aead,
     table_name: str,
 ) -> list[tuple[str]]:
     """
-    Retrieves data from the database and decrypts it using the KmsEnvelopeAead object.
+    Retrieves data from the database and decrypts it using the envelope AEAD object.
     """
     with db.connect() as conn:
         # Execute the query and fetch all results
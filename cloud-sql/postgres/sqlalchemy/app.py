@@ -17,6 +17,8 @@ from __future__ import annotations
 import datetime
 import logging
 import os
+import threading
+import time
 
 from flask import Flask, render_template, request, Response
 
@@ -26,30 +28,34 @@ from connect_connector import connect_with_connector
 from connect_connector_auto_iam_authn import connect_with_connector_auto_iam_authn
 from connect_tcp import connect_tcp_socket
 from connect_unix import connect_unix_socket
+import connection_pool
 
 app = Flask(__name__)
 
 logger = logging.getLogger()
 
 
-def init_connection_pool() -> sqlalchemy.engine.base.Engine:
+def init_connection_pool(
+    pool_size: int = connection_pool.DEFAULT_POOL_SIZE,
+    poolclass: type = sqlalchemy.pool.QueuePool,
+) -> sqlalchemy.engine.base.Engine:
     """Sets up connection pool for the app."""
     # use a TCP socket when INSTANCE_HOST (e.g. 127.0.0.1) is defined
     if os.environ.get("INSTANCE_HOST"):
-        return connect_tcp_socket()
+        return connect_tcp_socket(pool_size, poolclass)
 
     # use a Unix socket when INSTANCE_UNIX_SOCKET (e.g. /cloudsql/project:region:instance) is defined
     if os.environ.get("INSTANCE_UNIX_SOCKET"):
-        return connect_unix_socket()
+        return connect_unix_socket(pool_size, poolclass)
 
     # use the connector when INSTANCE_CONNECTION_NAME (e.g. project:region:instance) is defined
     if os.environ.get("INSTANCE_CONNECTION_NAME"):
         # Either a DB_USER or a DB_IAM_USER should be defined. If both are
         # defined, DB_IAM_USER takes precedence.
         return (
-            connect_with_connector_auto_iam_authn()
+            connect_with_connector_auto_iam_authn(pool_size, poolclass)
             if os.environ.get("DB_IAM_USER")
-            else connect_with_connector()
+            else connect_with_connector(pool_size, poolclass)
         )
 
     raise ValueError(
@@ -57,9 +63,35 @@ def init_connection_pool() -> sqlalchemy.engine.base.Engine:
     )
 
 
+def init_replica_connection_pool() -> sqlalchemy.engine.base.Engine | None:
+    """Sets up a connection pool for the read replica that serves the index
+    page, if REPLICA_INSTANCE_HOST (e.g. 127.0.0.1) is defined.
+
+    The replica is connected to over TCP with the same database user and
+    name as the primary instance, e.g. through a second Cloud SQL Auth Proxy
+    listening on REPLICA_DB_PORT.
+    """
+    if not os.environ.get("REPLICA_INSTANCE_HOST"):
+        return None
+    return sqlalchemy.create_engine(
+        sqlalchemy.engine.url.URL.create(
+            drivername="postgresql+pg8000",
+            username=os.environ["DB_USER"],
+            password=os.environ["DB_PASS"],
+            host=os.environ["REPLICA_INSTANCE_HOST"],
+            port=os.environ.get("REPLICA_DB_PORT", os.environ.get("DB_PORT")),
+            database=os.environ["DB_NAME"],
+        ),
+        pool_size=5,
+        max_overflow=2,
+        pool_timeout=30,
+        pool_recycle=1800,
+    )
+
+
 # create 'votes' table in database if it does not already exist
 def migrate_db(db: sqlalchemy.engine.base.Engine) -> None:
-    """Creates the `votes` table if it doesn't exist."""
+    """Creates the `votes` and `vote_counts` tables if they don't exist."""
     with db.connect() as conn:
         conn.execute(
             sqlalchemy.text(
@@ -68,7 +100,41 @@ def migrate_db(db: sqlalchemy.engine.base.Engine) -> None:
                 "candidate VARCHAR(6) NOT NULL, PRIMARY KEY (vote_id) );"
             )
         )
+        # The index page shows the most recent votes.
+        conn.execute(
+            sqlalchemy.text(
+                "CREATE INDEX IF NOT EXISTS votes_time_cast ON votes (time_cast);"
+            )
+        )
+        # The number of votes per candidate, which save_vote keeps up to date
+        # so that the index page doesn't have to count the votes.
+        conn.execute(
+            sqlalchemy.text(
+                "CREATE TABLE IF NOT EXISTS vote_counts "
+                "( candidate VARCHAR(6) NOT NULL, vote_count BIGINT NOT NULL, "
+                "PRIMARY KEY (candidate) );"
+            )
+        )
         conn.commit()
+        count_votes(conn)
+
+
+def count_votes(conn: sqlalchemy.engine.base.Connection) -> None:
+    """Counts the votes that were cast before the `vote_counts` table was
+    added, if it's empty."""
+    if conn.execute(sqlalchemy.text("SELECT COUNT(*) FROM vote_counts")).scalar():
+        return
+    try:
+        conn.execute(
+            sqlalchemy.text(
+                "INSERT INTO vote_counts (candidate, vote_count) "
+                "SELECT candidate, COUNT(*) FROM votes GROUP BY candidate"
+            )
+        )
+        conn.commit()
+    except sqlalchemy.exc.IntegrityError:
+        # Another instance of the app counted the votes first.
+        conn.rollback()
 
 
 # This global variable is declared with a value of `None`, instead of calling
@@ -76,32 +142,94 @@ def migrate_db(db: sqlalchemy.engine.base.Engine) -> None:
 # is safe to initialize your database connection pool when your script starts
 # -- there is no need to wait for the first request.
 db = None
-
-
-# init_db lazily instantiates a database connection pool. Users of Cloud Run or
-# App Engine may wish to skip this lazy instantiation and connect as soon
-# as the function is loaded. This is primarily to help testing.
+# The optional read replica that serves the index page.
+replica_db = None
+db_lock = threading.Lock()
+pool_metrics = connection_pool.PoolMetrics()
+
+# The index page is served from this in-process cache for INDEX_CACHE_TTL
+# seconds, so that page views don't each query the database. Votes cast
+# through this instance clear the cache.
+INDEX_CACHE_TTL = float(os.environ.get("INDEX_CACHE_TTL", "1"))
+index_cache = {"context": None, "expires": 0.0}
+index_cache_lock = threading.Lock()
+
+
+# init_db lazily instantiates a database connection pool. When the app is
+# served by gunicorn, gunicorn.conf.py calls start_db instead, which connects
+# as soon as the app is loaded. The lazy instantiation is primarily to help
+# testing.
 @app.before_request
-def init_db() -> sqlalchemy.engine.base.Engine:
-    """Initiates connection to database and its structure."""
-    global db
-    if db is None:
-        db = init_connection_pool()
-        migrate_db(db)
+def init_db(concurrency: int | None = None) -> None:
+    """Initiates connection to database and its structure.
+
+    Args:
+        concurrency: The number of requests the app serves at once, which
+            the connection pool is sized for.
+    """
+    global db, replica_db
+    if db is not None:
+        return
+    with db_lock:
+        if db is None:
+            pool = init_connection_pool(
+                connection_pool.pool_size(
+                    concurrency, connection_pool.DEFAULT_POOL_SIZE
+                ),
+                connection_pool.InstrumentedQueuePool,
+            )
+            pool.pool.metrics = pool_metrics
+            migrate_db(pool)
+            replica_db = init_replica_connection_pool()
+            db = pool
+
+
+def start_db(concurrency: int) -> None:
+    """Initiates the connection pool and opens all its connections, so that
+    the first requests don't wait for them."""
+    init_db(concurrency)
+    started = time.monotonic()
+    connection_pool.warm_up_pool(db, db.pool.size())
+    logger.info(
+        f"Opened {db.pool.size()} connections in {time.monotonic() - started:.2f}s"
+    )
 
 
 @app.route("/", methods=["GET"])
 def render_index() -> str:
     """Serves the index page of the app."""
-    context = get_index_context(db)
+    context = get_cached_index_context(replica_db or db)
     return render_template("index.html", **context)
 
 
+@app.route("/metrics", methods=["GET"])
+def render_metrics() -> Response:
+    """Serves the metrics of the connection pool in the Prometheus format."""
+    return Response(pool_metrics.render(db.pool), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/votes", methods=["POST"])
 def cast_vote() -> Response:
     """Processes a single vote from user."""
     team = request.form["team"]
-    return save_vote(db, team)
+    response = save_vote(db, team)
+    if response.status_code == 200:
+        with index_cache_lock:
+            index_cache["expires"] = 0.0
+    return response
+
+
+def get_cached_index_context(db: sqlalchemy.engine.base.Engine) -> dict:
+    """Returns the result of get_index_context, cached for INDEX_CACHE_TTL
+    seconds."""
+    with index_cache_lock:
+        if time.monotonic() < index_cache["expires"]:
+            return index_cache["context"]
+    context = get_index_context(db)
+    with index_cache_lock:
+        index_cache["context"] = context
+        index_cache["expires"] = time.monotonic() + INDEX_CACHE_TTL
+    return context
 
 
 # get_index_context gets data required for rendering HTML application
@@ -126,13 +254,15 @@ def get_index_context(db: sqlalchemy.engine.base.Engine) -> dict:
         for row in recent_votes:
             votes.append({"candidate": row[0], "time_cast": row[1]})
 
-        stmt = sqlalchemy.text(
-            "SELECT COUNT(vote_id) FROM votes WHERE candidate=:candidate"
+        # Read the number of votes of both candidates, which save_vote keeps
+        # up to date
+        vote_counts = dict(
+            conn.execute(
+                sqlalchemy.text("SELECT candidate, vote_count FROM vote_counts")
+            ).fetchall()
         )
-        # Count number of votes for tabs
-        tab_count = conn.execute(stmt, parameters={"candidate": "TABS"}).scalar()
-        # Count number of votes for spaces
-        space_count = conn.execute(stmt, parameters={"candidate": "SPACES"}).scalar()
+        tab_count = vote_counts.get("TABS", 0)
+        space_count = vote_counts.get("SPACES", 0)
 
     return {
         "space_count": space_count,
@@ -165,11 +295,19 @@ def save_vote(db: sqlalchemy.engine.base.Engine, team: str) -> Response:
     stmt = sqlalchemy.text(
         "INSERT INTO votes (time_cast, candidate) VALUES (:time_cast, :candidate)"
     )
+    # Adds the vote to the count, or starts the count if it's the first vote.
+    count_stmt = sqlalchemy.text(
+        "INSERT INTO vote_counts (candidate, vote_count) VALUES (:candidate, 1) "
+        "ON CONFLICT (candidate) DO UPDATE "
+        "SET vote_count = vote_counts.vote_count + 1"
+    )
     try:
         # Using a with statement ensures that the connection is always released
         # back into the pool at the end of statement (even if an error occurs)
         with db.connect() as conn:
             conn.execute(stmt, parameters={"time_cast": time_cast, "candidate": team})
+            # The vote and its count are committed in the same transaction.
+            conn.execute(count_stmt, parameters={"candidate": team})
             conn.commit()
     except Exception as e:
         # If something goes wrong, handle the error in this section. This might
@@ -0,0 +1,85 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+
+import asyncpg
+from google.cloud.sql.connector import Connector, IPTypes
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+import connection_pool
+
+
+async def connect_with_connector_async(
+    connector: Connector,
+    pool_size: int = 5,
+    metrics: connection_pool.PoolMetrics | None = None,
+) -> AsyncEngine:
+    """
+    Initializes an asyncio connection pool for a Cloud SQL instance of Postgres.
+
+    Uses the asyncpg driver through the Cloud SQL Python Connector package.
+    The connector must be created in the event loop that uses the pool, with
+    `await google.cloud.sql.connector.create_async_connector()`, and closed
+    with `await connector.close_async()`.
+    """
+    # Note: Saving credentials in environment variables is convenient, but not
+    # secure - consider a more secure solution such as
+    # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
+    # keep secrets safe.
+
+    instance_connection_name = os.environ[
+        "INSTANCE_CONNECTION_NAME"
+    ]  # e.g. 'project:region:instance'
+    db_user = os.environ["DB_USER"]  # e.g. 'my-db-user'
+    db_pass = os.environ["DB_PASS"]  # e.g. 'my-db-password'
+    db_name = os.environ["DB_NAME"]  # e.g. 'my-database'
+
+    ip_type = IPTypes.PRIVATE if os.environ.get("PRIVATE_IP") else IPTypes.PUBLIC
+
+    async def getconn() -> asyncpg.Connection:
+        conn: asyncpg.Connection = await connector.connect_async(
+            instance_connection_name,
+            "asyncpg",
+            user=db_user,
+            password=db_pass,
+            db=db_name,
+            ip_type=ip_type,
+        )
+        return conn
+
+    # The Cloud SQL Python Connector can be used with SQLAlchemy's asyncio
+    # extension using the 'async_creator' argument to 'create_async_engine'
+    pool = create_async_engine(
+        "postgresql+asyncpg://",
+        async_creator=getconn,
+        # Records the checkouts of the pool in the metrics.
+        poolclass=connection_pool.InstrumentedAsyncAdaptedQueuePool,
+        # Pool size is the maximum number of permanent connections to keep.
+        pool_size=pool_size,
+        # Temporarily exceeds the set pool_size if no connections are available.
+        max_overflow=2,
+        # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
+        # new connection from the pool. After the specified amount of time, an
+        # exception will be thrown.
+        pool_timeout=30,  # 30 seconds
+        # 'pool_recycle' is the maximum number of seconds a connection can persist.
+        # Connections that live longer than the specified amount of time will be
+        # re-established
+        pool_recycle=1800,  # 30 minutes
+    )
+    pool.sync_engine.pool.metrics = metrics
+    return pool
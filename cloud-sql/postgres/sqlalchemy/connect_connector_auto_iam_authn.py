@@ -21,7 +21,9 @@ import pg8000
 import sqlalchemy
 
 
-def connect_with_connector_auto_iam_authn() -> sqlalchemy.engine.base.Engine:
+def connect_with_connector_auto_iam_authn(
+    pool_size: int = 5, poolclass: type = sqlalchemy.pool.QueuePool
+) -> sqlalchemy.engine.base.Engine:
     """
     Initializes a connection pool for a Cloud SQL instance of Postgres.
 
@@ -59,8 +61,10 @@ def connect_with_connector_auto_iam_authn() -> sqlalchemy.engine.base.Engine:
         "postgresql+pg8000://",
         creator=getconn,
         # [START_EXCLUDE]
+        # The pool class, e.g. one that records metrics of the pool.
+        poolclass=poolclass,
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
+        pool_size=pool_size,
         # Temporarily exceeds the set pool_size if no connections are available.
         max_overflow=2,
         # The total number of concurrent connections for your application will be
@@ -22,7 +22,9 @@ import ssl
 import sqlalchemy
 
 
-def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
+def connect_tcp_socket(
+    pool_size: int = 5, poolclass: type = sqlalchemy.pool.QueuePool
+) -> sqlalchemy.engine.base.Engine:
     """Initializes a TCP connection pool for a Cloud SQL instance of Postgres."""
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
@@ -68,9 +70,11 @@ def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
         connect_args=connect_args,
         # [START cloud_sql_postgres_sqlalchemy_connect_tcp]
         # [START_EXCLUDE]
+        # The pool class, e.g. one that records metrics of the pool.
+        poolclass=poolclass,
         # [START cloud_sql_postgres_sqlalchemy_limit]
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
+        pool_size=pool_size,
         # Temporarily exceeds the set pool_size if no connections are available.
         max_overflow=2,
         # The total number of concurrent connections for your application will be
@@ -12,14 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import logging
 import os
 
 from flask.testing import FlaskClient
-
+from google.cloud.sql.connector import create_async_connector
 import pytest
+import sqlalchemy
 
 import app
+from connect_connector_async import connect_with_connector_async
+import connection_pool
 
 logger = logging.getLogger()
 
@@ -60,6 +64,20 @@ def test_cast_vote(client: FlaskClient) -> None:
     assert text in body
 
 
+def test_vote_counts(client: FlaskClient) -> None:
+    before = app.get_index_context(app.db)
+    test_cast_vote(client)
+    after = app.get_index_context(app.db)
+    assert after["space_count"] == before["space_count"] + 1
+    assert after["tab_count"] == before["tab_count"]
+
+
+def test_metrics(client: FlaskClient) -> None:
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "db_pool_checkouts_total" in response.text
+
+
 def test_unix_connection(client: FlaskClient) -> None:
     del os.environ["INSTANCE_HOST"]
     app.db = app.init_connection_pool()
@@ -74,3 +92,21 @@ def test_connector_connection(client: FlaskClient) -> None:
     assert str(app.db.url) == "postgresql+pg8000://"
     test_get_votes(client)
     test_cast_vote(client)
+
+
+def test_async_connector_connection(client: FlaskClient) -> None:
+    async def query() -> int:
+        connector = await create_async_connector()
+        metrics = connection_pool.PoolMetrics()
+        db = await connect_with_connector_async(connector, pool_size=2, metrics=metrics)
+        try:
+            await connection_pool.warm_up_pool_async(db, 2)
+            async with db.connect() as conn:
+                result = await conn.execute(sqlalchemy.text("SELECT 1"))
+                assert result.scalar() == 1
+        finally:
+            await db.dispose()
+            await connector.close_async()
+        return metrics.checkouts
+
+    assert asyncio.run(query()) == 3
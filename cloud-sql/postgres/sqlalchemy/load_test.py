@@ -0,0 +1,140 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the latency of the index page of the app with many votes.
+
+Adds votes to the database the app is configured to use (see README.md)
+until it has --votes votes, then loads the index page, and casts a vote for
+every --write_ratio page loads, from concurrent threads. The latency
+percentiles of the page are printed with the index cache disabled and with
+it enabled.
+
+Example usage:
+    python load_test.py --votes 1000000 --requests 2000 --concurrency 16
+"""
+
+from __future__ import annotations
+
+import argparse
+from concurrent import futures
+import datetime
+import random
+import time
+
+import sqlalchemy
+
+import app
+
+BATCH_SIZE = 10000
+
+
+def add_votes(db: sqlalchemy.engine.base.Engine, votes: int) -> None:
+    """Adds random votes until the database has the given number of votes."""
+    with db.connect() as conn:
+        missing = (
+            votes - conn.execute(sqlalchemy.text("SELECT COUNT(*) FROM votes")).scalar()
+        )
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    while missing > 0:
+        rows = [
+            {
+                "time_cast": now - datetime.timedelta(seconds=missing - i),
+                "candidate": random.choice(("TABS", "SPACES")),
+            }
+            for i in range(min(missing, BATCH_SIZE))
+        ]
+        with db.connect() as conn:
+            conn.execute(
+                sqlalchemy.text(
+                    "INSERT INTO votes (time_cast, candidate) "
+                    "VALUES (:time_cast, :candidate)"
+                ),
+                rows,
+            )
+            conn.commit()
+        missing -= len(rows)
+        print(f"{missing} votes left to add")
+    # Counts the votes again, including the added ones.
+    with db.connect() as conn:
+        conn.execute(sqlalchemy.text("DELETE FROM vote_counts"))
+        conn.commit()
+        app.count_votes(conn)
+
+
+def percentile(latencies: list[float], p: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def run(requests: int, concurrency: int, write_ratio: int) -> None:
+    """Loads the index page and casts votes, and prints the page latency."""
+
+    def load_page(i: int) -> float | None:
+        client = app.app.test_client()
+        if write_ratio and i % write_ratio == write_ratio - 1:
+            client.post("/votes", data={"team": random.choice(("TABS", "SPACES"))})
+            return None
+        started = time.perf_counter()
+        response = client.get("/")
+        latency = time.perf_counter() - started
+        assert response.status_code == 200
+        return latency
+
+    started = time.perf_counter()
+    with futures.ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(
+            latency
+            for latency in executor.map(load_page, range(requests))
+            if latency is not None
+        )
+    elapsed = time.perf_counter() - started
+    print(
+        f"  {len(latencies)} page loads in {elapsed:.1f}s, "
+        f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+        f"p90={percentile(latencies, 90) * 1000:.1f}ms "
+        f"p99={percentile(latencies, 99) * 1000:.1f}ms "
+        f"max={latencies[-1] * 1000:.1f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--votes", type=int, default=1000000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--write_ratio",
+        type=int,
+        default=10,
+        help="Casts a vote for every this many requests, 0 to cast none.",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=app.INDEX_CACHE_TTL,
+        help="The time in seconds the index page is cached for.",
+    )
+    args = parser.parse_args()
+
+    app.init_db()
+    add_votes(app.db, args.votes)
+    for cache_ttl in (0, args.cache_ttl):
+        app.INDEX_CACHE_TTL = cache_ttl
+        print(f"INDEX_CACHE_TTL={cache_ttl}:")
+        run(args.requests, args.concurrency, args.write_ratio)
+
+
+if __name__ == "__main__":
+    main()
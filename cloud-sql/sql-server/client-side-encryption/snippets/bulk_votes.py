@@ -0,0 +1,174 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module is the same in the MySQL, Postgres and SQL Server samples.
+
+import collections
+from collections.abc import Iterable, Iterator
+from concurrent import futures
+import datetime
+import io
+import itertools
+from typing import Any
+
+import sqlalchemy
+import tink
+
+TEAMS = ("TABS", "SPACES")
+
+
+def _encrypt_many(
+    env_aead: tink.aead.Aead, messages: list[tuple[bytes, bytes]]
+) -> list[bytes]:
+    # CachingEnvelopeAead encrypts a batch at once, other primitives one by one.
+    if hasattr(env_aead, "encrypt_many"):
+        return env_aead.encrypt_many(messages)
+    return [env_aead.encrypt(plaintext, ad) for plaintext, ad in messages]
+
+
+def _decrypt_many(
+    env_aead: tink.aead.Aead, messages: list[tuple[bytes, bytes]]
+) -> list[bytes]:
+    # CachingEnvelopeAead decrypts a batch at once, other primitives one by one.
+    if hasattr(env_aead, "decrypt_many"):
+        return env_aead.decrypt_many(messages)
+    return [env_aead.decrypt(ciphertext, ad) for ciphertext, ad in messages]
+
+
+def _copy_votes(
+    conn: sqlalchemy.engine.Connection, table_name: str, rows: list[dict[str, Any]]
+) -> None:
+    """
+    Inserts the rows with the COPY command of Postgres, which is faster than
+    inserting them with INSERT statements.
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        # In the text format of COPY, bytea values are written in hex, and
+        # their leading backslash is escaped.
+        buffer.write(
+            f"{row['time_cast'].isoformat()}\t{row['team']}\t"
+            f"\\\\x{row['voter_email'].hex()}\n"
+        )
+    buffer.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(
+            f"COPY {table_name} (time_cast, team, voter_email) FROM STDIN",
+            stream=buffer,
+        )
+    finally:
+        cursor.close()
+
+
+def encrypt_and_insert_votes(
+    db: sqlalchemy.engine.base.Engine,
+    env_aead: tink.aead.Aead,
+    table_name: str,
+    votes: Iterable[tuple[str, str]],
+    batch_size: int = 1000,
+) -> int:
+    """
+    Inserts (team, email) votes into the database, with the email addresses
+    encrypted using an envelope AEAD object.
+
+    The votes are encrypted and inserted batch_size at a time, over one
+    connection and in one transaction: with COPY on Postgres, and with
+    executemany on the other databases. Any number of votes can be passed
+    as an iterable.
+
+    Returns the number of votes inserted.
+    """
+    use_copy = db.dialect.name == "postgresql" and db.dialect.driver == "pg8000"
+    if db.dialect.name == "mssql":
+        voter_email = "CONVERT(varbinary(max), :voter_email, 0)"
+    else:
+        voter_email = ":voter_email"
+    stmt = sqlalchemy.text(
+        f"INSERT INTO {table_name} (time_cast, team, voter_email)"
+        f" VALUES (:time_cast, :team, {voter_email})"
+    )
+
+    votes = iter(votes)
+    inserted = 0
+    with db.begin() as conn:
+        while batch := list(itertools.islice(votes, batch_size)):
+            for team, _ in batch:
+                # Verify that the team is one of the allowed options
+                if team not in TEAMS:
+                    raise ValueError(f"Invalid team specified: {team}")
+            # The team name is the associated data of the encrypted email.
+            encrypted_emails = _encrypt_many(
+                env_aead, [(email.encode(), team.encode()) for team, email in batch]
+            )
+            time_cast = datetime.datetime.now(tz=datetime.timezone.utc)
+            rows = [
+                {"time_cast": time_cast, "team": team, "voter_email": encrypted_email}
+                for (team, _), encrypted_email in zip(batch, encrypted_emails)
+            ]
+            if use_copy:
+                _copy_votes(conn, table_name, rows)
+            else:
+                conn.execute(stmt, rows)
+            inserted += len(rows)
+    return inserted
+
+
+def _decrypt_rows(
+    env_aead: tink.aead.Aead, rows: list[sqlalchemy.engine.Row]
+) -> list[tuple[str, str, datetime.datetime]]:
+    # SQL Server returns the team as bytes, the other databases as str.
+    teams = [
+        row.team.decode() if isinstance(row.team, bytes) else row.team for row in rows
+    ]
+    emails = _decrypt_many(
+        env_aead,
+        [(row.voter_email, team.encode()) for row, team in zip(rows, teams)],
+    )
+    return [
+        (team, email.decode(), row.time_cast)
+        for row, team, email in zip(rows, teams, emails)
+    ]
+
+
+def query_and_decrypt_votes(
+    db: sqlalchemy.engine.base.Engine,
+    env_aead: tink.aead.Aead,
+    table_name: str,
+    batch_size: int = 1000,
+    max_workers: int = 4,
+) -> Iterator[tuple[str, str, datetime.datetime]]:
+    """
+    Yields all the votes in the database as (team, email, time_cast) tuples,
+    in the order they were inserted, with the email addresses decrypted.
+
+    The rows are read with a server-side cursor, batch_size at a time, so
+    they don't have to fit in memory. Batches are decrypted on a pool of
+    max_workers threads while the next ones are read, and at most
+    max_workers batches are decrypted ahead of the caller.
+    """
+    stmt = sqlalchemy.text(
+        f"SELECT team, time_cast, voter_email FROM {table_name} ORDER BY vote_id"
+    )
+    with db.connect() as conn, futures.ThreadPoolExecutor(max_workers) as executor:
+        result = conn.execution_options(
+            stream_results=True, yield_per=batch_size
+        ).execute(stmt)
+        pending = collections.deque()
+        for rows in result.partitions():
+            pending.append(executor.submit(_decrypt_rows, env_aead, rows))
+            if len(pending) > max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
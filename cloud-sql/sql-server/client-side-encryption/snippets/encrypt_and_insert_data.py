@@ -20,7 +20,7 @@ import os
 import sqlalchemy
 import tink
 
-from .cloud_kms_env_aead import init_tink_env_aead
+from .caching_env_aead import init_tink_caching_env_aead
 from .cloud_sql_connection_pool import init_db
 
 
@@ -52,7 +52,7 @@ def main() -> None:
     team = "TABS"
     email = "hello@example.com"
 
-    env_aead = init_tink_env_aead(key_uri, credentials)
+    env_aead = init_tink_caching_env_aead(key_uri, credentials)
     db = init_db(
         db_user,
         db_pass,
@@ -68,7 +68,7 @@ def main() -> None:
 
 def encrypt_and_insert_data(
     db: sqlalchemy.engine.base.Engine,
-    env_aead: tink.aead.KmsEnvelopeAead,
+    env_aead: tink.aead.Aead,
     table_name: str,
     team: str,
     email: str,
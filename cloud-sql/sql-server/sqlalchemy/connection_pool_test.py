@@ -0,0 +1,59 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+import sqlalchemy
+
+import connection_pool
+
+
+def test_instrumented_queue_pool(tmp_path: os.PathLike) -> None:
+    db = sqlalchemy.create_engine(
+        f"sqlite:///{tmp_path}/votes.db",
+        poolclass=connection_pool.InstrumentedQueuePool,
+        pool_size=2,
+        max_overflow=1,
+        pool_timeout=0.1,
+    )
+    metrics = connection_pool.PoolMetrics()
+    db.pool.metrics = metrics
+
+    connection_pool.warm_up_pool(db, 2)
+    assert db.pool.checkedin() == 2
+    assert metrics.checkouts == 2
+
+    # The third connection overflows the pool, and the fourth times out.
+    conns = [db.connect() for _ in range(3)]
+    with pytest.raises(sqlalchemy.exc.TimeoutError):
+        db.connect()
+    for conn in conns:
+        conn.close()
+
+    assert metrics.checkouts == 5
+    assert metrics.overflow_checkouts == 1
+    assert metrics.timeouts == 1
+    rendered = metrics.render(db.pool)
+    assert "db_pool_checkouts_total 5\n" in rendered
+    assert 'db_pool_wait_seconds_bucket{le="+Inf"} 5\n' in rendered
+    assert "db_pool_size 2\n" in rendered
+
+
+def test_pool_size(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delenv("DB_POOL_SIZE", raising=False)
+    assert connection_pool.pool_size(8, default=5) == 8
+    assert connection_pool.pool_size(None, default=5) == 5
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    assert connection_pool.pool_size(8, default=5) == 3
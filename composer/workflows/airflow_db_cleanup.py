@@ -44,12 +44,30 @@ The DAG is a fork of [teamclairvoyant repository.](https://github.com/teamclairv
     - airflow_db_cleanup__max_db_entry_age_in_days - integer - Length to retain
       the log files if not already provided in the conf. If this is set to 30,
       the job will remove those files that are 30 days old or older.
-
-4. Put the DAG in your gcs bucket.
+    - airflow_db_cleanup__delete_chunk_size - integer - (Optional) Number of
+      entries deleted and committed in a single transaction. Defaults to 10000.
+    - airflow_db_cleanup__max_deletes_per_second - integer - (Optional) Limit
+      of entries deleted per second to reduce the load on the database.
+      Defaults to 0 (no limit).
+    - airflow_db_cleanup__max_active_tasks - integer - (Optional) Number of
+      cleanup tasks running at the same time. Defaults to 4.
+    - airflow_db_cleanup__partition_target_rows - integer - (Optional)
+      Estimated number of entries cleaned up by a single mapped task.
+      Defaults to 1000000.
+
+4. The plan_cleanup task estimates the size of each table and of each dag_id
+   in the table from the PostgreSQL statistics (pg_class and pg_stats, which
+   are refreshed by the analyze_query task) and splits big tables into
+   partitions of their dag_ids. The cleanup_tables task is mapped over the
+   partitions of all tables, ordered from the biggest partition to the
+   smallest, so the biggest cleanups start first.
+
+5. Put the DAG in your gcs bucket.
 """
 from datetime import timedelta
 import logging
 import os
+import time
 
 import airflow
 from airflow import settings
@@ -64,13 +82,13 @@ from airflow.models import (
     XCom,
 )
 from airflow.operators.python import PythonOperator
+from airflow.stats import Stats
 from airflow.utils import timezone
 from airflow.version import version as airflow_version
 
 import dateutil.parser
-from sqlalchemy import and_, func, text
+from sqlalchemy import and_, bindparam, func, inspect, or_, text, tuple_
 from sqlalchemy.exc import ProgrammingError
-from sqlalchemy.orm import load_only
 
 now = timezone.utcnow
 
@@ -91,11 +109,30 @@ AIRFLOW_VERSION = airflow_version[: -len("+composer")].split(".")
 DEFAULT_MAX_DB_ENTRY_AGE_IN_DAYS = int(
     Variable.get("airflow_db_cleanup__max_db_entry_age_in_days", 30)
 )
+# Number of entries deleted and committed in a single transaction. Smaller
+# chunks hold locks for a shorter time and keep the WAL small.
+DELETE_CHUNK_SIZE = int(Variable.get("airflow_db_cleanup__delete_chunk_size", 10000))
+# Limit of entries deleted per second, set to 0 to delete as fast as possible
+MAX_DELETES_PER_SECOND = int(
+    Variable.get("airflow_db_cleanup__max_deletes_per_second", 0)
+)
+# Number of cleanup tasks running at the same time
+MAX_ACTIVE_TASKS = int(Variable.get("airflow_db_cleanup__max_active_tasks", 4))
+# Estimated number of entries cleaned up by a single mapped task, tables are
+# split into partitions of dag_ids of about this size
+PARTITION_TARGET_ROWS = int(
+    Variable.get("airflow_db_cleanup__partition_target_rows", 1000000)
+)
+# Max number of partitions (mapped tasks) per table
+MAX_PARTITIONS_PER_TABLE = 16
 # Prints the database entries which will be getting deleted; set to False
 # to avoid printing large lists and slowdown process
 PRINT_DELETES = False
+# Max number of the database entries printed when PRINT_DELETES is True
+PRINT_DELETES_LIMIT = 100
 # Whether the job should delete the db entries or not. Included if you want to
-# temporarily avoid deleting the db entries.
+# temporarily avoid deleting the db entries. When set to False, the job only
+# counts the entries which would be deleted.
 ENABLE_DELETE = True
 # List of all the objects that will be deleted. Comment out the DB objects you
 # want to skip.
@@ -267,6 +304,7 @@ dag = DAG(
     default_args=default_args,
     schedule_interval=SCHEDULE_INTERVAL,
     start_date=START_DATE,
+    max_active_tasks=MAX_ACTIVE_TASKS,
 )
 if hasattr(dag, "doc_md"):
     dag.doc_md = __doc__
@@ -321,7 +359,7 @@ def build_query(
     keep_last_filters=None,
     keep_last_group_by=None,
 ):
-    query = session.query(airflow_db_model).options(load_only(age_check_column))
+    query = session.query(airflow_db_model)
 
     logging.info("INITIAL QUERY : " + str(query))
 
@@ -353,28 +391,230 @@ def build_query(
 
 
 def print_query(query, airflow_db_model, age_check_column):
-    entries_to_delete = query.all()
-
     logging.info("Query: " + str(query))
     logging.info(
         "Process will be Deleting the following "
         + str(airflow_db_model.__name__)
-        + "(s):"
+        + "(s) (showing up to "
+        + str(PRINT_DELETES_LIMIT)
+        + "):"
     )
-    for entry in entries_to_delete:
+    for entry in query.limit(PRINT_DELETES_LIMIT):
         date = str(entry.__dict__[str(age_check_column).split(".")[1]])
         logging.info("\tEntry: " + str(entry) + ", Date: " + date)
 
     logging.info(
         "Process will be Deleting "
-        + str(len(entries_to_delete))
+        + str(count_query(query))
         + " "
         + str(airflow_db_model.__name__)
         + "(s)"
     )
 
 
-def cleanup_function(**context):
+def count_query(query):
+    """Counts the entries matching the query without loading them."""
+    return query.with_entities(func.count()).order_by(None).scalar()
+
+
+def _key_range_filters(primary_key, lower, upper):
+    """Builds filters for the primary keys in the (lower, upper] range."""
+    if len(primary_key) == 1:
+        key = primary_key[0]
+        lower = lower[0] if lower is not None else None
+        upper = upper[0] if upper is not None else None
+    else:
+        # Row value comparison for composite primary keys
+        key = tuple_(*primary_key)
+        lower = tuple_(*lower) if lower is not None else None
+        upper = tuple_(*upper) if upper is not None else None
+    filters = []
+    if lower is not None:
+        filters.append(key > lower)
+    if upper is not None:
+        filters.append(key <= upper)
+    return filters
+
+
+def delete_in_chunks(session, query, airflow_db_model):
+    """Deletes the entries matching the query in chunks of DELETE_CHUNK_SIZE.
+
+    The chunks are consecutive primary key ranges, so each chunk is found with
+    a short index scan. Each chunk is deleted and committed in its own
+    transaction, and the rate of deletes is limited by MAX_DELETES_PER_SECOND.
+
+    Returns the number of deleted entries.
+    """
+    model_name = airflow_db_model.__name__
+    primary_key = list(inspect(airflow_db_model).primary_key)
+    keys = query.with_entities(*primary_key).order_by(*primary_key)
+    started = time.monotonic()
+    deleted, chunks, lower = 0, 0, None
+
+    while True:
+        # Find the last key of the next chunk
+        upper = (
+            keys.filter(*_key_range_filters(primary_key, lower, None))
+            .offset(DELETE_CHUNK_SIZE - 1)
+            .limit(1)
+            .first()
+        )
+        chunk_deleted = query.filter(
+            *_key_range_filters(primary_key, lower, upper)
+        ).delete(synchronize_session=False)
+        session.commit()
+
+        deleted += chunk_deleted
+        chunks += 1
+        elapsed = time.monotonic() - started
+        Stats.incr(f"{DAG_ID}.{model_name}.deleted", chunk_deleted)
+        logging.info(
+            "Deleted %s %s(s) in %s chunk(s), %.1f entries/s",
+            deleted,
+            model_name,
+            chunks,
+            deleted / elapsed if elapsed else 0.0,
+        )
+        if upper is None:
+            break
+        lower = tuple(upper)
+
+        if MAX_DELETES_PER_SECOND > 0:
+            time.sleep(max(0.0, deleted / MAX_DELETES_PER_SECOND - elapsed))
+
+    Stats.timing(
+        f"{DAG_ID}.{model_name}.delete_duration",
+        timedelta(seconds=time.monotonic() - started),
+    )
+    return deleted
+
+
+def delete_query(session, query, airflow_db_model, age_check_column):
+    """Deletes the entries matching the query or only counts them when
+    ENABLE_DELETE is False."""
+    if PRINT_DELETES:
+        print_query(query, airflow_db_model, age_check_column)
+    if ENABLE_DELETE:
+        logging.info("Performing Delete...")
+        delete_in_chunks(session, query, airflow_db_model)
+    else:
+        logging.info(
+            "Dry run: %s %s(s) would be deleted",
+            count_query(query),
+            airflow_db_model.__name__,
+        )
+    session.commit()
+
+
+def estimate_table_rows(session, table_names):
+    """Estimates the number of rows of the tables from the pg_class statistics.
+
+    Returns an empty dictionary if the database is not PostgreSQL.
+    """
+    if session.bind.dialect.name != "postgresql":
+        return {}
+    statement = text(
+        "SELECT relname, reltuples FROM pg_class "
+        "WHERE relkind = 'r' AND relname IN :table_names"
+    ).bindparams(bindparam("table_names", expanding=True))
+    rows = session.execute(statement, {"table_names": list(table_names)})
+    # reltuples is -1 for tables that were never analyzed
+    return {relname: max(int(reltuples), 0) for relname, reltuples in rows}
+
+
+def estimate_dag_id_rows(session, table_name, table_rows):
+    """Estimates the number of rows per dag_id from the pg_stats statistics.
+
+    Returns a dictionary of the estimates for the most common dag_ids and
+    the estimate for any other dag_id.
+    """
+    if session.bind.dialect.name != "postgresql" or not table_rows:
+        return {}, 0
+    stats = session.execute(
+        text(
+            "SELECT most_common_vals::text::text[], most_common_freqs, n_distinct "
+            "FROM pg_stats WHERE tablename = :table_name AND attname = 'dag_id'"
+        ),
+        {"table_name": table_name},
+    ).first()
+    if stats is None:
+        return {}, 0
+    values, freqs, n_distinct = stats
+    common = {
+        value: int(freq * table_rows) for value, freq in zip(values or [], freqs or [])
+    }
+    # negative n_distinct is the number of distinct values divided by the rows
+    distinct = -n_distinct * table_rows if n_distinct < 0 else n_distinct
+    other_distinct = max(distinct - len(common), 1)
+    other_rows = max(table_rows - sum(common.values()), 0) / other_distinct
+    return common, int(other_rows)
+
+
+def partition_dag_ids(dag_ids, estimates, default_estimate, target_rows):
+    """Splits dag_ids into partitions of about target_rows estimated rows.
+
+    Returns op_kwargs of the mapped cleanup tasks ordered from the biggest
+    partition to the smallest.
+    """
+    partitions = []
+    dag_ids = sorted(
+        dag_ids,
+        key=lambda dag_id: estimates.get(dag_id, default_estimate),
+        reverse=True,
+    )
+    for dag_id in dag_ids:
+        rows = estimates.get(dag_id, default_estimate)
+        if not partitions or partitions[-1]["estimated_rows"] + rows > target_rows:
+            partitions.append({"dag_ids": [], "estimated_rows": 0})
+        partitions[-1]["dag_ids"].append(dag_id)
+        partitions[-1]["estimated_rows"] += rows
+    return sorted(partitions, key=lambda p: p["estimated_rows"], reverse=True)
+
+
+def plan_cleanup_function(**context):
+    """Plans the cleanup of each table as partitions of the table's dag_ids.
+
+    Returns the op_kwargs of the mapped cleanup tasks of all tables, ordered
+    from the biggest partition to the smallest.
+    """
+    session = settings.Session()
+    try:
+        models = [db_object["airflow_db_model"] for db_object in DATABASE_OBJECTS]
+        table_names = {model.__name__: model.__tablename__ for model in models}
+        table_rows = estimate_table_rows(session, table_names.values())
+        plan = []
+        for db_object in DATABASE_OBJECTS:
+            airflow_db_model = db_object["airflow_db_model"]
+            model_name = airflow_db_model.__name__
+            rows = table_rows.get(table_names[model_name], 0)
+            partitions = [{"dag_ids": None, "estimated_rows": rows}]
+            if not db_object.get("do_not_delete_by_dag_id"):
+                try:
+                    query = session.query(airflow_db_model.dag_id).distinct()
+                    dag_ids = [dag_id for (dag_id,) in query] + [None]
+                    common, other = estimate_dag_id_rows(
+                        session, table_names[model_name], rows
+                    )
+                    target_rows = max(
+                        PARTITION_TARGET_ROWS, rows // MAX_PARTITIONS_PER_TABLE + 1
+                    )
+                    partitions = partition_dag_ids(dag_ids, common, other, target_rows)
+                    if len(partitions) == 1:
+                        # A single partition cleans up the whole table
+                        partitions = [{"dag_ids": None, "estimated_rows": rows}]
+                except ProgrammingError as e:
+                    logging.error(e)
+                    session.rollback()
+            logging.info(
+                "%s: ~%s row(s) in %s partition(s)", model_name, rows, len(partitions)
+            )
+            plan += [dict(partition, model_name=model_name) for partition in partitions]
+        return sorted(plan, key=lambda p: p["estimated_rows"], reverse=True)
+    finally:
+        session.close()
+
+
+def cleanup_function(model_name, dag_ids=None, estimated_rows=None, **context):
     session = settings.Session()
 
     logging.info("Retrieving max_execution_date from XCom")
@@ -383,12 +623,17 @@ def cleanup_function(**context):
     )
     max_date = dateutil.parser.parse(max_date)  # stored as iso8601 str in xcom
 
-    airflow_db_model = context["params"].get("airflow_db_model")
-    state = context["params"].get("state")
-    age_check_column = context["params"].get("age_check_column")
-    keep_last = context["params"].get("keep_last")
-    keep_last_filters = context["params"].get("keep_last_filters")
-    keep_last_group_by = context["params"].get("keep_last_group_by")
+    db_object = next(
+        db_object
+        for db_object in DATABASE_OBJECTS
+        if db_object["airflow_db_model"].__name__ == model_name
+    )
+    airflow_db_model = db_object.get("airflow_db_model")
+    state = db_object.get("state")
+    age_check_column = db_object.get("age_check_column")
+    keep_last = db_object.get("keep_last")
+    keep_last_filters = db_object.get("keep_last_filters")
+    keep_last_group_by = db_object.get("keep_last_group_by")
 
     logging.info("Configurations:")
     logging.info("max_date:                 " + str(max_date))
@@ -400,50 +645,33 @@ def cleanup_function(**context):
     logging.info("keep_last:                " + str(keep_last))
     logging.info("keep_last_filters:        " + str(keep_last_filters))
     logging.info("keep_last_group_by:       " + str(keep_last_group_by))
+    logging.info("estimated_rows:           " + str(estimated_rows))
 
     logging.info("")
 
     logging.info("Running Cleanup Process...")
 
     try:
-        if context["params"].get("do_not_delete_by_dag_id"):
-            query = build_query(
-                session,
-                airflow_db_model,
-                age_check_column,
-                max_date,
-                keep_last,
-                keep_last_filters,
-                keep_last_group_by,
-            )
-            if PRINT_DELETES:
-                print_query(query, airflow_db_model, age_check_column)
-            if ENABLE_DELETE:
-                logging.info("Performing Delete...")
-                query.delete(synchronize_session=False)
-            session.commit()
-        else:
-            dags = session.query(airflow_db_model.dag_id).distinct()
-            session.commit()
-
-            list_dags = [str(list(dag)[0]) for dag in dags] + [None]
-            for dag in list_dags:
-                query = build_query(
-                    session,
-                    airflow_db_model,
-                    age_check_column,
-                    max_date,
-                    keep_last,
-                    keep_last_filters,
-                    keep_last_group_by,
+        query = build_query(
+            session,
+            airflow_db_model,
+            age_check_column,
+            max_date,
+            keep_last,
+            keep_last_filters,
+            keep_last_group_by,
+        )
+        if dag_ids is not None:
+            # Clean up the partition of dag_ids with a single query
+            dag_id_filters = [
+                airflow_db_model.dag_id.in_(
+                    [dag_id for dag_id in dag_ids if dag_id is not None]
                 )
-                query = query.filter(airflow_db_model.dag_id == dag)
-                if PRINT_DELETES:
-                    print_query(query, airflow_db_model, age_check_column)
-                if ENABLE_DELETE:
-                    logging.info("Performing Delete...")
-                    query.delete(synchronize_session=False)
-                session.commit()
+            ]
+            if None in dag_ids:
+                dag_id_filters.append(airflow_db_model.dag_id.is_(None))
+            query = query.filter(or_(*dag_id_filters))
+        delete_query(session, query, airflow_db_model, age_check_column)
 
         if not ENABLE_DELETE:
             logging.warn(
@@ -500,16 +728,24 @@ cleanup_session_op = PythonOperator(
 
 cleanup_session_op.set_downstream(analyze_op)
 
-for db_object in DATABASE_OBJECTS:
-    cleanup_op = PythonOperator(
-        task_id="cleanup_" + str(db_object["airflow_db_model"].__name__),
-        python_callable=cleanup_function,
-        params=db_object,
-        provide_context=True,
-        dag=dag,
-    )
+plan_cleanup_op = PythonOperator(
+    task_id="plan_cleanup",
+    python_callable=plan_cleanup_function,
+    provide_context=True,
+    dag=dag,
+)
+
+print_configuration.set_downstream(plan_cleanup_op)
+
+# One task mapped over the partitions of all tables. Mapped tasks are queued
+# in the order of the plan, so the biggest partitions are cleaned up first.
+cleanup_op = PythonOperator.partial(
+    task_id="cleanup_tables",
+    python_callable=cleanup_function,
+    dag=dag,
+).expand(op_kwargs=plan_cleanup_op.output)
 
-    print_configuration.set_downstream(cleanup_op)
-    cleanup_op.set_downstream(analyze_op)
+plan_cleanup_op.set_downstream(cleanup_op)
+cleanup_op.set_downstream(analyze_op)
 
 # [END composer_metadb_cleanup]
@@ -14,6 +14,9 @@
 
 
 import internal_unit_testing
+import pytest
+from sqlalchemy import Column, create_engine, Integer, String
+from sqlalchemy.orm import declarative_base, sessionmaker
 
 
 def test_dag_import(airflow_database):
@@ -26,3 +29,108 @@ def test_dag_import(airflow_database):
     from . import airflow_db_cleanup as module
 
     internal_unit_testing.assert_has_valid_dag(module)
+
+
+Base = declarative_base()
+
+
+class TaskEntry(Base):
+    """An Airflow-like table with a composite primary key."""
+
+    __tablename__ = "task_entry"
+
+    dag_id = Column(String, primary_key=True)
+    task_id = Column(String, primary_key=True)
+    age = Column(Integer)
+
+
+@pytest.fixture
+def module(airflow_database, monkeypatch):
+    from . import airflow_db_cleanup as module
+
+    monkeypatch.setattr(module, "DELETE_CHUNK_SIZE", 3)
+    monkeypatch.setattr(module, "MAX_DELETES_PER_SECOND", 0)
+    return module
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    # Every other entry of each dag_id is old enough to be deleted
+    session.add_all(
+        TaskEntry(dag_id=dag_id, task_id=f"task_{i:02}", age=i % 2)
+        for dag_id in ["a", "b", "c"]
+        for i in range(10)
+    )
+    session.commit()
+    yield session
+    session.close()
+
+
+def old_entries(session):
+    return session.query(TaskEntry).filter(TaskEntry.age == 1)
+
+
+def remaining_keys(session):
+    return sorted(session.query(TaskEntry.dag_id, TaskEntry.task_id))
+
+
+def test_key_range_filters(module, session):
+    primary_key = [TaskEntry.dag_id, TaskEntry.task_id]
+    filters = module._key_range_filters(primary_key, ("a", "task_08"), ("b", "task_01"))
+
+    keys = session.query(*primary_key).filter(*filters).order_by(*primary_key)
+    assert keys.all() == [("a", "task_09"), ("b", "task_00"), ("b", "task_01")]
+
+
+def test_count_query(module, session):
+    assert module.count_query(old_entries(session).order_by(TaskEntry.task_id)) == 15
+
+
+def test_delete_in_chunks(module, session):
+    expected = [
+        (dag_id, f"task_{i:02}") for dag_id in ["a", "b", "c"] for i in range(0, 10, 2)
+    ]
+
+    deleted = module.delete_in_chunks(session, old_entries(session), TaskEntry)
+
+    assert deleted == 15
+    # The entries between the deleted ones in each chunk's key range remain
+    assert remaining_keys(session) == expected
+
+
+def test_delete_query_dry_run(module, session, monkeypatch):
+    monkeypatch.setattr(module, "ENABLE_DELETE", False)
+    counts = []
+    original_count_query = module.count_query
+
+    def count_query(query):
+        counts.append(original_count_query(query))
+        return counts[-1]
+
+    monkeypatch.setattr(module, "count_query", count_query)
+    expected = remaining_keys(session)
+
+    module.delete_query(session, old_entries(session), TaskEntry, TaskEntry.age)
+
+    assert counts == [15]
+    assert remaining_keys(session) == expected
+
+
+def test_partition_dag_ids(module):
+    estimates = {"big": 900, "medium": 400, "small": 100}
+
+    partitions = module.partition_dag_ids(
+        ["small", "other", "big", "medium", None],
+        estimates,
+        default_estimate=50,
+        target_rows=500,
+    )
+
+    assert partitions == [
+        {"dag_ids": ["big"], "estimated_rows": 900},
+        {"dag_ids": ["medium", "small"], "estimated_rows": 500},
+        {"dag_ids": ["other", None], "estimated_rows": 100},
+    ]
@@ -20,15 +20,20 @@ from __future__ import annotations
 import argparse
 import ast
 from collections import defaultdict
+from concurrent import futures
 from dataclasses import dataclass
 from dataclasses import field
+import functools
 import glob
+import hashlib
+import json
 import os
 from pathlib import Path
 import re
-import subprocess
+import sys
 import warnings
 
+import black
 import isort
 
 INGREDIENTS_START = re.compile(r"\s*#\s*<INGREDIENT ([\w\d_-]+)>")
@@ -50,6 +55,19 @@ DEFAULT_OUTPUT_PATH = Path("snippets")
 INGREDIENTS_PATH = Path("ingredients")
 RECIPES_PATH = Path("recipes")
 
+# The manifest in the output directory records the hashes of the inputs and
+# the output of every rendered recipe, to skip the recipes that are up to date.
+MANIFEST_FILE = ".sgs_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+# Changes to this script invalidate all the rendered recipes.
+GENERATOR_DIGEST = _digest(Path(__file__).read_text())
+
 
 @dataclass
 class ImportItem:
@@ -78,6 +96,7 @@ class Ingredient:
     imports_from: list[tuple[str, ImportItem]] = field(default_factory=list)
     text: str = ""
     name: str = ""
+    digest: str = ""
 
     def __repr__(self):
         return f"<Ingredient: {self.name}>"
@@ -92,6 +111,7 @@ IGNORED_OUTPUT_FILES = (
     re.compile(r".*?/tests/.*"),
     re.compile(r".*?/__pycache__/.*"),
     re.compile(r".*?sponge_log.xml.*"),
+    re.compile(rf".*{re.escape(MANIFEST_FILE)}$"),
 )
 
 
@@ -144,6 +164,7 @@ def load_ingredient(path: Path) -> Ingredient:
         text="".join(ingredient_lines),
         simple_imports=simple_imports,
         imports_from=imports_from,
+        digest=_digest(file_content),
     )
 
 
@@ -175,20 +196,51 @@ def load_recipes(path: Path) -> dict:
     return recipes
 
 
+def recipe_ingredients(recipe: str) -> list[str]:
+    """
+    Returns the names of the ingredients used by the recipe.
+    """
+    names = []
+    for line in recipe.splitlines():
+        match = INGREDIENT_FILL.match(line)
+        if match:
+            names.append(match.group(1))
+    return names
+
+
+def recipe_inputs(recipe: str, ingredients: dict) -> dict:
+    """
+    Returns the hashes of everything the rendered recipe depends on.
+    """
+    return {
+        "generator": GENERATOR_DIGEST,
+        "recipe": _digest(recipe),
+        "ingredients": {
+            name: ingredients[name].digest
+            for name in sorted(set(recipe_ingredients(recipe)))
+        },
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def sort_imports(import_lines: frozenset[str]) -> str:
+    """
+    Sorts the import lines. The results are cached, since many recipes
+    share the same imports.
+    """
+    return isort.code(
+        "\n".join(sorted(import_lines)), config=isort.Config(profile="google")
+    )
+
+
 def render_recipe(recipe: str, ingredients: dict) -> str:
     """
     Replace all `# IMPORTS` and `# INGREDIENT <name>` occurrences in
     the provided recipe, producing a script ready to be saved to a file.
     """
-    ingredients_used = []
+    ingredients_used = [ingredients[name] for name in recipe_ingredients(recipe)]
     file_lines = recipe.splitlines()
 
-    # Scan the file to used ingredients
-    for line in file_lines:
-        match = INGREDIENT_FILL.match(line)
-        if match:
-            ingredients_used.append(ingredients[match.group(1)])
-
     simple_imports_used = set()
     for ingredient in ingredients_used:
         for simple_import in ingredient.simple_imports:
@@ -217,9 +269,7 @@ def render_recipe(recipe: str, ingredients: dict) -> str:
         names = ", ".join(names)
         import_lines.add(f"from {module} import {names}")
 
-    import_lines = isort.code(
-        "\n".join(import_lines), config=isort.Config(profile="google")
-    )
+    import_lines = sort_imports(frozenset(import_lines))
 
     output_file = []
     header_added = False
@@ -264,15 +314,67 @@ def save_rendered_recipe(
     output_path = output_dir / recipe_path.relative_to(recipes_path)
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
+    try:
+        rendered_recipe = black.format_str(rendered_recipe, mode=black.Mode())
+    except black.InvalidInput:
+        # Saves the recipe as it is, so that the error is easy to find.
+        pass
+
+    # Leaves the file untouched if nothing changed.
+    if output_path.is_file() and output_path.read_text() == rendered_recipe:
+        return output_path
     with output_path.open(mode="w") as out_file:
         out_file.write(rendered_recipe)
+    return output_path
+
 
-    subprocess.run(
-        ["black", str(output_path)],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
+def _render_and_save(
+    recipe_path: Path,
+    recipe: str,
+    ingredients: dict,
+    output_dir: Path,
+    recipes_path: Path,
+) -> tuple[Path, str]:
+    rendered = render_recipe(recipe, ingredients)
+    out = save_rendered_recipe(
+        recipe_path, rendered, output_dir=output_dir, recipes_path=recipes_path
+    )
+    return out, _digest(out.read_text())
+
+
+def load_manifest(output_dir: Path) -> dict:
+    """
+    Loads the manifest of the output directory, or returns an empty
+    manifest if it doesn't exist or was written by another version.
+    """
+    try:
+        with (output_dir / MANIFEST_FILE).open() as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("recipes", {})
+
+
+def save_manifest(output_dir: Path, entries: dict):
+    manifest = {"version": MANIFEST_VERSION, "recipes": dict(sorted(entries.items()))}
+    with (output_dir / MANIFEST_FILE).open(mode="w") as file:
+        json.dump(manifest, file, indent=2)
+        file.write("\n")
+
+
+def is_up_to_date(entry: dict | None, inputs: dict, output_path: Path) -> bool:
+    """
+    Checks that the output was rendered from the same inputs and wasn't
+    modified since.
+    """
+    return (
+        entry is not None
+        and entry["inputs"] == inputs
+        and output_path.is_file()
+        and _digest(output_path.read_text()) == entry["output"]
     )
-    return output_path
 
 
 def generate(
@@ -282,21 +384,53 @@ def generate(
 ):
     ingredients = load_ingredients(ingredients_path)
     recipes = load_recipes(recipes_path)
+    output_dir = Path(args.output_dir)
+    manifest = {} if getattr(args, "force", False) else load_manifest(output_dir)
 
     updated_paths = set()
+    rendered_paths = set()
+    entries = {}
+    to_render = {}
 
     for path, recipe in recipes.items():
-        rendered = render_recipe(recipe, ingredients)
-        out = save_rendered_recipe(
-            path.absolute(),
-            rendered,
-            recipes_path=recipes_path.absolute(),
-            output_dir=Path(args.output_dir),
-        )
-        updated_paths.add(str(out))
+        key = str(path.relative_to(recipes_path.absolute()))
+        inputs = recipe_inputs(recipe, ingredients)
+        if is_up_to_date(manifest.get(key), inputs, output_dir / key):
+            entries[key] = manifest[key]
+            updated_paths.add(str(output_dir / key))
+        else:
+            to_render[key] = (path, recipe, inputs)
+
+    # Rendering is dominated by formatting with black, so the recipes are
+    # rendered in parallel processes. Each process gets only the ingredients it needs.
+    with futures.ProcessPoolExecutor(getattr(args, "jobs", None)) as executor:
+        rendering = {
+            executor.submit(
+                _render_and_save,
+                path.absolute(),
+                recipe,
+                {name: ingredients[name] for name in inputs["ingredients"]},
+                output_dir,
+                recipes_path.absolute(),
+            ): (key, inputs)
+            for key, (path, recipe, inputs) in to_render.items()
+        }
+        for future in futures.as_completed(rendering):
+            key, inputs = rendering[future]
+            out, output_digest = future.result()
+            entries[key] = {"inputs": inputs, "output": output_digest}
+            updated_paths.add(str(out))
+            rendered_paths.add(str(out))
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    save_manifest(output_dir, entries)
 
+    print(
+        f"Rendered {len(rendered_paths)} of {len(recipes)} recipes, "
+        f"{len(recipes) - len(rendered_paths)} were up to date."
+    )
     print("Generated files:")
-    for file in sorted(updated_paths):
+    for file in sorted(rendered_paths):
         print(f" - {repr(file)}")
 
     all_files = glob.glob(f"{args.output_dir}/**", recursive=True)
@@ -318,9 +452,44 @@ def generate(
             print(f" - {repr(file)}")
 
 
-def verify(args: argparse.Namespace):
-    # TODO: Needs to check if the files are up to date. Will be used to auto-check every commit.
-    pass
+def verify(
+    args: argparse.Namespace,
+    ingredients_path: Path = INGREDIENTS_PATH,
+    recipes_path: Path = RECIPES_PATH,
+) -> bool:
+    """
+    Checks that the generated files match the recipes and ingredients,
+    using the manifest instead of rendering the recipes again.
+    """
+    ingredients = load_ingredients(ingredients_path)
+    recipes = load_recipes(recipes_path)
+    output_dir = Path(args.output_dir)
+    manifest = load_manifest(output_dir)
+
+    problems = []
+    keys = set()
+    for path, recipe in sorted(recipes.items()):
+        key = str(path.relative_to(recipes_path.absolute()))
+        keys.add(key)
+        output_path = output_dir / key
+        entry = manifest.get(key)
+        if entry is None:
+            problems.append(f"{output_path} was not generated.")
+        elif entry["inputs"] != recipe_inputs(recipe, ingredients):
+            problems.append(f"{output_path} is outdated.")
+        elif not is_up_to_date(entry, entry["inputs"], output_path):
+            problems.append(f"{output_path} was modified or removed.")
+    for key in sorted(manifest.keys() - keys):
+        problems.append(f"{output_dir / key} has no recipe.")
+
+    if problems:
+        print("The generated files don't match the sources:")
+        for problem in problems:
+            print(f" - {problem}")
+        print("Run `python sgs.py generate` to update them.")
+        return False
+    print(f"All {len(recipes)} generated files are up to date.")
+    return True
 
 
 def parse_arguments():
@@ -332,18 +501,31 @@ def parse_arguments():
     gen_parser = subparsers.add_parser("generate", help="Generates the code samples.")
     gen_parser.set_defaults(func=generate)
     gen_parser.add_argument("--output_dir", default=DEFAULT_OUTPUT_PATH)
+    gen_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of processes rendering the recipes, defaults to the number of CPUs.",
+    )
+    gen_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Renders all the recipes, even the ones that are up to date.",
+    )
 
     verify_parser = subparsers.add_parser(
         "verify", help="Verify if the generated samples match the sources."
     )
     verify_parser.set_defaults(func=verify)
+    verify_parser.add_argument("--output_dir", default=DEFAULT_OUTPUT_PATH)
 
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
-    args.func(args)
+    if args.func(args) is False:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
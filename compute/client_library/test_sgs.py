@@ -34,6 +34,29 @@ def test_sgs_generate():
             assert test_file.read_bytes() == match_file.read_bytes()
 
 
+def test_sgs_generate_incremental(capsys):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        args = Namespace(output_dir=tmp_dir)
+        sgs.generate(args, FIXTURE_INGREDIENTS.absolute(), FIXTURE_RECIPES.absolute())
+        assert sgs.verify(
+            args, FIXTURE_INGREDIENTS.absolute(), FIXTURE_RECIPES.absolute()
+        )
+
+        output = Path(tmp_dir) / "experimental_recipe.pytest"
+        output.write_text(output.read_text() + "# Modified\n")
+        assert not sgs.verify(
+            args, FIXTURE_INGREDIENTS.absolute(), FIXTURE_RECIPES.absolute()
+        )
+
+        capsys.readouterr()
+        sgs.generate(args, FIXTURE_INGREDIENTS.absolute(), FIXTURE_RECIPES.absolute())
+        assert "Rendered 1 of 1 recipes" in capsys.readouterr().out
+        assert output.read_bytes() == (FIXTURE_OUTPUT / output.name).read_bytes()
+
+        sgs.generate(args, FIXTURE_INGREDIENTS.absolute(), FIXTURE_RECIPES.absolute())
+        assert "Rendered 0 of 1 recipes" in capsys.readouterr().out
+
+
 def test_snippets_freshness():
     """
     Make sure that the snippets/ folder is up-to-date and matches
@@ -0,0 +1,347 @@
+# Copyright 2023 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stores and retrieves many DICOM instances using the DICOMweb standard.
+
+Unlike the samples in dicomweb.py, all requests share one pooled session
+and access token, instances are uploaded straight from disk, and retrieved
+studies are written to disk part by part as they are downloaded.
+
+Example usage:
+    python dicomweb_bulk.py --project_id my-project --dataset_id my-dataset \\
+        --dicom_store_id my-dicom-store store path/to/dcm/files
+    python dicomweb_bulk.py --project_id my-project --dataset_id my-dataset \\
+        --dicom_store_id my-dicom-store retrieve-study 1.2.3 path/to/output
+"""
+
+import argparse
+from concurrent import futures
+import os
+import random
+import re
+import time
+
+import requests
+
+BASE_URL = "https://healthcare.googleapis.com/v1"
+# Status codes of the requests that are safe to retry
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# Size of the chunks the retrieved studies are read in
+CHUNK_SIZE = 1024 * 1024
+
+
+class DicomWebClient:
+    """A client for the DICOMweb API of a DICOM store that is safe to use
+    from many threads at once."""
+
+    def __init__(
+        self,
+        project_id,
+        location,
+        dataset_id,
+        dicom_store_id,
+        max_connections=32,
+        max_attempts=5,
+        base_url=BASE_URL,
+        session=None,
+    ):
+        if session is None:
+            # Imports the google.auth.transport.requests transport
+            from google.auth.transport import requests as auth_requests
+
+            # Imports a module to allow authentication using Application Default Credentials (ADC)
+            import google.auth
+
+            credentials, _ = google.auth.default()
+            scoped_credentials = credentials.with_scopes(
+                ["https://www.googleapis.com/auth/cloud-platform"]
+            )
+            # The session refreshes the token when it expires, so all
+            # requests share one token.
+            session = auth_requests.AuthorizedSession(scoped_credentials)
+
+        # Keeps a connection per concurrent request open for reuse.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_connections
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.session = session
+        self.max_attempts = max_attempts
+        self.dicomweb_path = (
+            "{}/projects/{}/locations/{}/datasets/{}/dicomStores/{}/dicomWeb".format(
+                base_url, project_id, location, dataset_id, dicom_store_id
+            )
+        )
+
+    def _request(self, method, url, body_path=None, **kwargs):
+        """Sends the request, retrying it with exponential backoff on
+        connection errors and retryable status codes.
+
+        If body_path is set, the file is streamed as the request body."""
+        for attempt in range(self.max_attempts):
+            try:
+                if body_path is None:
+                    response = self.session.request(method, url, **kwargs)
+                else:
+                    with open(body_path, "rb") as body:
+                        response = self.session.request(
+                            method, url, data=body, **kwargs
+                        )
+            except requests.ConnectionError:
+                if attempt == self.max_attempts - 1:
+                    raise
+            else:
+                if (
+                    response.status_code not in RETRYABLE_STATUS_CODES
+                    or attempt == self.max_attempts - 1
+                ):
+                    return response
+                response.close()
+            time.sleep(min(2**attempt, 32) * random.uniform(0.5, 1.5))
+
+    def store_instance(self, dcm_file):
+        """Stores the DICOM instance in the file.
+
+        Returns True if the instance was stored, or False if the store
+        already has it."""
+        response = self._request(
+            "POST",
+            f"{self.dicomweb_path}/studies",
+            body_path=dcm_file,
+            headers={"Content-Type": "application/dicom"},
+        )
+        if response.status_code == 409:
+            return False
+        response.raise_for_status()
+        return True
+
+    def store_instances(self, dcm_files, max_in_flight=32):
+        """Stores the DICOM instances in the files concurrently.
+
+        At most max_in_flight files are being uploaded at once, so any
+        number of files can be passed as an iterable.
+
+        Yields (dcm_file, result) tuples in completion order, where the
+        result is the return value of store_instance or the raised
+        exception."""
+        dcm_files = iter(dcm_files)
+        with futures.ThreadPoolExecutor(max_in_flight) as executor:
+            in_flight = {}
+            while True:
+                for dcm_file in dcm_files:
+                    future = executor.submit(self.store_instance, dcm_file)
+                    in_flight[future] = dcm_file
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    return
+                done, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    dcm_file = in_flight.pop(future)
+                    yield dcm_file, future.exception() or future.result()
+
+    def retrieve_study(self, study_uid, output_dir):
+        """Retrieves the DICOM instances of the study into output_dir.
+
+        The multipart response is written to disk part by part while it is
+        downloaded, so the study doesn't have to fit in memory.
+
+        Returns the paths of the retrieved instances."""
+        response = self._request(
+            "GET",
+            f"{self.dicomweb_path}/studies/{study_uid}",
+            headers={
+                "Accept": 'multipart/related; type="application/dicom"; '
+                "transfer-syntax=*"
+            },
+            stream=True,
+        )
+        with response:
+            response.raise_for_status()
+            boundary = multipart_boundary(response.headers["Content-Type"])
+            os.makedirs(output_dir, exist_ok=True)
+            paths = []
+
+            def open_part(headers):
+                paths.append(os.path.join(output_dir, f"{len(paths):06}.dcm"))
+                return open(paths[-1], "wb")
+
+            split_multipart(
+                response.iter_content(chunk_size=CHUNK_SIZE), boundary, open_part
+            )
+        return paths
+
+
+def multipart_boundary(content_type):
+    """Returns the boundary of a multipart Content-Type header."""
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise ValueError(f"No boundary in Content-Type: {content_type}")
+    return match.group(1).encode()
+
+
+def split_multipart(chunks, boundary, open_part):
+    """Writes each part of a multipart body to its own file.
+
+    Args:
+        chunks: An iterable of the body's bytes, in chunks of any size.
+        boundary: The multipart boundary as bytes.
+        open_part: A function that is called with the headers of each part
+            as a dict and returns a binary file to write the part's body to.
+            The file is closed after the part is written.
+
+    Only the bytes that could belong to a delimiter are buffered between
+    chunks."""
+    delimiter = b"\r\n--" + boundary
+    # The first delimiter isn't preceded by a line break.
+    buffer = bytearray(b"\r\n")
+    part = None
+    state = "preamble"
+    try:
+        for chunk in chunks:
+            buffer += chunk
+            while True:
+                if state in ("preamble", "body"):
+                    index = buffer.find(delimiter)
+                    if index < 0:
+                        keep = len(delimiter) - 1
+                        if part and len(buffer) > keep:
+                            part.write(buffer[:-keep])
+                        del buffer[:-keep]
+                        break
+                    if part:
+                        part.write(buffer[:index])
+                        part.close()
+                        part = None
+                    del buffer[: index + len(delimiter)]
+                    state = "delimiter"
+                elif state == "delimiter":
+                    if len(buffer) < 2:
+                        break
+                    if buffer[:2] == b"--":
+                        return
+                    state = "headers"
+                else:
+                    index = buffer.find(b"\r\n\r\n")
+                    if index < 0:
+                        break
+                    headers = {}
+                    for line in bytes(buffer[2:index]).decode("latin-1").split("\r\n"):
+                        if line:
+                            name, _, value = line.partition(":")
+                            headers[name.strip().lower()] = value.strip()
+                    del buffer[: index + 4]
+                    part = open_part(headers)
+                    state = "body"
+        raise ValueError("The multipart body ended before its closing delimiter.")
+    finally:
+        if part:
+            part.close()
+
+
+def _find_dcm_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.endswith(".dcm"):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def store(client, paths, max_in_flight):
+    """Stores the .dcm files in the paths and prints the progress."""
+    started = time.monotonic()
+    stored = existing = failed = stored_bytes = 0
+    for dcm_file, result in client.store_instances(
+        _find_dcm_files(paths), max_in_flight
+    ):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"Failed to store {dcm_file}: {result}")
+        elif result:
+            stored += 1
+            stored_bytes += os.path.getsize(dcm_file)
+        else:
+            existing += 1
+    elapsed = time.monotonic() - started
+    print(
+        f"Stored {stored} instances ({stored_bytes} bytes) in {elapsed:.1f}s, "
+        f"{stored / elapsed:.1f} instances/s, {existing} already stored, "
+        f"{failed} failed"
+    )
+
+
+def parse_command_line_args():
+    """Parses command line arguments."""
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    parser.add_argument(
+        "--project_id",
+        default=(os.environ.get("GOOGLE_CLOUD_PROJECT")),
+        help="GCP project name",
+    )
+
+    parser.add_argument("--location", default="us-central1", help="GCP location")
+
+    parser.add_argument("--dataset_id", default=None, help="Name of dataset")
+
+    parser.add_argument("--dicom_store_id", default=None, help="Name of DICOM store")
+
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=32,
+        help="Max number of concurrent requests.",
+    )
+
+    command = parser.add_subparsers(dest="command", required=True)
+
+    store_parser = command.add_parser("store", help=store.__doc__)
+    store_parser.add_argument(
+        "paths", nargs="+", help=".dcm files or directories to store."
+    )
+
+    retrieve_parser = command.add_parser(
+        "retrieve-study", help=DicomWebClient.retrieve_study.__doc__
+    )
+    retrieve_parser.add_argument("study_uid", help="Unique identifier for a study.")
+    retrieve_parser.add_argument("output_dir", help="Directory to save instances to.")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    client = DicomWebClient(
+        args.project_id,
+        args.location,
+        args.dataset_id,
+        args.dicom_store_id,
+        max_connections=args.max_in_flight,
+    )
+    if args.command == "store":
+        store(client, args.paths, args.max_in_flight)
+    else:
+        paths = client.retrieve_study(args.study_uid, args.output_dir)
+        print(f"Retrieved {len(paths)} instances to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
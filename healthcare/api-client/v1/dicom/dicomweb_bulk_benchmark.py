@@ -0,0 +1,152 @@
+# Copyright 2023 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the throughput of dicomweb_bulk against a local fake DICOMweb
+server.
+
+Example usage:
+    python dicomweb_bulk_benchmark.py --instances 500 --instance_bytes 500000 \\
+        --latency 0.05 --max_in_flight 1 8 32
+"""
+
+import argparse
+from http import server
+import os
+import random
+import tempfile
+import threading
+import time
+
+import requests
+
+import dicomweb_bulk
+
+BOUNDARY = "benchmark-boundary"
+
+
+class FakeDicomWebHandler(server.BaseHTTPRequestHandler):
+    """Accepts stored instances and returns studies of random instances."""
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    error_rate = 0.0
+    study_instances = 0
+    instance_bytes = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b"", content_type="application/dicom+json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        remaining = int(self.headers["Content-Length"])
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 65536)))
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self._reply(503)
+        else:
+            self._reply(200, b"{}")
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        instance = os.urandom(self.instance_bytes)
+        part = (
+            f"--{BOUNDARY}\r\nContent-Type: application/dicom\r\n\r\n".encode()
+            + instance
+            + b"\r\n"
+        )
+        closing = f"--{BOUNDARY}--\r\n".encode()
+        self.send_response(200)
+        self.send_header(
+            "Content-Type",
+            f'multipart/related; type="application/dicom"; boundary={BOUNDARY}',
+        )
+        self.send_header(
+            "Content-Length", str(len(part) * self.study_instances + len(closing))
+        )
+        self.end_headers()
+        for _ in range(self.study_instances):
+            self.wfile.write(part)
+        self.wfile.write(closing)
+
+
+def run(args):
+    FakeDicomWebHandler.latency = args.latency
+    FakeDicomWebHandler.error_rate = args.error_rate
+    FakeDicomWebHandler.study_instances = args.instances
+    FakeDicomWebHandler.instance_bytes = args.instance_bytes
+    httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), FakeDicomWebHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{httpd.server_port}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dcm_files = []
+        for i in range(args.instances):
+            dcm_files.append(os.path.join(tmp, f"{i:06}.dcm"))
+            with open(dcm_files[-1], "wb") as f:
+                f.write(os.urandom(args.instance_bytes))
+        total_bytes = args.instances * args.instance_bytes
+
+        for max_in_flight in args.max_in_flight:
+            client = dicomweb_bulk.DicomWebClient(
+                "project",
+                "location",
+                "dataset",
+                "store",
+                max_connections=max_in_flight,
+                base_url=base_url,
+                session=requests.Session(),
+            )
+            started = time.monotonic()
+            failed = sum(
+                isinstance(result, Exception)
+                for _, result in client.store_instances(dcm_files, max_in_flight)
+            )
+            elapsed = time.monotonic() - started
+            print(
+                f"store max_in_flight={max_in_flight}: {args.instances} instances "
+                f"in {elapsed:.2f}s, {args.instances / elapsed:.1f} instances/s, "
+                f"{total_bytes / elapsed / 1e6:.1f} MB/s, {failed} failed"
+            )
+
+        started = time.monotonic()
+        paths = client.retrieve_study("1.2.3", os.path.join(tmp, "study"))
+        elapsed = time.monotonic() - started
+        print(
+            f"retrieve: {len(paths)} instances in {elapsed:.2f}s, "
+            f"{total_bytes / elapsed / 1e6:.1f} MB/s"
+        )
+    httpd.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--instances", type=int, default=500)
+    parser.add_argument("--instance_bytes", type=int, default=500000)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Server latency in seconds."
+    )
+    parser.add_argument(
+        "--error_rate", type=float, default=0.0, help="Share of 503 responses."
+    )
+    parser.add_argument("--max_in_flight", type=int, nargs="+", default=[1, 8, 32])
+    run(parser.parse_args())
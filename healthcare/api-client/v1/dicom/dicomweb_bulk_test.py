@@ -0,0 +1,88 @@
+# Copyright 2023 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from http import server
+import io
+import os
+import threading
+
+import pytest
+import requests
+
+import dicomweb_bulk
+from dicomweb_bulk_benchmark import FakeDicomWebHandler
+
+RESOURCES = os.path.join(os.path.dirname(__file__), "resources")
+dcm_file = os.path.join(RESOURCES, "dicom_00000001_000.dcm")
+
+
+class Part(io.BytesIO):
+    def __init__(self, parts):
+        super().__init__()
+        self._parts = parts
+
+    def close(self):
+        self._parts.append(self.getvalue())
+        super().close()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 4096])
+def test_split_multipart(chunk_size):
+    bodies = [b"a" * 100, b"", b"\r\n--OTHER\r\n"]
+    body = (
+        b"preamble\r\n"
+        + b"".join(
+            b"--BOUNDARY\r\nContent-Type: application/dicom\r\n\r\n" + b + b"\r\n"
+            for b in bodies
+        )
+        + b"--BOUNDARY--\r\n"
+    )
+    chunks = (body[i : i + chunk_size] for i in range(0, len(body), chunk_size))
+    parts = []
+
+    dicomweb_bulk.split_multipart(chunks, b"BOUNDARY", lambda _: Part(parts))
+
+    assert parts == bodies
+
+
+@pytest.fixture
+def client():
+    FakeDicomWebHandler.study_instances = 3
+    FakeDicomWebHandler.instance_bytes = 1000
+    httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), FakeDicomWebHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    yield dicomweb_bulk.DicomWebClient(
+        "project",
+        "location",
+        "dataset",
+        "store",
+        base_url=f"http://127.0.0.1:{httpd.server_port}",
+        session=requests.Session(),
+    )
+
+    httpd.shutdown()
+
+
+def test_store_instances(client):
+    results = list(client.store_instances([dcm_file] * 10, max_in_flight=4))
+
+    assert results == [(dcm_file, True)] * 10
+
+
+def test_retrieve_study(client, tmp_path):
+    paths = client.retrieve_study("1.2.3", str(tmp_path))
+
+    assert len(paths) == 3
+    assert all(os.path.getsize(path) == 1000 for path in paths)
@@ -0,0 +1,323 @@
+# Copyright 2023 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Writes FHIR resources in batch Bundles.
+
+Unlike the samples in fhir_resources.py, which send a request per resource,
+FhirWriteBuffer collects creates, updates and patches into Bundles. A Bundle
+is sent when it is full or when its oldest write has waited long enough, and
+several Bundles are sent at once. Each write returns a future of the result
+of its own Bundle entry.
+
+Example usage:
+    python fhir_batch.py --project_id my-project --dataset_id my-dataset \\
+        --fhir_store_id my-fhir-store resources.ndjson
+"""
+
+import argparse
+import base64
+from concurrent import futures
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import requests
+
+import fhir_search
+
+# Status codes of the Bundles that weren't processed and are safe to retry
+RETRYABLE_STATUS_CODES = (429, 503)
+
+
+class FhirEntryError(Exception):
+    """A Bundle entry failed."""
+
+    def __init__(self, status: str, outcome: Optional[Dict[str, Any]] = None) -> None:
+        super().__init__(f"{status}: {json.dumps(outcome)}" if outcome else status)
+        self.status = status
+        self.outcome = outcome
+
+
+class FhirWriteBuffer:
+    """Collects FHIR writes into Bundles and sends them concurrently.
+
+    The buffer is safe to use from many threads. Use it as a context manager
+    or call close to send the remaining writes.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        store_url: str,
+        bundle_type: str = "batch",
+        max_entries: int = 100,
+        max_bytes: int = 5 * 1024 * 1024,
+        max_delay: float = 1.0,
+        max_in_flight: int = 4,
+        max_attempts: int = 5,
+    ) -> None:
+        """Creates an empty write buffer.
+
+        Args:
+          session: The authorized session.
+          store_url: The URL of the FHIR REST API of the FHIR store.
+          bundle_type: batch, or transaction to apply each Bundle atomically.
+          max_entries: The max number of entries per Bundle.
+          max_bytes: The max size of the entries of a Bundle.
+          max_delay: Time in seconds after which a Bundle is sent even if it's
+            not full.
+          max_in_flight: The max number of Bundles sent at once. Writes block
+            when that many Bundles are in flight and the next one is full.
+          max_attempts: The max number of attempts to send a Bundle.
+        """
+        self.session = session
+        self.store_url = store_url
+        self.bundle_type = bundle_type
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._executor = futures.ThreadPoolExecutor(max_in_flight)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._entries = []
+        self._futures = []
+        self._bytes = 0
+        self._oldest = None
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def __enter__(self) -> "FhirWriteBuffer":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def create(self, resource: Dict[str, Any]) -> futures.Future:
+        """Creates the resource. The future's result is the created resource."""
+        return self._add(
+            {
+                "resource": resource,
+                "request": {"method": "POST", "url": resource["resourceType"]},
+            }
+        )
+
+    def update(self, resource: Dict[str, Any]) -> futures.Future:
+        """Updates the resource. The future's result is the updated resource."""
+        return self._add(
+            {
+                "resource": resource,
+                "request": {
+                    "method": "PUT",
+                    "url": f"{resource['resourceType']}/{resource['id']}",
+                },
+            }
+        )
+
+    def patch(
+        self, resource_type: str, resource_id: str, patch: List[Dict[str, Any]]
+    ) -> futures.Future:
+        """Applies the JSON Patch to the resource. The future's result is the
+        patched resource."""
+        return self._add(
+            {
+                "resource": {
+                    "resourceType": "Binary",
+                    "contentType": "application/json-patch+json",
+                    "data": base64.b64encode(json.dumps(patch).encode()).decode(),
+                },
+                "request": {"method": "PATCH", "url": f"{resource_type}/{resource_id}"},
+            }
+        )
+
+    def _add(self, entry: Dict[str, Any]) -> futures.Future:
+        if self._closed.is_set():
+            raise RuntimeError("The write buffer is closed.")
+        future = futures.Future()
+        size = len(json.dumps(entry))
+        with self._lock:
+            if self._entries and self._bytes + size > self.max_bytes:
+                self._flush_locked()
+            self._entries.append(entry)
+            self._futures.append(future)
+            self._bytes += size
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._entries) >= self.max_entries:
+                self._flush_locked()
+        return future
+
+    def flush(self) -> None:
+        """Sends the buffered writes without waiting for the results."""
+        with self._lock:
+            if self._entries:
+                self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        entries, entry_futures = self._entries, self._futures
+        self._entries, self._futures, self._bytes, self._oldest = [], [], 0, None
+        self._in_flight.acquire()
+        self._executor.submit(self._send, entries, entry_futures)
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.max_delay / 4):
+            with self._lock:
+                if (
+                    self._oldest is not None
+                    and time.monotonic() - self._oldest >= self.max_delay
+                ):
+                    self._flush_locked()
+
+    def _post(self, bundle: Dict[str, Any]) -> requests.Response:
+        body = json.dumps(bundle)
+        for attempt in range(self.max_attempts):
+            response = self.session.post(
+                self.store_url,
+                headers={"Content-Type": "application/fhir+json;charset=utf-8"},
+                data=body,
+            )
+            if (
+                response.status_code not in RETRYABLE_STATUS_CODES
+                or attempt == self.max_attempts - 1
+            ):
+                return response
+            time.sleep(min(2**attempt, 32) * random.uniform(0.5, 1.5))
+
+    def _send(
+        self, entries: List[Dict[str, Any]], entry_futures: List[futures.Future]
+    ) -> None:
+        try:
+            response = self._post(
+                {"resourceType": "Bundle", "type": self.bundle_type, "entry": entries}
+            )
+            response.raise_for_status()
+            results = response.json()["entry"]
+            if len(results) != len(entries):
+                raise ValueError(
+                    f"Expected {len(entries)} entries in the response bundle, "
+                    f"got {len(results)}."
+                )
+            for future, result in zip(entry_futures, results):
+                status = result["response"]["status"]
+                if status.startswith("2"):
+                    future.set_result(result.get("resource", result["response"]))
+                else:
+                    future.set_exception(
+                        FhirEntryError(status, result["response"].get("outcome"))
+                    )
+        except Exception as e:
+            for future in entry_futures:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._in_flight.release()
+
+    def close(self) -> None:
+        """Sends the remaining writes and waits for all the results."""
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        self._executor.shutdown()
+
+
+def load_ndjson(
+    buffer: FhirWriteBuffer, path: str, update: bool = False
+) -> Dict[str, int]:
+    """Creates, or updates if update is set, the resources in the NDJSON file.
+
+    Returns the number of resources that were written and that failed.
+    """
+    counts = {"written": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def count(future: futures.Future) -> None:
+        with lock:
+            if future.exception():
+                counts["failed"] += 1
+                print(f"Failed to write resource: {future.exception()}")
+            else:
+                counts["written"] += 1
+
+    with buffer, open(path) as ndjson:
+        for line in ndjson:
+            if line.strip():
+                resource = json.loads(line)
+                future = buffer.update(resource) if update else buffer.create(resource)
+                future.add_done_callback(count)
+    return counts
+
+
+def parse_command_line_args():
+    """Parses command line arguments."""
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    parser.add_argument(
+        "--project_id",
+        default=(os.environ.get("GOOGLE_CLOUD_PROJECT")),
+        help="GCP project name",
+    )
+
+    parser.add_argument("--location", default="us-central1", help="GCP location")
+
+    parser.add_argument("--dataset_id", default=None, help="Name of dataset")
+
+    parser.add_argument("--fhir_store_id", default=None, help="Name of FHIR store")
+
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Updates the resources by ID instead of creating them",
+    )
+
+    parser.add_argument(
+        "--max_entries", type=int, default=100, help="Max entries per Bundle"
+    )
+
+    parser.add_argument(
+        "--max_in_flight", type=int, default=4, help="Max Bundles sent at once"
+    )
+
+    parser.add_argument("ndjson_file", help="NDJSON file with the resources to write")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    buffer = FhirWriteBuffer(
+        fhir_search.authorized_session(args.max_in_flight),
+        fhir_search.fhir_store_url(
+            args.project_id, args.location, args.dataset_id, args.fhir_store_id
+        ),
+        max_entries=args.max_entries,
+        max_in_flight=args.max_in_flight,
+    )
+    started = time.monotonic()
+    counts = load_ndjson(buffer, args.ndjson_file, args.update)
+    elapsed = time.monotonic() - started
+    print(
+        f"Wrote {counts['written']} resources in {elapsed:.1f}s "
+        f"({counts['written'] / elapsed:.1f} resources/s), {counts['failed']} failed"
+    )
+
+
+if __name__ == "__main__":
+    main()
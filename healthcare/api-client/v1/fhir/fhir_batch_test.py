@@ -0,0 +1,115 @@
+# Copyright 2023 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+
+import pytest
+
+import fhir_batch
+
+store_url = "https://healthcare.googleapis.com/v1/fhir"
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+    def json(self):
+        return self._body
+
+
+class FakeSession:
+    """Creates resources with sequential IDs and fails Observations."""
+
+    def __init__(self, statuses=()):
+        self.bundles = []
+        self._statuses = list(statuses)
+        self._lock = threading.Lock()
+
+    def post(self, url, headers, data):
+        bundle = json.loads(data)
+        with self._lock:
+            self.bundles.append(bundle)
+            if self._statuses:
+                return FakeResponse(self._statuses.pop(0), {})
+        entries = []
+        for entry in bundle["entry"]:
+            if entry["resource"]["resourceType"] == "Observation":
+                entries.append({"response": {"status": "400 Bad Request"}})
+            else:
+                resource = dict(entry["resource"], id=entry["resource"].get("id", "1"))
+                entries.append({"resource": resource, "response": {"status": "201"}})
+        return FakeResponse(200, {"entry": entries})
+
+
+def test_write_buffer_batches_writes():
+    session = FakeSession()
+
+    with fhir_batch.FhirWriteBuffer(session, store_url, max_entries=3) as buffer:
+        created = [buffer.create({"resourceType": "Patient"}) for _ in range(4)]
+        updated = buffer.update({"resourceType": "Patient", "id": "2"})
+        failed = buffer.create({"resourceType": "Observation"})
+
+    assert [len(bundle["entry"]) for bundle in session.bundles] == [3, 3]
+    assert all(future.result()["id"] == "1" for future in created)
+    assert updated.result()["id"] == "2"
+    assert session.bundles[1]["entry"][1]["request"] == {
+        "method": "PUT",
+        "url": "Patient/2",
+    }
+    with pytest.raises(fhir_batch.FhirEntryError):
+        failed.result()
+
+
+def test_write_buffer_flushes_after_delay():
+    session = FakeSession()
+
+    with fhir_batch.FhirWriteBuffer(session, store_url, max_delay=0.1) as buffer:
+        future = buffer.patch("Patient", "1", [{"op": "remove", "path": "/active"}])
+        assert future.result(timeout=5)["resourceType"] == "Binary"
+
+
+def test_write_buffer_retries_throttled_bundles(monkeypatch):
+    monkeypatch.setattr(fhir_batch.time, "sleep", lambda _: None)
+    session = FakeSession(statuses=[429, 500])
+
+    with fhir_batch.FhirWriteBuffer(session, store_url) as buffer:
+        first = buffer.create({"resourceType": "Patient"})
+        buffer.flush()
+        second = buffer.create({"resourceType": "Patient"})
+
+    with pytest.raises(RuntimeError):
+        first.result()
+    assert second.result()["id"] == "1"
+    assert len(session.bundles) == 3
+
+
+def test_write_buffer_fails_all_writes_on_short_response():
+    session = FakeSession()
+    session.post = lambda url, headers, data: FakeResponse(
+        200, {"entry": [{"response": {"status": "201"}}]}
+    )
+
+    with fhir_batch.FhirWriteBuffer(session, store_url) as buffer:
+        writes = [buffer.create({"resourceType": "Patient"}) for _ in range(2)]
+
+    for future in writes:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
@@ -0,0 +1,379 @@
+# Copyright 2023 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Searches a FHIR store across all pages of the results.
+
+Unlike the samples in fhir_resources.py, which return the first page of the
+results, the functions in this module follow the next links of the search
+Bundles. The next page is downloaded while the caller processes the current
+one, and each Bundle is parsed entry by entry as it is downloaded, so the
+memory use doesn't grow with the number of results.
+
+Example usage:
+    python fhir_search.py --project_id my-project --dataset_id my-dataset \\
+        --fhir_store_id my-fhir-store --resource_type Observation \\
+        --elements code,subject --count 1000 --output observations.ndjson
+"""
+
+import argparse
+import codecs
+import json
+import os
+import queue
+import sys
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO
+
+import requests
+
+BASE_URL = "https://healthcare.googleapis.com/v1"
+# Size of the chunks the search Bundles are read in
+CHUNK_SIZE = 64 * 1024
+
+
+def authorized_session(max_connections: int = 10) -> requests.Session:
+    """Returns a session authorized with Application Default Credentials.
+
+    The session is safe to share between threads and keeps up to
+    max_connections connections open for reuse.
+    """
+    # Imports the google.auth.transport.requests transport
+    from google.auth.transport import requests as auth_requests
+
+    # Imports a module to allow authentication using Application Default Credentials (ADC)
+    import google.auth
+
+    credentials, _ = google.auth.default()
+    scoped_credentials = credentials.with_scopes(
+        ["https://www.googleapis.com/auth/cloud-platform"]
+    )
+    session = auth_requests.AuthorizedSession(scoped_credentials)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=max_connections
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+def fhir_store_url(
+    project_id: str,
+    location: str,
+    dataset_id: str,
+    fhir_store_id: str,
+    base_url: str = BASE_URL,
+) -> str:
+    """Returns the URL of the FHIR REST API of the FHIR store."""
+    return "{}/projects/{}/locations/{}/datasets/{}/fhirStores/{}/fhir".format(
+        base_url, project_id, location, dataset_id, fhir_store_id
+    )
+
+
+class _JsonStream:
+    """Reads JSON values one by one from a stream of bytes chunks."""
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+
+    def _fill(self) -> None:
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            raise ValueError("The JSON document is truncated.")
+        self._buffer = self._buffer[self._pos :] + self._text_decoder.decode(chunk)
+        self._pos = 0
+
+    def peek(self) -> str:
+        """Returns the next structural character without consuming it."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            self._fill()
+
+    def token(self) -> str:
+        """Consumes and returns the next structural character."""
+        char = self.peek()
+        self._pos += 1
+        return char
+
+    def value(self) -> Any:
+        """Consumes and returns the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A value is always followed by a structural character, which
+                # guarantees that a number wasn't cut off at the chunk's end.
+                if end < len(self._buffer):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                pass
+            self._fill()
+
+
+def iter_bundle(chunks: Iterable[bytes], fields: Dict[str, Any]) -> Iterator[dict]:
+    """Yields the entries of a Bundle as soon as each of them is downloaded.
+
+    Args:
+      chunks: The Bundle's JSON in chunks of bytes of any size.
+      fields: A dict that is updated with the Bundle's other fields, such as
+        link and total.
+    """
+    stream = _JsonStream(chunks)
+    if stream.token() != "{":
+        raise ValueError("The Bundle is not a JSON object.")
+    if stream.peek() == "}":
+        return
+    separator = ","
+    while separator == ",":
+        key = stream.value()
+        stream.token()  # :
+        if key == "entry":
+            if stream.token() != "[":
+                raise ValueError("The Bundle's entry is not a list.")
+            item_separator = "]" if stream.peek() == "]" else ","
+            if item_separator == "]":
+                stream.token()
+            while item_separator == ",":
+                yield stream.value()
+                item_separator = stream.token()
+        else:
+            fields[key] = stream.value()
+        separator = stream.token()
+
+
+def _next_url(links: List[Dict[str, str]]) -> Optional[str]:
+    for link in links:
+        if link.get("relation") == "next":
+            return link["url"]
+    return None
+
+
+def iter_search(
+    session: requests.Session,
+    url: str,
+    params: Optional[Dict[str, str]] = None,
+    method: str = "GET",
+    elements: Optional[List[str]] = None,
+    count: Optional[int] = None,
+    max_buffered: int = 1000,
+) -> Iterator[Dict[str, Any]]:
+    """Yields the resources of a search Bundle and all its following pages.
+
+    A background thread downloads the pages and keeps up to max_buffered
+    resources ahead of the caller. If the caller stops iterating, the
+    download stops too.
+
+    Args:
+      session: The authorized session.
+      url: The URL of the search.
+      params: The search parameters.
+      method: GET, or POST to send the search parameters in the request body.
+      elements: The resource elements to return, if not all of them.
+      count: The number of resources per page.
+      max_buffered: The max number of resources to download ahead.
+    """
+    params = dict(params or {})
+    if elements:
+        params["_elements"] = ",".join(elements)
+    if count:
+        params["_count"] = str(count)
+
+    resources = queue.Queue(maxsize=max_buffered)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item: Any) -> bool:
+        while not stopped.is_set():
+            try:
+                resources.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def download() -> None:
+        try:
+            if method == "POST":
+                request = {"method": "POST", "url": url, "data": params}
+            else:
+                request = {"method": "GET", "url": url, "params": params}
+            while request:
+                response = session.request(
+                    headers={"Accept": "application/fhir+json"},
+                    stream=True,
+                    **request,
+                )
+                with response:
+                    response.raise_for_status()
+                    fields = {}
+                    for entry in iter_bundle(
+                        response.iter_content(chunk_size=CHUNK_SIZE), fields
+                    ):
+                        if not put(entry["resource"]):
+                            return
+                next_url = _next_url(fields.get("link", []))
+                # The next link includes the search parameters.
+                request = {"method": "GET", "url": next_url} if next_url else None
+            put(done)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=download, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = resources.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+
+
+def search_resources(
+    session: requests.Session,
+    store_url: str,
+    resource_type: str,
+    params: Optional[Dict[str, str]] = None,
+    **kwargs: Any,
+) -> Iterator[Dict[str, Any]]:
+    """Yields all the resources of the type that match the search parameters.
+
+    The search parameters are sent in a POST request body, so that they are
+    not limited by the max URL length. See iter_search for the other arguments.
+    """
+    return iter_search(
+        session,
+        f"{store_url}/{resource_type}/_search",
+        params,
+        method="POST",
+        **kwargs,
+    )
+
+
+def patient_everything(
+    session: requests.Session,
+    store_url: str,
+    patient_id: str,
+    **kwargs: Any,
+) -> Iterator[Dict[str, Any]]:
+    """Yields all the resources in the patient compartment.
+
+    See iter_search for the other arguments.
+    """
+    return iter_search(
+        session, f"{store_url}/Patient/{patient_id}/$everything", **kwargs
+    )
+
+
+def export_ndjson(resources: Iterable[Dict[str, Any]], output: TextIO) -> int:
+    """Writes the resources as newline delimited JSON.
+
+    Returns the number of resources written.
+    """
+    written = 0
+    for resource in resources:
+        output.write(json.dumps(resource, separators=(",", ":")))
+        output.write("\n")
+        written += 1
+    return written
+
+
+def parse_command_line_args():
+    """Parses command line arguments."""
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    parser.add_argument(
+        "--project_id",
+        default=(os.environ.get("GOOGLE_CLOUD_PROJECT")),
+        help="GCP project name",
+    )
+
+    parser.add_argument("--location", default="us-central1", help="GCP location")
+
+    parser.add_argument("--dataset_id", default=None, help="Name of dataset")
+
+    parser.add_argument("--fhir_store_id", default=None, help="Name of FHIR store")
+
+    parser.add_argument(
+        "--resource_type", default="Patient", help="The type of resources to search"
+    )
+
+    parser.add_argument(
+        "--patient_id",
+        default=None,
+        help="Returns the patient compartment of the patient instead of searching",
+    )
+
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        help="A search parameter as name=value, can be repeated",
+    )
+
+    parser.add_argument(
+        "--elements", default=None, help="Comma separated elements to return"
+    )
+
+    parser.add_argument(
+        "--count", type=int, default=None, help="Number of resources per page"
+    )
+
+    parser.add_argument(
+        "--output", default="-", help="The NDJSON file to write, - for stdout"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    session = authorized_session()
+    store_url = fhir_store_url(
+        args.project_id, args.location, args.dataset_id, args.fhir_store_id
+    )
+    kwargs = {
+        "elements": args.elements.split(",") if args.elements else None,
+        "count": args.count,
+    }
+    if args.patient_id:
+        resources = patient_everything(session, store_url, args.patient_id, **kwargs)
+    else:
+        params = dict(param.split("=", 1) for param in args.param)
+        resources = search_resources(
+            session, store_url, args.resource_type, params, **kwargs
+        )
+
+    if args.output == "-":
+        export_ndjson(resources, sys.stdout)
+    else:
+        with open(args.output, "w") as output:
+            written = export_ndjson(resources, output)
+        print(f"Exported {written} resources to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
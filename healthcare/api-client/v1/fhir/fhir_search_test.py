@@ -0,0 +1,117 @@
+# Copyright 2023 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+
+import pytest
+
+import fhir_search
+
+store_url = "https://healthcare.googleapis.com/v1/fhir"
+
+
+def make_bundle(ids, next_url=None):
+    bundle = {
+        "entry": [
+            {
+                "fullUrl": f"Patient/{i}",
+                "resource": {"id": i, "resourceType": "Patient"},
+            }
+            for i in ids
+        ],
+        "link": [{"relation": "self", "url": "self"}],
+        "resourceType": "Bundle",
+        "total": 12345,
+        "type": "searchset",
+    }
+    if next_url:
+        bundle["link"].append({"relation": "next", "url": next_url})
+    return json.dumps(bundle, indent=1, ensure_ascii=False).encode()
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self._body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        # Uses small chunks to split the values and characters across chunks.
+        for i in range(0, len(self._body), 7):
+            yield self._body[i : i + 7]
+
+
+class FakeSession:
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs.get("params"), kwargs.get("data")))
+        return FakeResponse(self.pages[url])
+
+
+@pytest.mark.parametrize("ids", [[], ["a"], ["a", "b", "ü"]])
+def test_iter_bundle(ids):
+    fields = {}
+    body = make_bundle(ids, next_url="next")
+
+    entries = list(fhir_search.iter_bundle(FakeResponse(body).iter_content(7), fields))
+
+    assert entries == json.loads(body)["entry"]
+    assert fields["total"] == 12345
+    assert fhir_search._next_url(fields["link"]) == "next"
+
+
+def test_search_resources_follows_next_links():
+    session = FakeSession(
+        {
+            f"{store_url}/Patient/_search": make_bundle(["1", "2"], "page2"),
+            "page2": make_bundle(["3"], "page3"),
+            "page3": make_bundle([]),
+        }
+    )
+
+    resources = fhir_search.search_resources(
+        session,
+        store_url,
+        "Patient",
+        {"family:exact": "Smith"},
+        elements=["id"],
+        count=2,
+        max_buffered=1,
+    )
+    output = io.StringIO()
+
+    assert fhir_search.export_ndjson(resources, output) == 3
+    assert [json.loads(line)["id"] for line in output.getvalue().splitlines()] == [
+        "1",
+        "2",
+        "3",
+    ]
+    assert session.requests[0] == (
+        "POST",
+        f"{store_url}/Patient/_search",
+        None,
+        {"family:exact": "Smith", "_elements": "id", "_count": "2"},
+    )
+    assert [request[1] for request in session.requests[1:]] == ["page2", "page3"]
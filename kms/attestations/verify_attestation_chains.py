@@ -21,8 +21,14 @@ For more information, visit https://cloud.google.com/kms/docs/attest-key.
 
 # [START kms_verify_chains]
 import argparse
+import collections
+from concurrent import futures
+import contextlib
+import datetime
+import functools
 import gzip
 import io
+import os
 import zipfile
 
 from cryptography import exceptions
@@ -38,6 +44,14 @@ ATTESTATION_SIGNATURE_LEN = 256
 
 MANUFACTURER_CERT_URL = "https://www.marvell.com/content/dam/marvell/en/public-collateral/security-solutions/liquid_security_certificate.zip"
 
+# The downloaded manufacturer root certificate is cached in this file.
+MANUFACTURER_CERT_CACHE_FILE = os.path.join(
+    os.path.expanduser("~"),
+    ".cache",
+    "kms-attestations",
+    "liquid_security_certificate.crt",
+)
+
 # <Name(C=US,ST=California,L=San Jose,O=Cavium\, Inc.,OU=LiquidSecurity,CN=localca.liquidsecurity.cavium.com)>
 MANUFACTURER_CERT_SUBJECT_BYTES = (
     b"0\x81\x911\x0b0\t\x06\x03U\x04\x06\x13\x02US1\x130\x11\x06\x03U\x04\x08"
@@ -128,16 +142,50 @@ x2JBsjEjmWpHuBDAXPCesD5cu9UzzDgcpdwmi7Xidl74kj3f/HgrOeimRdOb8lG5
 -----END CERTIFICATE-----
 """
 
+# Manufacturer root certificates loaded by this process, by cache file.
+_manufacturer_root_certificates = {}
+
+
+def _is_expired(cert):
+    return cert.not_valid_after_utc <= datetime.datetime.now(datetime.timezone.utc)
+
+
+def get_manufacturer_root_certificate(cache_file=MANUFACTURER_CERT_CACHE_FILE):
+    """Gets the manufacturer root certificate.
+
+    The certificate is downloaded once and kept in memory and in cache_file
+    until it expires. Pass an empty cache_file to only keep it in memory.
+    """
+    cert = _manufacturer_root_certificates.get(cache_file)
+    if cert is not None and not _is_expired(cert):
+        return cert
+
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read(), backends.default_backend())
+        if not _is_expired(cert):
+            _manufacturer_root_certificates[cache_file] = cert
+            return cert
 
-def get_manufacturer_root_certificate():
-    """Gets the manufacturer root certificate."""
     resp = requests.get(MANUFACTURER_CERT_URL)
+    resp.raise_for_status()
     tmp_file = io.BytesIO(resp.content)
     zip_file = zipfile.ZipFile(tmp_file)
     with zip_file.open("liquid_security_certificate.crt") as f:
-        return x509.load_pem_x509_certificate(f.read(), backends.default_backend())
-
-
+        cert_pem = f.read()
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # Writes to a temporary file first, so that concurrent readers never
+        # see a partially written certificate.
+        with open(f"{cache_file}.{os.getpid()}", "wb") as f:
+            f.write(cert_pem)
+        os.replace(f"{cache_file}.{os.getpid()}", cache_file)
+    cert = x509.load_pem_x509_certificate(cert_pem, backends.default_backend())
+    _manufacturer_root_certificates[cache_file] = cert
+    return cert
+
+
+@functools.lru_cache(maxsize=None)
 def get_owner_root_certificate():
     """Gets the owner root certificate."""
     return x509.load_pem_x509_certificate(
@@ -145,19 +193,70 @@ def get_owner_root_certificate():
     )
 
 
-def verify_certificate(signing_cert, issued_cert):
-    """Verifies the signing_cert issued the issued_cert.
+def _get_extension_value(cert, extension_class):
+    try:
+        return cert.extensions.get_extension_for_class(extension_class).value
+    except x509.ExtensionNotFound:
+        return None
 
-    Args:
-        signing_cert: The certificate used to verify the issued certificate's
-          signature.
-        issued_cert: The issued certificate.
 
-    Returns:
-        True if the signing_cert issued the issued_cert.
+def _subject_key_identifier(cert):
+    ski = _get_extension_value(cert, x509.SubjectKeyIdentifier)
+    return ski.digest if ski else None
+
+
+def _authority_key_identifier(cert):
+    aki = _get_extension_value(cert, x509.AuthorityKeyIdentifier)
+    return aki.key_identifier if aki else None
+
+
+class CertificateIndex:
+    """A set of untrusted certificates indexed by their issuer.
+
+    Finding the certificates that could have been issued by an issuer
+    certificate only compares names and key identifiers, so that signatures
+    are checked only for the likely candidates.
     """
-    if signing_cert.subject != issued_cert.issuer:
-        return False
+
+    def __init__(self, certs):
+        self._certs = set()
+        self._by_issuer = collections.defaultdict(list)
+        for cert in certs:
+            if cert not in self._certs:
+                self._certs.add(cert)
+                self._by_issuer[cert.issuer].append(cert)
+
+    def candidates(self, issuer_cert):
+        """Returns the certificates that name issuer_cert as their issuer.
+
+        Args:
+            issuer_cert: The issuer certificate.
+
+        Returns:
+            The certificates whose issuer name matches the subject of the
+            issuer certificate, and whose authority key identifier, if any,
+            matches its subject key identifier.
+        """
+        key_id = _subject_key_identifier(issuer_cert)
+        return [
+            cert
+            for cert in self._by_issuer.get(issuer_cert.subject, [])
+            if cert in self._certs
+            and (key_id is None or _authority_key_identifier(cert) in (None, key_id))
+        ]
+
+    def remove(self, cert):
+        self._certs.remove(cert)
+
+    def __len__(self):
+        return len(self._certs)
+
+    def __iter__(self):
+        return iter(self._certs)
+
+
+@functools.lru_cache(maxsize=4096)
+def _verify_signature(signing_cert, issued_cert):
     try:
         signing_cert.public_key().verify(
             issued_cert.signature,
@@ -168,7 +267,25 @@ def verify_certificate(signing_cert, issued_cert):
         return True
     except exceptions.InvalidSignature:
         return False
-    return False
+
+
+def verify_certificate(signing_cert, issued_cert):
+    """Verifies the signing_cert issued the issued_cert.
+
+    The results of the signature checks are memoized, since the same
+    certificates appear in the chains of many attestations.
+
+    Args:
+        signing_cert: The certificate used to verify the issued certificate's
+          signature.
+        issued_cert: The issued certificate.
+
+    Returns:
+        True if the signing_cert issued the issued_cert.
+    """
+    if signing_cert.subject != issued_cert.issuer:
+        return False
+    return _verify_signature(signing_cert, issued_cert)
 
 
 def get_issued_certificate(issuer_cert, untrusted_certs, predicate=lambda _: True):
@@ -178,15 +295,22 @@ def get_issued_certificate(issuer_cert, untrusted_certs, predicate=lambda _: Tru
 
     Args:
         issuer_cert: The issuer certificate.
-        untrusted_certs: A set of untrusted certificates.
+        untrusted_certs: A set or CertificateIndex of untrusted certificates.
         predicate: An additional condition for the issued certificate.
 
     Returns:
         A certificate within the set of untrusted certificates that was issued
         by the issuer certificate and matches the predicate.
     """
-    for cert in untrusted_certs:
-        if verify_certificate(issuer_cert, cert) and predicate(cert):
+    if isinstance(untrusted_certs, CertificateIndex):
+        candidates = untrusted_certs.candidates(issuer_cert)
+    else:
+        candidates = [
+            cert for cert in untrusted_certs if cert.issuer == issuer_cert.subject
+        ]
+    # Checks the predicate first, since it's cheaper than the signature.
+    for cert in candidates:
+        if predicate(cert) and verify_certificate(issuer_cert, cert):
             untrusted_certs.remove(cert)
             return cert
     return None
@@ -230,12 +354,12 @@ def verify(certs_file, attestation_file):
         return False
 
     untrusted_certs_pem = pem.parse_file(certs_file)
-    untrusted_certs = {
+    untrusted_certs = CertificateIndex(
         x509.load_pem_x509_certificate(
             str(cert_pem).encode("utf-8"), backends.default_backend()
         )
         for cert_pem in untrusted_certs_pem
-    }
+    )
 
     # Build the manufacturer certificate chain.
     mfr_card_cert = get_issued_certificate(mfr_root_cert, untrusted_certs)
@@ -287,16 +411,71 @@ def verify(certs_file, attestation_file):
         ) and verify_attestation(owner_partition_cert, attestation)
 
 
+def _verify_quietly(files):
+    certs_file, attestation_file = files
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            verified = verify(certs_file, attestation_file)
+        except Exception as e:
+            print(f"Error: {e}")
+            verified = False
+    return attestation_file, verified, output.getvalue()
+
+
+def verify_many(file_pairs, processes=None):
+    """Verifies many attestations in parallel processes.
+
+    Args:
+        file_pairs: (certificate chains filename, attestation filename) tuples.
+        processes: The number of processes, defaults to the number of CPUs.
+
+    Yields:
+        (attestation filename, verified, output) tuples in the order of
+        file_pairs, where output is what verify printed.
+    """
+    # Downloads the manufacturer root certificate before starting the
+    # processes, so that they all read it from the cache file.
+    get_manufacturer_root_certificate()
+    if processes == 1:
+        yield from map(_verify_quietly, file_pairs)
+        return
+    with futures.ProcessPoolExecutor(processes) as executor:
+        yield from executor.map(_verify_quietly, file_pairs, chunksize=16)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
     )
     parser.add_argument("--certificates", help="The certificate chains filename.")
     parser.add_argument("--attestation", help="The attestation filename.")
+    parser.add_argument(
+        "--manifest",
+        help="A file with a certificate chains filename and an attestation "
+        "filename per line, to verify many attestations in parallel.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="The number of processes for --manifest, defaults to the number of CPUs.",
+    )
 
     args = parser.parse_args()
 
-    if verify(args.certificates, args.attestation):
+    if args.manifest:
+        with open(args.manifest) as f:
+            file_pairs = [tuple(line.split()) for line in f if line.strip()]
+        failed = 0
+        for attestation_file, verified, output in verify_many(
+            file_pairs, args.processes
+        ):
+            if not verified:
+                failed += 1
+                print(f"{attestation_file} could not be verified:\n{output}")
+        print(f"Verified {len(file_pairs) - failed} of {len(file_pairs)} attestations.")
+    elif verify(args.certificates, args.attestation):
         print("The attestation has been verified.")
     else:
         print("The attestation could not be verified.")
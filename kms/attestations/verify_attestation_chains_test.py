@@ -12,10 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import io
+import os
 import tempfile
+from unittest import mock
+import zipfile
 
 from cryptography import x509
 from cryptography.hazmat import backends
+import pem
 import pytest
 
 import verify_attestation_chains
@@ -296,6 +302,42 @@ def test_data():
     yield param
 
 
+def make_manufacturer_root_zip():
+    """Returns a zip file with the test root, as the manufacturer serves it."""
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, "w") as zip_file:
+        zip_file.writestr("liquid_security_certificate.crt", TEST_MANUFACTURER_ROOT)
+    return zip_bytes.getvalue()
+
+
+def test_get_manufacturer_root_certificate_until_expired(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        verify_attestation_chains, "_manufacturer_root_certificates", {}
+    )
+    response = mock.Mock(content=make_manufacturer_root_zip())
+    get = mock.Mock(return_value=response)
+    monkeypatch.setattr(verify_attestation_chains.requests, "get", get)
+    cache_file = str(tmp_path / "cache" / "mfr.crt")
+
+    cert = verify_attestation_chains.get_manufacturer_root_certificate(cache_file)
+    assert cert == get_test_manufacturer_root()
+    assert (
+        verify_attestation_chains.get_manufacturer_root_certificate(cache_file) is cert
+    )
+    assert get.call_count == 1
+
+    # Certificates are downloaded again once expired.
+    expired = mock.Mock(
+        not_valid_after_utc=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    )
+    verify_attestation_chains._manufacturer_root_certificates[cache_file] = expired
+    os.remove(cache_file)
+    assert (
+        verify_attestation_chains.get_manufacturer_root_certificate(cache_file) == cert
+    )
+    assert get.call_count == 2
+
+
 def test_verify(monkeypatch, test_data):
     monkeypatch.setattr(
         verify_attestation_chains,
@@ -331,3 +373,47 @@ def test_verify_invalid_mfr_root_fails(monkeypatch, test_data):
     assert not verify_attestation_chains.verify(
         test_data["cert_chains"], test_data["attestation"]
     )
+
+
+def test_certificate_index_prunes_candidates():
+    mfr_chain = [
+        x509.load_pem_x509_certificate(cert_pem.as_bytes(), backends.default_backend())
+        for cert_pem in pem.parse(TEST_MANUFACTURER_CHAIN)
+    ]
+    owner_card = x509.load_pem_x509_certificate(
+        TEST_OWNER_CARD_CHAIN, backends.default_backend()
+    )
+    index = verify_attestation_chains.CertificateIndex(mfr_chain + [owner_card])
+
+    assert index.candidates(get_test_owner_root()) == [owner_card]
+    assert index.candidates(get_test_manufacturer_root()) == [mfr_chain[1]]
+    assert (
+        verify_attestation_chains.get_issued_certificate(get_test_owner_root(), index)
+        == owner_card
+    )
+    assert len(index) == 2
+
+
+def test_verify_many(monkeypatch, test_data):
+    monkeypatch.setattr(
+        verify_attestation_chains,
+        "MANUFACTURER_CERT_SUBJECT_BYTES",
+        TEST_MANUFACTURER_SUBJECT_BYTES,
+    )
+    monkeypatch.setattr(
+        verify_attestation_chains,
+        "get_manufacturer_root_certificate",
+        get_test_manufacturer_root,
+    )
+    monkeypatch.setattr(
+        verify_attestation_chains, "get_owner_root_certificate", get_test_owner_root
+    )
+    file_pairs = [
+        (test_data["cert_chains"], test_data["attestation"]),
+        (test_data["mfr_chain"], test_data["attestation"]),
+    ]
+
+    results = list(verify_attestation_chains.verify_many(file_pairs, processes=1))
+
+    assert [verified for _, verified, _ in results] == [True, False]
+    assert "Invalid HSM owner certificate chain." in results[1][2]
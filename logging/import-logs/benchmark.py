@@ -0,0 +1,132 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+# pylint: disable=protected-access
+
+"""Local benchmark of the import engine using fake storage and logging clients.
+
+Usage:
+    python benchmark.py --files 20 --entries 5000 --read-latency 0.05 --write-latency 0.2
+"""
+
+import argparse
+import io
+import json
+import threading
+import time
+from typing import List
+
+import main
+
+
+class FakeBlob:
+    def __init__(self, content: bytes, latency: float) -> None:
+        self._content = content
+        self._latency = latency
+
+    def open(self, *_args: str, **_kwargs: int) -> io.BytesIO:
+        time.sleep(self._latency)
+        return io.BytesIO(self._content)
+
+
+class FakeBucket:
+    def __init__(self, content: bytes, latency: float) -> None:
+        self._content = content
+        self._latency = latency
+
+    def blob(self, _path: str) -> FakeBlob:
+        return FakeBlob(self._content, self._latency)
+
+
+class FakeStorageClient:
+    def __init__(self, content: bytes, latency: float) -> None:
+        self._bucket = FakeBucket(content, latency)
+
+    def bucket(self, _name: str) -> FakeBucket:
+        return self._bucket
+
+
+class FakeLoggingAPI:
+    def __init__(self, latency: float) -> None:
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def write_entries(self, _entries: List[dict]) -> None:
+        time.sleep(self._latency)
+        with self._lock:
+            self.calls += 1
+
+
+class FakeLoggingClient:
+    def __init__(self, latency: float) -> None:
+        self.project = "benchmark-project"
+        self.logging_api = FakeLoggingAPI(latency)
+
+
+def _make_file(entries: int) -> bytes:
+    lines = []
+    for i in range(entries):
+        lines.append(
+            json.dumps(
+                {
+                    "logName": "projects/source-project/logs/benchmark",
+                    "insertId": f"{i:012}",
+                    "timestamp": "2023-08-12T00:00:00.000000Z",
+                    "severity": "INFO",
+                    "textPayload": f"GET /health {i} 200 OK",
+                    "resource": {"type": "global", "labels": {}},
+                }
+            )
+        )
+    return "\n".join(lines).encode()
+
+
+def run(files: int, entries: int, read_latency: float, write_latency: float) -> None:
+    storage_client = FakeStorageClient(_make_file(entries), read_latency)
+    logging_client = FakeLoggingClient(write_latency)
+    started = time.monotonic()
+    total_entries, total_bytes = main.import_logs(
+        [f"benchmark/{i}.json" for i in range(files)], storage_client, logging_client
+    )
+    elapsed = time.monotonic() - started
+    print(
+        f"download_workers={main.DOWNLOAD_WORKERS} write_workers={main.WRITE_WORKERS}: "
+        f"{total_entries} entries ({total_bytes} bytes) "
+        f"in {logging_client.logging_api.calls} writes, {elapsed:.2f}s: "
+        f"{total_entries / elapsed:.1f} entries/s, {total_bytes / elapsed:.1f} bytes/s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--entries", type=int, default=5000, help="entries per file")
+    parser.add_argument("--read-latency", type=float, default=0.05)
+    parser.add_argument("--write-latency", type=float, default=0.2)
+    parser.add_argument("--download-workers", type=int, default=main.DOWNLOAD_WORKERS)
+    parser.add_argument("--write-workers", type=int, default=main.WRITE_WORKERS)
+    parser.add_argument(
+        "--max-batch-bytes", type=int, default=main._LOGS_MAX_SIZE_BYTES
+    )
+    args = parser.parse_args()
+
+    main.BUCKET_NAME = "benchmark-bucket"
+    main.DOWNLOAD_WORKERS = args.download_workers
+    main.WRITE_WORKERS = args.write_workers
+    main._LOGS_MAX_SIZE_BYTES = args.max_batch_bytes
+    run(args.files, args.entries, args.read_latency, args.write_latency)
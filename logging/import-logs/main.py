@@ -15,19 +15,33 @@
 # pylint: disable=missing-module-docstring
 # pylint: disable=broad-exception-caught
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import date, datetime, timedelta
+import heapq
 import json
-import math
 import os
+import queue
 import sys
+import threading
+import time
 
-from typing import List, Tuple, TypedDict
+from typing import Callable, Iterator, List, Optional, Tuple, TypedDict
 
 from google.api_core import exceptions
 from google.cloud import logging_v2, storage
 
 # Logging limits (https://cloud.google.com/logging/quotas#api-limits)
 _LOGS_MAX_SIZE_BYTES = 9 * 1024 * 1024  # < 10MB
+# Size of ranged reads when streaming log files from Cloud Storage
+_READ_CHUNK_SIZE = 8 * 1024 * 1024
+# Number of parsed entries handed from a download worker to the batcher at once
+_PARSE_CHUNK_ENTRIES = 1000
+# Max number of parsed chunks waiting to be batched (bounds memory use)
+_PARSE_QUEUE_SIZE = 64
+# Object name prefix and min interval between saves of the task checkpoints
+_CHECKPOINT_PREFIX = "import-logs-checkpoints"
+_CHECKPOINT_INTERVAL_SEC = 30
 
 # Read Cloud Run environment variables
 TASK_INDEX = int(os.getenv("CLOUD_RUN_TASK_INDEX", "0"))
@@ -48,6 +62,10 @@ END_DATE = getenv_date("END_DATE")
 LOG_ID = os.getenv("LOG_ID")
 BUCKET_NAME = os.getenv("STORAGE_BUCKET_NAME")
 PROJECT_ID = os.getenv("PROJECT_ID")
+# Read import tuning parameters' environment variables
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+WRITE_WORKERS = int(os.getenv("WRITE_WORKERS", "4"))
+CHECKPOINT_BUCKET_NAME = os.getenv("CHECKPOINT_BUCKET_NAME")
 
 
 def eprint(*objects: str, **kwargs: TypedDict) -> None:
@@ -55,17 +73,6 @@ def eprint(*objects: str, **kwargs: TypedDict) -> None:
     print(*objects, file=sys.stderr, **kwargs)
 
 
-def _day(blob_name: str) -> int:
-    """Parse day number from Blob's path
-
-    Use the known Blob path convention to parse the day part from the path.
-    The path convention is <LOG_ID>/YYYY/MM/DD/<OBJECT_NAME>
-    """
-    # calculated in function to allow test to set LOG_ID
-    offset = len(LOG_ID) + 1 + 4 + 1 + 2 + 1
-    return int(blob_name[offset : offset + 2])
-
-
 def _is_valid_import_range() -> bool:
     """Validate the import date range
 
@@ -84,76 +91,110 @@ def _is_valid_import_range() -> bool:
     return True
 
 
-def calc_import_range() -> Tuple[date, date]:
-    """Calculate import range for the task based on full import range and number of tasks"""
-    if TASK_COUNT == 1:
-        return START_DATE, END_DATE
-
-    diff = END_DATE - START_DATE
-    if diff.days > TASK_COUNT:
-        shard_days = math.floor(diff.days / TASK_COUNT)
-    else:
-        shard_days = 1
-
-    # start day is next day after prev. task end day
-    start_date = START_DATE + timedelta((shard_days + 1) * TASK_INDEX)
-    # when no more tasks required return (deterministic) negative range
-    if start_date > END_DATE:
-        return END_DATE, START_DATE
+def _prefix(_date: date) -> str:
+    return f"{LOG_ID}/{_date.year:04}/{_date.month:02}/"
 
-    if TASK_INDEX < (TASK_COUNT - 1):
-        end_date = start_date + timedelta(shard_days)
-    else:
-        end_date = END_DATE
-    return start_date, end_date
 
+def _prefixes(first_day: date, last_day: date) -> List[str]:
+    """Build listing prefixes that cover the days between first and last days.
 
-def _prefix(_date: date) -> str:
-    return f"{LOG_ID}/{_date.year:04}/{_date.month:02}/"
+    Whole months in the range are listed with a month prefix,
+    partially covered months are listed day by day.
+    """
+    prefixes = []
+    month_start = date(first_day.year, first_day.month, 1)
+    while month_start <= last_day:
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        month_end = next_month - timedelta(days=1)
+        first, last = max(first_day, month_start), min(last_day, month_end)
+        if first == month_start and last == month_end:
+            prefixes.append(_prefix(month_start))
+        else:
+            prefixes.extend(
+                f"{_prefix(first)}{day:02}/" for day in range(first.day, last.day + 1)
+            )
+        month_start = next_month
+    return prefixes
 
 
-def list_log_files(first_day: date, last_day: date, client: storage.Client) -> List:
-    """Load paths to all log files stored in Cloud Storage in between first and last days.
+def list_log_files(
+    first_day: date, last_day: date, client: storage.Client
+) -> List[Tuple[str, int]]:
+    """Load paths and sizes of all log files stored in Cloud Storage in between first and last days.
     For log organization hierarchy see
     https://cloud.google.com/logging/docs/export/storage#gcs-organization.
     """
-    paths = []
+    files = []
+    for prefix in _prefixes(first_day, last_day):
+        blobs = client.list_blobs(BUCKET_NAME, prefix=prefix, delimiter=None)
+        files.extend((b.name, b.size or 0) for b in blobs)
+    return files
 
-    # collect paths for special case when first and last days are in the same month
-    if first_day.year == last_day.year and first_day.month == last_day.month:
-        blobs = client.list_blobs(
-            BUCKET_NAME, prefix=_prefix(first_day), delimiter=None
-        )
-        paths = [
-            b.name
-            for b in blobs
-            if _day(b.name) >= first_day.day and _day(b.name) <= last_day.day
-        ]
-        return paths
-
-    # collect all log file paths in first month and filter those for early days
-    blobs = client.list_blobs(BUCKET_NAME, prefix=_prefix(first_day), delimiter=None)
-    paths.extend([b.name for b in blobs if _day(b.name) >= first_day.day])
-    # process all paths in last months
-    blobs = client.list_blobs(BUCKET_NAME, prefix=_prefix(last_day))
-    paths.extend([b.name for b in blobs if _day(b.name) <= last_day.day])
-    # process all paths in between
-    for year in range(first_day.year, last_day.year + 1):
-        for month in range(
-            first_day.month + 1 if year == first_day.year else 1,
-            last_day.month if year == last_day.year else 13,
-        ):
-            blobs = client.list_blobs(
-                BUCKET_NAME, prefix=_prefix(date(year=year, month=month, day=1))
+
+def assign_log_files(files: List[Tuple[str, int]]) -> List[str]:
+    """Select the log files that the task should import.
+
+    Every task builds the same manifest that balances files across tasks
+    by their size: files are placed from the largest to the smallest
+    onto the task with the least assigned bytes.
+    """
+    if TASK_COUNT == 1:
+        return [name for name, _ in files]
+
+    loads = [(0, index) for index in range(TASK_COUNT)]
+    assigned = []
+    for name, size in sorted(files, key=lambda f: (-f[1], f[0])):
+        load, index = heapq.heappop(loads)
+        if index == TASK_INDEX:
+            assigned.append(name)
+        heapq.heappush(loads, (load + size, index))
+    return assigned
+
+
+def _checkpoint_path() -> str:
+    return (
+        f"{_CHECKPOINT_PREFIX}/{LOG_ID}/"
+        f"{START_DATE:%Y%m%d}-{END_DATE:%Y%m%d}/"
+        f"task-{TASK_INDEX:04}-of-{TASK_COUNT:04}.json"
+    )
+
+
+class Checkpoint:
+    """Records imported log files in Cloud Storage so a retried task can resume"""
+
+    def __init__(self, client: storage.Client) -> None:
+        self._blob = client.bucket(CHECKPOINT_BUCKET_NAME).blob(_checkpoint_path())
+        self._saved_at = time.monotonic()
+        self._dirty = False
+        try:
+            self.imported = set(json.loads(self._blob.download_as_bytes()))
+        except exceptions.NotFound:
+            self.imported = set()
+
+    def add(self, path: str) -> None:
+        """Marks the file as imported and saves the checkpoint once in a while"""
+        self.imported.add(path)
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= _CHECKPOINT_INTERVAL_SEC:
+            self.save()
+
+    def save(self) -> None:
+        """Saves the checkpoint if new files were imported since the last save"""
+        if self._dirty:
+            self._blob.upload_from_string(
+                json.dumps(sorted(self.imported)), content_type="application/json"
             )
-            paths.extend([b.name for b in blobs])
-    return paths
+            self._dirty = False
+        self._saved_at = time.monotonic()
 
 
-def _read_logs(path: str, bucket: storage.Bucket) -> List[str]:
+def _read_logs(path: str, bucket: storage.Bucket) -> Iterator[bytes]:
+    """Streams lines of the log file using ranged reads of _READ_CHUNK_SIZE"""
     blob = bucket.blob(path)
-    contents = blob.download_as_string()
-    return contents.splitlines()
+    with blob.open("rb", chunk_size=_READ_CHUNK_SIZE) as reader:
+        for line in reader:
+            if line.strip():
+                yield line
 
 
 def _write_logs(logs: List[dict], client: logging_v2.Client) -> None:
@@ -187,25 +228,135 @@ def _patch_entry(log: dict, project_id: str) -> None:
     # log["timestamp"] = None
 
 
-def import_logs(
-    log_files: List, storage_client: storage.Client, logging_client: logging_v2.Client
+def _put(entries_queue: queue.Queue, item: object, stop: threading.Event) -> None:
+    """Puts item to the queue unless the import was stopped"""
+    while not stop.is_set():
+        try:
+            entries_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def _parse_logs(
+    path: str,
+    bucket: storage.Bucket,
+    project_id: str,
+    entries_queue: queue.Queue,
+    stop: threading.Event,
 ) -> None:
-    """Iterates through log files to write log entries in batched mode"""
-    total_size, logs = 0, []
+    """Reads and patches log entries of the file, passing them to the batcher in chunks.
+
+    Each entry is paired with the size of its encoded form
+    which is used to size the write batches.
+    """
+    if stop.is_set():
+        return
+    chunk = []
+    for line in _read_logs(path, bucket):
+        if stop.is_set():
+            return
+        log = json.loads(line)
+        _patch_entry(log, project_id)
+        chunk.append((log, len(json.dumps(log))))
+        if len(chunk) >= _PARSE_CHUNK_ENTRIES:
+            _put(entries_queue, chunk, stop)
+            chunk = []
+    if chunk:
+        _put(entries_queue, chunk, stop)
+
+
+def import_logs(
+    log_files: List,
+    storage_client: storage.Client,
+    logging_client: logging_v2.Client,
+    on_file_imported: Optional[Callable[[str], None]] = None,
+) -> Tuple[int, int]:
+    """Iterates through log files to write log entries in batched mode
+
+    Log files are downloaded and parsed by a pool of DOWNLOAD_WORKERS threads.
+    Batches are sized by the encoded size of the entries and written
+    with up to WRITE_WORKERS concurrent write_entries calls.
+    The optional on_file_imported callback is called with the path of each file
+    after all its entries were written.
+    Returns the number of imported entries and their total size in bytes.
+    """
     bucket = storage_client.bucket(BUCKET_NAME)
-    for file_path in log_files:
-        data = _read_logs(file_path, bucket)
-        for entry in data:
-            log = json.loads(entry)
-            _patch_entry(log, logging_client.project)
-            size = sys.getsizeof(log)
-            if total_size + size >= _LOGS_MAX_SIZE_BYTES:
-                _write_logs(logs, logging_client)
-                total_size, logs = 0, []
-            total_size += size
-            logs.append(log)
-    if logs:
-        _write_logs(logs, logging_client)
+    entries_queue = queue.Queue(maxsize=_PARSE_QUEUE_SIZE)
+    stop = threading.Event()
+    writes: deque = deque()
+    # files waiting for the write of the batch with the given index
+    # (the batch that was being filled when the file was fully read)
+    unconfirmed_files: deque = deque()
+    submitted_batches, written_batches = 0, 0
+    total_entries, total_bytes = 0, 0
+
+    def _on_parsed(future: Future) -> None:
+        # the future is the end-of-file marker for the batcher
+        _put(entries_queue, future, stop)
+
+    def _confirm_write() -> None:
+        nonlocal written_batches
+        writes.popleft().result()
+        written_batches += 1
+        while unconfirmed_files and unconfirmed_files[0][0] < written_batches:
+            path = unconfirmed_files.popleft()[1]
+            if on_file_imported:
+                on_file_imported(path)
+
+    def _submit_write(logs: List[dict]) -> None:
+        nonlocal submitted_batches
+        # bound the number of batches held in memory by in-flight writes
+        if len(writes) >= WRITE_WORKERS:
+            _confirm_write()
+        writes.append(write_pool.submit(_write_logs, logs, logging_client))
+        submitted_batches += 1
+
+    with ThreadPoolExecutor(
+        max_workers=DOWNLOAD_WORKERS
+    ) as download_pool, ThreadPoolExecutor(max_workers=WRITE_WORKERS) as write_pool:
+        try:
+            for file_path in log_files:
+                future = download_pool.submit(
+                    _parse_logs,
+                    file_path,
+                    bucket,
+                    logging_client.project,
+                    entries_queue,
+                    stop,
+                )
+                future.file_path = file_path
+                future.add_done_callback(_on_parsed)
+
+            total_size, logs = 0, []
+            pending_files = len(log_files)
+            while pending_files:
+                item = entries_queue.get()
+                if isinstance(item, Future):
+                    item.result()
+                    unconfirmed_files.append((submitted_batches, item.file_path))
+                    pending_files -= 1
+                    continue
+                for log, size in item:
+                    if total_size + size >= _LOGS_MAX_SIZE_BYTES and logs:
+                        _submit_write(logs)
+                        total_size, logs = 0, []
+                    total_size += size
+                    total_bytes += size
+                    logs.append(log)
+                total_entries += len(item)
+            if logs:
+                _submit_write(logs)
+            while writes:
+                _confirm_write()
+            # files without entries do not wait for any write
+            for _, path in unconfirmed_files:
+                if on_file_imported:
+                    on_file_imported(path)
+        except BaseException:
+            stop.set()
+            raise
+    return total_entries, total_bytes
 
 
 def main() -> None:
@@ -216,21 +367,43 @@ def main() -> None:
     if not _is_valid_import_range():
         sys.exit(1)
 
-    start_date, end_date = calc_import_range()
+    storage_client = storage.Client()
+    log_files = assign_log_files(list_log_files(START_DATE, END_DATE, storage_client))
+    checkpoint = Checkpoint(storage_client) if CHECKPOINT_BUCKET_NAME else None
+    if checkpoint and checkpoint.imported:
+        log_files = [f for f in log_files if f not in checkpoint.imported]
+        print(
+            f"Task #{(TASK_INDEX+1)} resumes after {len(checkpoint.imported)} imported files"
+        )
 
-    if start_date > end_date:
+    if not log_files:
         print(f"Task #{(TASK_INDEX+1)} has no work to do")
         sys.exit(0)
     print(
-        f"Task #{(TASK_INDEX+1)} starts importing logs from {start_date} to {end_date}"
+        f"Task #{(TASK_INDEX+1)} starts importing {len(log_files)} log files "
+        f"from {START_DATE} to {END_DATE}"
     )
 
-    storage_client = storage.Client()
-    log_files = list_log_files(start_date, end_date, storage_client)
     logging_client = (
         logging_v2.Client(project=PROJECT_ID) if PROJECT_ID else logging_v2.Client()
     )
-    import_logs(log_files, storage_client, logging_client)
+    started = time.monotonic()
+    try:
+        entries, size = import_logs(
+            log_files,
+            storage_client,
+            logging_client,
+            checkpoint.add if checkpoint else None,
+        )
+    finally:
+        if checkpoint:
+            checkpoint.save()
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(
+        f"Task #{(TASK_INDEX+1)} imported {entries} entries ({size} bytes) "
+        f"from {len(log_files)} files in {elapsed:.1f}s: "
+        f"{entries / elapsed:.1f} entries/s, {size / elapsed:.1f} bytes/s"
+    )
 
 
 # Start script
@@ -18,9 +18,9 @@
 # pylint: disable=too-many-return-statements
 
 from datetime import date, timedelta
+import io
 import json
 import os
-import sys
 from typing import List, Tuple, TypedDict
 from unittest import mock
 from unittest.mock import MagicMock
@@ -82,85 +82,6 @@ def test_import_range_validation(
     ), f"import range ({start_date} -> {end_date}) validation failed: expected {expected_validity} and got {isvalid}"
 
 
-@pytest.mark.parametrize(
-    "start_date, end_date, task_index, task_count, expected_first_day, expected_last_day",
-    [
-        (
-            date(2001, 1, 1),
-            date(2001, 1, 31),
-            0,
-            1,
-            date(2001, 1, 1),
-            date(2001, 1, 31),
-        ),
-        (
-            date(2001, 1, 1),
-            date(2001, 1, 10),
-            0,
-            20,
-            date(2001, 1, 1),
-            date(2001, 1, 2),
-        ),
-        (
-            date(2001, 1, 1),
-            date(2001, 1, 10),
-            12,
-            20,
-            date(2001, 1, 10),
-            date(2001, 1, 1),
-        ),
-        (
-            date(2001, 1, 10),
-            date(2001, 2, 1),
-            0,
-            2,
-            date(2001, 1, 10),
-            date(2001, 1, 21),
-        ),
-        (
-            date(2001, 1, 10),
-            date(2001, 2, 1),
-            1,
-            2,
-            date(2001, 1, 22),
-            date(2001, 2, 1),
-        ),
-        (date(2001, 5, 5), date(2002, 2, 2), 1, 2, date(2001, 9, 19), date(2002, 2, 2)),
-    ],
-    ids=[
-        "simple single range",
-        "more tasks than days",
-        "extra task when more tasks then days",
-        "two month range task 1",
-        "two month range task 2",
-        "multi year range",
-    ],
-)
-def test_calc_import_range(
-    start_date: str,
-    end_date: str,
-    task_index: int,
-    task_count: int,
-    expected_first_day: date,
-    expected_last_day: date,
-) -> None:
-    _setup_environment(
-        task_index=task_index,
-        task_count=task_count,
-        start_date=start_date,
-        end_date=end_date,
-    )
-
-    first_day, last_day = main.calc_import_range()
-
-    assert (
-        first_day == expected_first_day
-    ), f"first day is wrong: expected {expected_first_day} and got {first_day}"
-    assert (
-        last_day == expected_last_day
-    ), f"last day is wrong: expected {expected_last_day} and got {last_day}"
-
-
 TEST_FILES_JUN_2001 = [
     storage.Blob(name=f"{TEST_LOG_ID}/2001/06/01/file1.json", bucket=TEST_BUCKET),
     storage.Blob(name=f"{TEST_LOG_ID}/2001/06/01/file2.json", bucket=TEST_BUCKET),
@@ -220,30 +141,19 @@ TEST_FILES_MAR_2003 = [
 ]
 
 
+TEST_FILES = [
+    *TEST_FILES_JUN_2001,
+    *TEST_FILES_JUL_2001,
+    *TEST_FILES_AUG_2001,
+    *TEST_FILES_MAY_2002,
+    *TEST_FILES_JAN_2003,
+    *TEST_FILES_FEB_2003,
+    *TEST_FILES_MAR_2003,
+]
+
+
 def _args_based_list_blobs_return(*_args: str, **kwargs: TypedDict) -> List[str]:
-    if kwargs["prefix"] == f"{TEST_LOG_ID}/2001/06/":
-        print("TEST_FILES_JUN_2001")
-        return TEST_FILES_JUN_2001
-    elif kwargs["prefix"] == f"{TEST_LOG_ID}/2001/07/":
-        print("TEST_FILES_JUL_2001")
-        return TEST_FILES_JUL_2001
-    elif kwargs["prefix"] == f"{TEST_LOG_ID}/2001/08/":
-        print("TEST_FILES_AUG_2001")
-        return TEST_FILES_AUG_2001
-    elif kwargs["prefix"] == f"{TEST_LOG_ID}/2002/05/":
-        print("TEST_FILES_MAY_2002")
-        return TEST_FILES_MAY_2002
-    elif kwargs["prefix"] == f"{TEST_LOG_ID}/2003/01/":
-        print("TEST_FILES_JAN_2003")
-        return TEST_FILES_JAN_2003
-    elif kwargs["prefix"] == f"{TEST_LOG_ID}/2003/02/":
-        print("TEST_FILES_FEB_2003")
-        return TEST_FILES_FEB_2003
-    elif kwargs["prefix"] == f"{TEST_LOG_ID}/2003/03/":
-        print("TEST_FILES_MAR_2003")
-        return TEST_FILES_MAR_2003
-    else:
-        return []
+    return [f for f in TEST_FILES if f.name.startswith(kwargs["prefix"])]
 
 
 @pytest.mark.parametrize(
@@ -278,9 +188,72 @@ def test_list_log_files(first_day: str, last_day: str, expected_paths: List) ->
     mocked_client = MagicMock(spec=storage.Client)
     mocked_client.list_blobs = MagicMock(side_effect=_args_based_list_blobs_return)
 
-    paths = main.list_log_files(first_day, last_day, mocked_client)
+    files = main.list_log_files(first_day, last_day, mocked_client)
+
+    assert set(name for name, _ in files) == set(expected_paths)
+
+
+def test_list_log_files_prefixes() -> None:
+    _setup_environment()
+
+    mocked_client = MagicMock(spec=storage.Client)
+    mocked_client.list_blobs = MagicMock(side_effect=_args_based_list_blobs_return)
+
+    main.list_log_files(date(2001, 6, 29), date(2001, 8, 1), mocked_client)
 
-    assert set(paths) == set(expected_paths)
+    prefixes = [c.kwargs["prefix"] for c in mocked_client.list_blobs.call_args_list]
+    assert prefixes == [
+        f"{TEST_LOG_ID}/2001/06/29/",
+        f"{TEST_LOG_ID}/2001/06/30/",
+        f"{TEST_LOG_ID}/2001/07/",
+        f"{TEST_LOG_ID}/2001/08/01/",
+    ]
+
+
+TEST_SIZED_FILES = [
+    ("a.json", 100),
+    ("b.json", 70),
+    ("c.json", 40),
+    ("d.json", 30),
+    ("e.json", 30),
+    ("f.json", 0),
+]
+
+
+@pytest.mark.parametrize(
+    "task_count, expected_assignments",
+    [
+        (1, [[f for f, _ in TEST_SIZED_FILES]]),
+        (2, [["a.json", "d.json", "f.json"], ["b.json", "c.json", "e.json"]]),
+        (
+            3,
+            [["a.json"], ["b.json", "e.json"], ["c.json", "d.json", "f.json"]],
+        ),
+        (
+            8,
+            [
+                ["a.json"],
+                ["b.json"],
+                ["c.json"],
+                ["d.json"],
+                ["e.json"],
+                ["f.json"],
+                [],
+                [],
+            ],
+        ),
+    ],
+    ids=["single task", "two tasks", "three tasks", "more tasks than files"],
+)
+def test_assign_log_files(
+    task_count: int, expected_assignments: List[List[str]]
+) -> None:
+    assignments = []
+    for task_index in range(task_count):
+        _setup_environment(task_index=task_index, task_count=task_count)
+        assignments.append(main.assign_log_files(TEST_SIZED_FILES))
+
+    assert assignments == expected_assignments
 
 
 TEST_LOG_FILES = ["file1.json", "file2.json", "file3.json", "file4.json"]
@@ -291,13 +264,23 @@ TEST_CONTENT = {
          {"file": "3", "line": "3"}\n{"file": "3", "line": "4"}',
     "file4.json": '{"file": "4", "line": "1"}',
 }
-# note that all log entries are of same size (expected 184 bytes)
-TEST_LOG_SIZE = sys.getsizeof(json.loads(TEST_CONTENT["file4.json"]))
+# note that all patched log entries are of same encoded size
+TEST_LOG_SIZE = len(
+    json.dumps(
+        {
+            **json.loads(TEST_CONTENT["file4.json"]),
+            "logName": f"projects/{TEST_PROJECT_ID}/logs/imported_logs",
+            "labels": {"original_logName": None},
+        }
+    )
+)
 
 
 def _args_based_blob_return(*args: Tuple, **_kwargs: TypedDict) -> str:
     mocked_blob = MagicMock(spec=storage.Blob)
-    mocked_blob.download_as_string = MagicMock(return_value=TEST_CONTENT.get(args[0]))
+    mocked_blob.open = MagicMock(
+        return_value=io.BytesIO(TEST_CONTENT.get(args[0]).encode())
+    )
     return mocked_blob
 
 
@@ -305,7 +288,7 @@ def _calc_args_size(*args: Tuple) -> int:
     size = 0
     if args and args[0] and isinstance(args[0][0], list):
         for arg in args[0][0]:
-            size += sys.getsizeof(arg)
+            size += len(json.dumps(arg))
     return size
 
 
@@ -343,7 +326,11 @@ def test_import_logs(
     mocked_logging_client.project = TEST_PROJECT_ID
     mocked_write_entries = mocked_logging_client.logging_api.write_entries = MagicMock()
 
-    main.import_logs(log_files, mocked_storage_client, mocked_logging_client)
+    on_file_imported = MagicMock()
+
+    entries, size = main.import_logs(
+        log_files, mocked_storage_client, mocked_logging_client, on_file_imported
+    )
 
     assert mocked_bucket.blob.call_count == len(
         log_files
@@ -351,12 +338,47 @@ def test_import_logs(
     assert len(mocked_write_entries.call_args_list) == len(
         expected_writes
     ), f"expected {len(expected_writes)} writes, got {len(mocked_write_entries.call_args_list)}"
-    for write_call, expected_size in zip(
-        mocked_write_entries.call_args_list, expected_writes
-    ):
-        assert (
-            _calc_args_size(write_call.args) == expected_size
-        ), f"expected write size {expected_size}, got {_calc_args_size(write_call.args)}"
+    # files are read and batches are written concurrently so the order may vary
+    write_sizes = sorted(
+        _calc_args_size(write_call.args)
+        for write_call in mocked_write_entries.call_args_list
+    )
+    assert write_sizes == sorted(
+        expected_writes
+    ), f"expected write sizes {expected_writes}, got {write_sizes}"
+    assert entries * TEST_LOG_SIZE == size == sum(expected_writes)
+    assert sorted(c.args[0] for c in on_file_imported.call_args_list) == sorted(
+        log_files
+    )
+
+
+def test_checkpoint(monkeypatch: pytest.MonkeyPatch) -> None:
+    _setup_environment(
+        task_index=1,
+        task_count=4,
+        start_date=date(2001, 6, 1),
+        end_date=date(2001, 6, 3),
+    )
+    monkeypatch.setattr(main, "CHECKPOINT_BUCKET_NAME", TEST_BUCKET)
+    mocked_storage_client = MagicMock(spec=storage.Client)
+    mocked_bucket = MagicMock(spec=storage.Bucket)
+    mocked_storage_client.bucket = MagicMock(return_value=mocked_bucket)
+    mocked_blob = MagicMock(spec=storage.Blob)
+    mocked_bucket.blob = MagicMock(return_value=mocked_blob)
+    mocked_blob.download_as_bytes = MagicMock(return_value=b'["file1.json"]')
+
+    checkpoint = main.Checkpoint(mocked_storage_client)
+    checkpoint.add("file2.json")
+    checkpoint.save()
+
+    mocked_bucket.blob.assert_called_once_with(
+        f"import-logs-checkpoints/{TEST_LOG_ID}/20010601-20010603/task-0001-of-0004.json"
+    )
+    assert checkpoint.imported == {"file1.json", "file2.json"}
+    assert json.loads(mocked_blob.upload_from_string.call_args.args[0]) == [
+        "file1.json",
+        "file2.json",
+    ]
 
 
 TEST_DATE_STR = "08/12/2023"
@@ -16,22 +16,31 @@
 from __future__ import annotations
 
 import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
 import logging
+import random
+import sys
+import threading
+import time
 
 from apache_beam import (
-    CombineFn,
-    CombineGlobally,
     DoFn,
+    GroupIntoBatches,
     io,
     ParDo,
     Pipeline,
     WindowInto,
+    WithKeys,
 )
 from apache_beam.error import PipelineError
+from apache_beam.metrics import Metrics
 from apache_beam.options.pipeline_options import GoogleCloudOptions, PipelineOptions
 from apache_beam.transforms.window import FixedWindows
 
+from google.api_core import exceptions, retry
 from google.cloud import dlp_v2, logging_v2
 
 
@@ -53,39 +62,133 @@ REDACTION_CFG = {
     }
 }
 
+# DLP limits the size of content in a single request to 0.5MB. For details, please see
+# https://cloud.google.com/dlp/limits#content-redaction-limits
+MAX_REQUEST_BYTES = 500 * 1000
+
+# Retry DLP calls that failed due to throttling or transient errors
+DLP_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(
+        exceptions.ResourceExhausted,
+        exceptions.ServiceUnavailable,
+        exceptions.DeadlineExceeded,
+    ),
+    initial=1.0,
+    maximum=60.0,
+    multiplier=2.0,
+    deadline=600,
+)
 
-class PayloadAsJson(DoFn):
-    """Convert PubSub message payload to UTF-8 and return as JSON"""
-
-    def process(self, element):
-        yield json.loads(element.decode("utf-8"))
 
+# Fingerprint of the configurations that the redacted payload depends on
+CONFIG_FINGERPRINT = hashlib.sha256(
+    json.dumps([INSPECT_CFG, REDACTION_CFG], sort_keys=True).encode("utf-8")
+).digest()
+
+# Redaction caches shared by all DoFn instances of the worker process
+_REDACTION_CACHES = {}
+_REDACTION_CACHES_LOCK = threading.Lock()
+
+
+class RedactionCache:
+    """LRU cache of redacted payloads bounded by memory and entry age"""
+
+    def __init__(self, max_bytes: int, ttl_secs: float):
+        self.max_bytes = max_bytes
+        self.ttl_secs = ttl_secs
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(payload: str) -> bytes:
+        return hashlib.sha256(CONFIG_FINGERPRINT + payload.encode("utf-8")).digest()
+
+    @staticmethod
+    def _entry_size(key: bytes, value: str) -> int:
+        return sys.getsizeof(key) + sys.getsizeof(value)
+
+    def _evict(self, key: bytes) -> None:
+        value, _ = self._entries.pop(key)
+        self.size_bytes -= self._entry_size(key, value)
+
+    def get(self, key: bytes):
+        """Return the redacted payload or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                self._evict(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: bytes, value: str) -> None:
+        size = self._entry_size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl_secs)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                self._evict(next(iter(self._entries)))
 
-class BatchPayloads(CombineFn):
-    """Collect all items in the windowed collection into single batch"""
 
-    def create_accumulator(self):
-        return []
+def _get_redaction_cache(max_bytes: int, ttl_secs: float) -> RedactionCache:
+    # the lock makes concurrent DoFn setups share one cache
+    with _REDACTION_CACHES_LOCK:
+        key = (max_bytes, ttl_secs)
+        if key not in _REDACTION_CACHES:
+            _REDACTION_CACHES[key] = RedactionCache(max_bytes, ttl_secs)
+        return _REDACTION_CACHES[key]
 
-    def add_input(self, accumulator, input):
-        accumulator.append(input)
-        return accumulator
 
-    def merge_accumulators(self, accumulators):
-        merged = [item for accumulator in accumulators for item in accumulator]
-        return merged
+class PayloadAsJson(DoFn):
+    """Convert PubSub message payload to UTF-8 and return as JSON"""
 
-    def extract_output(self, accumulator):
-        return accumulator
+    def process(self, element):
+        yield json.loads(element.decode("utf-8"))
 
 
 class LogRedaction(DoFn):
-    """Apply inspection and redaction to textPayload field of log entries"""
-
-    def __init__(self, region, project_id: str):
+    """Apply inspection and redaction to textPayload field of log entries
+
+    Each batch of log entries is split into DLP requests of at most
+    max_request_rows rows and max_request_bytes bytes of payload.
+    The requests are sent concurrently using a pool of dlp_concurrency threads.
+    If cache_max_bytes is set, redacted payloads are cached per worker so
+    that repeated payloads are redacted without calling DLP.
+    """
+
+    def __init__(
+        self,
+        region,
+        project_id: str,
+        max_request_rows: int,
+        max_request_bytes: int = MAX_REQUEST_BYTES,
+        dlp_concurrency: int = 4,
+        cache_max_bytes: int = 0,
+        cache_ttl_secs: float = 3600,
+    ):
         self.project_id = project_id
         self.region = region
+        self.max_request_rows = max_request_rows
+        self.max_request_bytes = max_request_bytes
+        self.dlp_concurrency = dlp_concurrency
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_ttl_secs = cache_ttl_secs
         self.dlp_client = None
+        self.executor = None
+        self.cache = None
+        self.dlp_latency = Metrics.distribution(self.__class__, "dlp_latency_ms")
+        self.request_rows = Metrics.distribution(self.__class__, "dlp_request_rows")
+        self.redacted_rows = Metrics.counter(self.__class__, "redacted_rows")
+        self.cache_hits = Metrics.counter(self.__class__, "cache_hits")
+        self.cache_misses = Metrics.counter(self.__class__, "cache_misses")
 
     def _log_to_row(self, entry):
         # Make `Row` from `textPayload`. For more details on the row, please see
@@ -93,16 +196,23 @@ class LogRedaction(DoFn):
         payload = entry.get("textPayload", "")
         return {"values": [{"string_value": payload}]}
 
-    def setup(self):
-        """Initialize DLP client"""
-        if self.dlp_client:
-            return
-        self.dlp_client = dlp_v2.DlpServiceClient()
-        if not self.dlp_client:
-            logging.error("Cannot create Google DLP Client")
-            raise PipelineError("Cannot create Google DLP Client")
-
-    def process(self, logs):
+    def _split(self, logs):
+        # Split logs into chunks that fit into a single DLP request
+        chunk, chunk_bytes = [], 0
+        for log in logs:
+            size = len(log.get("textPayload", "").encode("utf-8"))
+            if chunk and (
+                len(chunk) >= self.max_request_rows
+                or chunk_bytes + size > self.max_request_bytes
+            ):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(log)
+            chunk_bytes += size
+        if chunk:
+            yield chunk
+
+    def _redact(self, logs):
         # Construct the `table`. For more details on the table schema, please see
         # https://cloud.google.com/dlp/docs/reference/rest/v2/ContentItem#Table
         table = {
@@ -112,25 +222,88 @@ class LogRedaction(DoFn):
             }
         }
 
+        start = time.monotonic()
         response = self.dlp_client.deidentify_content(
             request={
                 "parent": f"projects/{self.project_id}/locations/{self.region}",
                 "inspect_config": INSPECT_CFG,
                 "deidentify_config": REDACTION_CFG,
                 "item": table,
-            }
+            },
+            retry=DLP_RETRY,
         )
+        latency_ms = int((time.monotonic() - start) * 1000)
 
         # replace payload with redacted version
-        modified_logs = []
         for index, log in enumerate(logs):
             log["textPayload"] = response.item.table.rows[index].values[0].string_value
             # you may consider changing insert ID if the project already has a copy
             # of this log (e.g. log['insertId'] = 'deid-' + log['insertId'])
             # For more details about insert ID, please see:
             # https://cloud.google.com/logging/docs/reference/v2/rest/v2/LogEntry#FIELDS.insert_id
-            modified_logs.append(log)
-        yield modified_logs
+        return logs, latency_ms
+
+    def setup(self):
+        """Initialize DLP client and the pool of DLP calls"""
+        if self.dlp_client:
+            return
+        self.dlp_client = dlp_v2.DlpServiceClient()
+        if not self.dlp_client:
+            logging.error("Cannot create Google DLP Client")
+            raise PipelineError("Cannot create Google DLP Client")
+        self.executor = ThreadPoolExecutor(max_workers=self.dlp_concurrency)
+        if self.cache_max_bytes > 0:
+            self.cache = _get_redaction_cache(self.cache_max_bytes, self.cache_ttl_secs)
+
+    def teardown(self):
+        if self.executor:
+            self.executor.shutdown()
+
+    def _redact_all(self, logs):
+        # the pool bounds the number of concurrent DLP calls
+        for modified_logs, latency_ms in self.executor.map(
+            self._redact, self._split(logs)
+        ):
+            # Beam metrics are updated in the bundle's thread
+            self.dlp_latency.update(latency_ms)
+            self.request_rows.update(len(modified_logs))
+            self.redacted_rows.inc(len(modified_logs))
+            yield modified_logs
+
+    def process(self, element):
+        _, logs = element
+        if not self.cache:
+            yield from self._redact_all(logs)
+            return
+
+        # group cache misses by the payload to redact each payload only once
+        hits, misses, miss_count = [], OrderedDict(), 0
+        for log in logs:
+            key = self.cache.key(log.get("textPayload", ""))
+            redacted = self.cache.get(key)
+            if redacted is None:
+                misses.setdefault(key, []).append(log)
+                miss_count += 1
+            else:
+                log["textPayload"] = redacted
+                hits.append(log)
+        self.cache_hits.inc(len(hits))
+        self.cache_misses.inc(miss_count)
+        if hits:
+            yield hits
+
+        keys = {id(same_logs[0]): key for key, same_logs in misses.items()}
+        for modified_logs in self._redact_all(
+            [same_logs[0] for same_logs in misses.values()]
+        ):
+            duplicates = []
+            for log in modified_logs:
+                key = keys[id(log)]
+                self.cache.put(key, log["textPayload"])
+                for duplicate in misses[key][1:]:
+                    duplicate["textPayload"] = log["textPayload"]
+                    duplicates.append(duplicate)
+            yield modified_logs + duplicates
 
 
 class IngestLogs(DoFn):
@@ -139,6 +312,8 @@ class IngestLogs(DoFn):
     def __init__(self, destination_log_name):
         self.destination_log_name = destination_log_name
         self.logger = None
+        self.write_latency = Metrics.distribution(self.__class__, "write_latency_ms")
+        self.ingested_rows = Metrics.counter(self.__class__, "ingested_rows")
 
     def _replace_log_name(self, entry):
         # updates log name in the entry to logger name
@@ -162,7 +337,10 @@ class IngestLogs(DoFn):
     def process(self, element):
         if self.logger:
             logs = list(map(self._replace_log_name, element))
+            start = time.monotonic()
             self.logger.client.logging_api.write_entries(logs)
+            self.write_latency.update(int((time.monotonic() - start) * 1000))
+            self.ingested_rows.inc(len(logs))
         yield logs
 
 
@@ -170,6 +348,11 @@ def run(
     pubsub_subscription: str,
     destination_log_name: str,
     window_size: float,
+    num_shards: int = 5,
+    max_request_rows: int = 1000,
+    dlp_concurrency: int = 4,
+    cache_max_bytes: int = 0,
+    cache_ttl_secs: float = 3600,
     pipeline_args: list[str] = None,
 ) -> None:
     """Runs Dataflow pipeline"""
@@ -192,12 +375,28 @@ def run(
         | "Convert log entry payload to Json" >> ParDo(PayloadAsJson())
         | "Aggregate payloads in fixed time intervals"
         >> WindowInto(FixedWindows(window_size))
+        # Distribute payloads between shards to redact them on many workers
+        | "Assign payloads to shards"
+        >> WithKeys(lambda _: random.randint(0, num_shards - 1))
         # Optimize Google API consumption and avoid possible throttling
-        # by calling APIs for batched data and not per each element
-        | "Batch aggregated payloads"
-        >> CombineGlobally(BatchPayloads()).without_defaults()
+        # by calling APIs for batched data and not per each element.
+        # Each batch is large enough to fill dlp_concurrency DLP requests.
+        | "Batch sharded payloads"
+        >> GroupIntoBatches(
+            max_request_rows * dlp_concurrency,
+            max_buffering_duration_secs=window_size,
+        )
         | "Redact SSN info from logs"
-        >> ParDo(LogRedaction(region, destination_log_name.split("/")[1]))
+        >> ParDo(
+            LogRedaction(
+                region,
+                destination_log_name.split("/")[1],
+                max_request_rows,
+                dlp_concurrency=dlp_concurrency,
+                cache_max_bytes=cache_max_bytes,
+                cache_ttl_secs=cache_ttl_secs,
+            )
+        )
         | "Ingest to output log" >> ParDo(IngestLogs(destination_log_name))
     )
     pipeline.run()
@@ -223,11 +422,47 @@ if __name__ == "__main__":
         default=60.0,
         help="Output file's window size in seconds.",
     )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=5,
+        help="Number of shards to redact log entries in parallel.",
+    )
+    parser.add_argument(
+        "--max_request_rows",
+        type=int,
+        default=1000,
+        help="Max number of log entries in a single DLP request.",
+    )
+    parser.add_argument(
+        "--dlp_concurrency",
+        type=int,
+        default=4,
+        help="Number of concurrent DLP requests per worker.",
+    )
+    parser.add_argument(
+        "--cache_max_bytes",
+        type=int,
+        default=0,
+        help="Max memory in bytes of the per-worker cache of redacted payloads. "
+        "Set to 0 to disable the cache.",
+    )
+    parser.add_argument(
+        "--cache_ttl_secs",
+        type=float,
+        default=3600,
+        help="Time in seconds to keep redacted payloads in the cache.",
+    )
     known_args, pipeline_args = parser.parse_known_args()
 
     run(
         known_args.pubsub_subscription,
         known_args.destination_log_name,
         known_args.window_size,
+        known_args.num_shards,
+        known_args.max_request_rows,
+        known_args.dlp_concurrency,
+        known_args.cache_max_bytes,
+        known_args.cache_ttl_secs,
         pipeline_args,
     )
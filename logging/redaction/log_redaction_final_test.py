@@ -0,0 +1,187 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+import log_redaction_final
+from log_redaction_final import LogRedaction, RedactionCache
+
+
+def _entry_size(payload: str) -> int:
+    return RedactionCache._entry_size(RedactionCache.key(payload), payload)
+
+
+def test_cache_evicts_least_recently_used() -> None:
+    cache = RedactionCache(max_bytes=2 * _entry_size("a"), ttl_secs=60)
+    key_a, key_b, key_c = (RedactionCache.key(p) for p in "abc")
+    cache.put(key_a, "a")
+    cache.put(key_b, "b")
+    # reading "a" makes "b" the least recently used entry
+    assert cache.get(key_a) == "a"
+
+    cache.put(key_c, "c")
+
+    assert cache.get(key_b) is None
+    assert cache.get(key_a) == "a"
+    assert cache.get(key_c) == "c"
+    assert cache.size_bytes == 2 * _entry_size("a")
+
+
+def test_cache_skips_values_larger_than_max_bytes() -> None:
+    cache = RedactionCache(max_bytes=_entry_size("a"), ttl_secs=60)
+    key = RedactionCache.key("too large")
+
+    cache.put(key, "too large")
+
+    assert cache.get(key) is None
+    assert cache.size_bytes == 0
+
+
+def test_cache_expires_entries(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(log_redaction_final.time, "monotonic", lambda: now)
+    cache = RedactionCache(max_bytes=1000, ttl_secs=60)
+    key = RedactionCache.key("a")
+    cache.put(key, "a")
+
+    now += 59
+    assert cache.get(key) == "a"
+    now += 2
+    assert cache.get(key) is None
+    assert cache.size_bytes == 0
+
+
+def test_cache_hits_and_misses_are_counted_per_entry() -> None:
+    redaction = LogRedaction("us-central1", "test-project", max_request_rows=10)
+    redaction.cache = RedactionCache(max_bytes=10000, ttl_secs=60)
+    redaction.executor = ThreadPoolExecutor(max_workers=1)
+    redaction.cache_hits = MagicMock()
+    redaction.cache_misses = MagicMock()
+    redacted_payloads = []
+
+    def redact(logs: list) -> tuple:
+        redacted_payloads.extend(log["textPayload"] for log in logs)
+        for log in logs:
+            log["textPayload"] = log["textPayload"].upper()
+        return logs, 0
+
+    redaction._redact = redact
+    redaction.cache.put(RedactionCache.key("cached"), "CACHED")
+    logs = [{"textPayload": p} for p in ["cached", "new", "new", "other"]]
+
+    output = [log for batch in redaction.process((0, logs)) for log in batch]
+    redaction.teardown()
+
+    redaction.cache_hits.inc.assert_called_once_with(1)
+    redaction.cache_misses.inc.assert_called_once_with(3)
+    # duplicate payloads are sent to DLP only once
+    assert redacted_payloads == ["new", "other"]
+    assert sorted(log["textPayload"] for log in output) == [
+        "CACHED",
+        "NEW",
+        "NEW",
+        "OTHER",
+    ]
+    assert redaction.cache.get(RedactionCache.key("new")) == "NEW"
+
+
+def test_get_redaction_cache_is_shared() -> None:
+    cache = log_redaction_final._get_redaction_cache(1000, 60)
+
+    assert log_redaction_final._get_redaction_cache(1000, 60) is cache
+    assert log_redaction_final._get_redaction_cache(2000, 60) is not cache
+
+
+def _payloads(chunks: list) -> list:
+    return [[log["textPayload"] for log in chunk] for chunk in chunks]
+
+
+def _split(payloads: list, max_request_rows: int, max_request_bytes: int) -> list:
+    redaction = LogRedaction(
+        "us-central1", "test-project", max_request_rows, max_request_bytes
+    )
+    return _payloads(redaction._split([{"textPayload": p} for p in payloads]))
+
+
+def test_split_caps_rows() -> None:
+    assert _split(list("abcde"), max_request_rows=2, max_request_bytes=100) == [
+        ["a", "b"],
+        ["c", "d"],
+        ["e"],
+    ]
+
+
+def test_split_caps_bytes() -> None:
+    payloads = ["aaaa", "bbbb", "cccc", "dddd", "eeee"]
+    assert _split(payloads, max_request_rows=10, max_request_bytes=10) == [
+        ["aaaa", "bbbb"],
+        ["cccc", "dddd"],
+        ["eeee"],
+    ]
+
+
+def test_split_payload_larger_than_max_bytes() -> None:
+    payloads = ["a", "x" * 50, "b"]
+    assert _split(payloads, max_request_rows=10, max_request_bytes=10) == [
+        ["a"],
+        ["x" * 50],
+        ["b"],
+    ]
+
+
+def test_split_counts_utf8_bytes() -> None:
+    # each payload is 2 characters, but 4 bytes
+    payloads = ["éé", "üü", "ññ"]
+    assert _split(payloads, max_request_rows=10, max_request_bytes=8) == [
+        ["éé", "üü"],
+        ["ññ"],
+    ]
+
+
+def test_redact_all_keeps_order() -> None:
+    redaction = LogRedaction("us-central1", "test-project", max_request_rows=2)
+    redaction.executor = ThreadPoolExecutor(max_workers=3)
+
+    def deidentify_content(request: dict, retry: object) -> SimpleNamespace:
+        payloads = [
+            row["values"][0]["string_value"] for row in request["item"]["table"]["rows"]
+        ]
+        if payloads[0] == "log 0":
+            # the first request finishes last
+            time.sleep(0.1)
+        rows = [
+            SimpleNamespace(values=[SimpleNamespace(string_value=p.upper())])
+            for p in payloads
+        ]
+        return SimpleNamespace(item=SimpleNamespace(table=SimpleNamespace(rows=rows)))
+
+    redaction.dlp_client = MagicMock()
+    redaction.dlp_client.deidentify_content.side_effect = deidentify_content
+    logs = [{"textPayload": f"log {i}"} for i in range(7)]
+
+    chunks = list(redaction._redact_all(logs))
+    redaction.teardown()
+
+    assert _payloads(chunks) == [
+        ["LOG 0", "LOG 1"],
+        ["LOG 2", "LOG 3"],
+        ["LOG 4", "LOG 5"],
+        ["LOG 6"],
+    ]
+    assert redaction.dlp_client.deidentify_content.call_count == 4
@@ -26,8 +26,10 @@ The land cover labels for the training dataset come from the ESA WorldCover.
 from __future__ import annotations
 
 from collections.abc import Iterable
+import functools
 
 import apache_beam as beam
+from apache_beam.metrics import Metrics
 from apache_beam.options.pipeline_options import PipelineOptions
 import ee
 import numpy as np
@@ -39,6 +41,7 @@ from serving import data
 POINTS_PER_CLASS = 100
 PATCH_SIZE = 128
 MAX_REQUESTS = 20  # default EE request quota
+REQUESTS_PER_SECOND = 20.0  # default EE download rate for all the workers
 
 # Simplified polygons covering most land areas in the world.
 WORLD_POLYGONS = [
@@ -93,30 +96,52 @@ def sample_points(
         yield point["geometry"]["coordinates"]
 
 
+def report_response(latency: float, status_code: int) -> None:
+    """Exports the latency and status of an Earth Engine request as Beam metrics."""
+    Metrics.counter("earth_engine", "requests").inc()
+    if status_code == 429:
+        Metrics.counter("earth_engine", "too_many_requests").inc()
+    Metrics.distribution("earth_engine", "request_latency_ms").update(
+        int(latency * 1000)
+    )
+
+
+@functools.cache
+def get_fetch_client(requests_per_second: float) -> data.FetchClient:
+    """Gets a client shared by all the bundles of a worker process."""
+    return data.FetchClient(requests_per_second, on_response=report_response)
+
+
 def get_training_example(
-    lonlat: tuple[float, float], patch_size: int = PATCH_SIZE
+    lonlat: tuple[float, float],
+    patch_size: int = PATCH_SIZE,
+    requests_per_second: float = data.REQUESTS_PER_SECOND,
 ) -> tuple[np.ndarray, np.ndarray]:
     """Gets an (inputs, labels) training example for year 2020.
 
     Args:
         lonlat: A (longitude, latitude) pair for the point of interest.
         patch_size: Size in pixels of the surrounding square patch.
+        requests_per_second: Limit of Earth Engine downloads per second for this worker.
 
     Returns: An (inputs, labels) pair of NumPy arrays.
     """
     data.ee_init()
+    client = get_fetch_client(requests_per_second)
     return (
-        data.get_input_patch(2020, lonlat, patch_size),
-        data.get_label_patch(lonlat, patch_size),
+        data.get_input_patch(2020, lonlat, patch_size, client),
+        data.get_label_patch(lonlat, patch_size, client),
     )
 
 
 def try_get_example(
-    lonlat: tuple[float, float], patch_size: int = PATCH_SIZE
+    lonlat: tuple[float, float],
+    patch_size: int = PATCH_SIZE,
+    requests_per_second: float = data.REQUESTS_PER_SECOND,
 ) -> Iterable[tuple[np.ndarray, np.ndarray]]:
     """Wrapper over `get_training_examples` that allows it to simply log errors instead of crashing."""
     try:
-        yield get_training_example(lonlat, patch_size)
+        yield get_training_example(lonlat, patch_size, requests_per_second)
     except requests.exceptions.HTTPError as e:
         logging.exception(e)
 
@@ -150,6 +175,7 @@ def run_tensorflow(
     points_per_class: int = POINTS_PER_CLASS,
     patch_size: int = PATCH_SIZE,
     max_requests: int = MAX_REQUESTS,
+    requests_per_second: float = REQUESTS_PER_SECOND,
     polygons: list[list[tuple[float, float]]] = WORLD_POLYGONS,
     beam_args: list[str] | None = None,
 ) -> None:
@@ -158,17 +184,21 @@ def run_tensorflow(
     This fetches data from Earth Engine and creates a TFRecords dataset.
     We use `max_requests` to limit the number of concurrent requests to Earth Engine
     to avoid quota issues. You can request for an increas of quota if you need it.
+    The `requests_per_second` rate is split evenly between the workers.
 
     Args:
         data_path: Directory path to save the TFRecord files.
         points_per_class: Number of points to get for each classification.
         patch_size: Size in pixels of the surrounding square patch.
         max_requests: Limit the number of concurrent requests to Earth Engine.
+        requests_per_second: Limit of Earth Engine downloads per second.
         polygons: List of polygons to pick points from.
         beam_args: Apache Beam command line arguments to parse as pipeline options.
     """
     # Equally divide the number of points by the number of concurrent requests.
     num_points = max(int(points_per_class / max_requests), 1)
+    # There is at most one worker per concurrent request.
+    worker_requests_per_second = requests_per_second / max_requests
 
     beam_options = PipelineOptions(
         beam_args,
@@ -184,7 +214,8 @@ def run_tensorflow(
             | "🌱 Make seeds" >> beam.Create(range(max_requests))
             | "📌 Sample points" >> beam.FlatMap(sample_points, polygons, num_points)
             | "🃏 Reshuffle" >> beam.Reshuffle()
-            | "📑 Get examples" >> beam.FlatMap(try_get_example, patch_size)
+            | "📑 Get examples"
+            >> beam.FlatMap(try_get_example, patch_size, worker_requests_per_second)
             | "✍🏽 Serialize" >> beam.MapTuple(serialize_tensorflow)
             | "📚 Write TFRecords"
             >> beam.io.WriteToTFRecord(
@@ -224,6 +255,12 @@ if __name__ == "__main__":
         type=int,
         help="Limit the number of concurrent requests to Earth Engine.",
     )
+    parser.add_argument(
+        "--requests-per-second",
+        default=REQUESTS_PER_SECOND,
+        type=float,
+        help="Limit of Earth Engine downloads per second for all the workers.",
+    )
     args, beam_args = parser.parse_known_args()
 
     if args.framework == "tensorflow":
@@ -232,6 +269,7 @@ if __name__ == "__main__":
             points_per_class=args.points_per_class,
             patch_size=args.patch_size,
             max_requests=args.max_requests,
+            requests_per_second=args.requests_per_second,
             beam_args=beam_args,
         )
     else:
@@ -0,0 +1,134 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import io
+from types import SimpleNamespace
+from unittest import mock
+
+from google.api_core.retry import retry_base, retry_unary
+import numpy as np
+import pytest
+import requests
+
+from serving import data
+
+
+class FakeClock:
+    """Fakes `time.monotonic` and `time.sleep`, so nothing really waits."""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps: list[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    clock = FakeClock()
+    fake_time = SimpleNamespace(monotonic=clock.monotonic, sleep=clock.sleep)
+    # Only the rate limiter and the retries see the fake time, not all of `time`.
+    for module in [data, retry_base, retry_unary]:
+        monkeypatch.setattr(module, "time", fake_time)
+    return clock
+
+
+def make_response(status_code: int) -> mock.Mock:
+    pixels = np.zeros((2, 2), dtype=[("B1", np.float32), ("B2", np.float32)])
+    buffer = io.BytesIO()
+    np.save(buffer, pixels)
+    response = mock.Mock(status_code=status_code, content=buffer.getvalue())
+    if status_code >= 400:
+        response.raise_for_status.side_effect = requests.exceptions.HTTPError(
+            f"{status_code} error"
+        )
+    return response
+
+
+def make_client(status_codes: list[int]) -> data.FetchClient:
+    client = data.FetchClient(requests_per_second=100.0, on_response=mock.Mock())
+    client.session = mock.Mock()
+    client.session.get.side_effect = [make_response(code) for code in status_codes]
+    return client
+
+
+def test_token_bucket_allows_bursts_up_to_capacity(clock: FakeClock) -> None:
+    bucket = data.TokenBucket(rate=2.0, capacity=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    # Once the burst is spent, requests are spaced at the rate.
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == [0.5, 0.5]
+
+    # Tokens refill while idle, but only up to the capacity.
+    clock.now += 60
+    for _ in range(3):
+        bucket.acquire()
+    assert len(clock.sleeps) == 2
+    bucket.acquire()
+    assert clock.sleeps[2:] == [0.5]
+
+
+def test_get_pixels_retries_too_many_requests(clock: FakeClock) -> None:
+    client = make_client([429, 429, 200])
+    client.rate_limiter = mock.Mock(wraps=client.rate_limiter)
+    image = mock.Mock()
+    image.getDownloadURL.return_value = "https://earthengine.googleapis.com/pixels"
+
+    pixels = client.get_pixels(image, {"format": "NPY"})
+
+    assert pixels.shape == (2, 2)
+    assert pixels.dtype.names == ("B1", "B2")
+    assert client.session.get.call_count == 3
+    # Every attempt, including the retries, waits for the rate limiter.
+    assert client.rate_limiter.acquire.call_count == 3
+    # The backoff waits a random time of up to 1 second, then up to 2 seconds.
+    (first, second) = clock.sleeps
+    assert 0 <= first <= 1.0
+    assert 0 <= second <= 2.0
+
+
+def test_get_pixels_does_not_retry_other_errors(clock: FakeClock) -> None:
+    client = make_client([500])
+    image = mock.Mock()
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get_pixels(image, {"format": "NPY"})
+    assert client.session.get.call_count == 1
+    assert client.stats()["too_many_requests"] == 0
+
+
+def test_stats_count_too_many_requests(clock: FakeClock) -> None:
+    client = make_client([429, 200, 429, 200])
+    image = mock.Mock()
+
+    client.get_pixels(image, {"format": "NPY"})
+    client.get_pixels(image, {"format": "NPY"})
+
+    status_codes = [c.args[1] for c in client.on_response.call_args_list]
+    assert status_codes == [429, 200, 429, 200]
+    stats = client.stats()
+    assert stats["requests"] == 4
+    assert stats["too_many_requests"] == 2
+    assert stats["too_many_requests_rate"] == 0.5
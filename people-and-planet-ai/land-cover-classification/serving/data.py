@@ -20,7 +20,12 @@ trained on exactly the same data that will be used for predictions.
 
 from __future__ import annotations
 
+from collections.abc import Callable
+import functools
 import io
+import os
+import threading
+import time
 
 import ee
 from google.api_core import exceptions, retry
@@ -28,9 +33,12 @@ import google.auth
 import numpy as np
 from numpy.lib.recfunctions import structured_to_unstructured
 import requests
+from requests.adapters import HTTPAdapter
 
 
 SCALE = 10  # meters per pixel
+REQUESTS_PER_SECOND = 10.0  # default Earth Engine download rate per process
+MAX_CONNECTIONS = 16  # HTTP connections kept open per process
 
 
 def ee_init() -> None:
@@ -50,6 +58,7 @@ def ee_init() -> None:
     )
 
 
+@functools.cache
 def get_input_image(year: int) -> ee.Image:
     """Get a Sentinel-2 Earth Engine image.
 
@@ -57,6 +66,7 @@ def get_input_image(year: int) -> ee.Image:
     Then it removes the mask and fills all the missing values, otherwise
     the data normalization will give infinities and not-a-number.
     Missing values on Sentinel 2 are filled with 1000, which is near the mean.
+    The image is memoized, so the composite is only built once for every year.
 
     For more information, see:
         https://developers.google.com/earth-engine/datasets/catalog/COPERNICUS_S2_HARMONIZED
@@ -86,6 +96,7 @@ def get_input_image(year: int) -> ee.Image:
     )
 
 
+@functools.cache
 def get_label_image() -> ee.Image:
     """Get the European Space Agency WorldCover image.
 
@@ -112,7 +123,10 @@ def get_label_image() -> ee.Image:
 
 
 def get_input_patch(
-    year: int, lonlat: tuple[float, float], patch_size: int
+    year: int,
+    lonlat: tuple[float, float],
+    patch_size: int,
+    client: FetchClient | None = None,
 ) -> np.ndarray:
     """Gets the inputs patch of pixels for the given point and year.
 
@@ -120,15 +134,20 @@ def get_input_patch(
         year: Year of interest, a median composite is used.
         lonlat: A (longitude, latitude) pair for the point of interest.
         patch_size: Size in pixels of the surrounding square patch.
+        client: Client to fetch the patch with, `get_fetch_client()` by default.
 
     Returns: The pixel values of an inputs patch as a NumPy array.
     """
     image = get_input_image(year)
-    patch = get_patch(image, lonlat, patch_size, SCALE)
+    patch = get_patch(image, lonlat, patch_size, SCALE, client)
     return structured_to_unstructured(patch)
 
 
-def get_label_patch(lonlat: tuple[float, float], patch_size: int) -> np.ndarray:
+def get_label_patch(
+    lonlat: tuple[float, float],
+    patch_size: int,
+    client: FetchClient | None = None,
+) -> np.ndarray:
     """Gets the labels patch of pixels for the given point.
 
     Labels land cover data is only available for 2020, so any training example
@@ -137,27 +156,30 @@ def get_label_patch(lonlat: tuple[float, float], patch_size: int) -> np.ndarray:
     args:
         lonlat: A (longitude, latitude) pair for the point of interest.
         patch_size: Size in pixels of the surrounding square patch.
+        client: Client to fetch the patch with, `get_fetch_client()` by default.
 
     Returns: The pixel values of a labels patch as a NumPy array.
     """
     image = get_label_image()
-    patch = get_patch(image, lonlat, patch_size, SCALE)
+    patch = get_patch(image, lonlat, patch_size, SCALE, client)
     return structured_to_unstructured(patch)
 
 
-@retry.Retry(deadline=10 * 60)  # seconds
 def get_patch(
-    image: ee.Image, lonlat: tuple[float, float], patch_size: int, scale: int
+    image: ee.Image,
+    lonlat: tuple[float, float],
+    patch_size: int,
+    scale: int,
+    client: FetchClient | None = None,
 ) -> np.ndarray:
     """Fetches a patch of pixels from Earth Engine.
 
-    It retries if we get error "429: Too Many Requests".
-
     Args:
         image: Image to get the patch from.
         lonlat: A (longitude, latitude) pair for the point of interest.
         patch_size: Size in pixels of the surrounding square patch.
         scale: Number of meters per pixel.
+        client: Client to fetch the patch with, `get_fetch_client()` by default.
 
     Raises:
         requests.exceptions.RequestException
@@ -165,20 +187,138 @@ def get_patch(
     Returns: The requested patch of pixels as a NumPy array with shape (width, height, bands).
     """
     point = ee.Geometry.Point(lonlat)
-    url = image.getDownloadURL(
+    return (client or get_fetch_client()).get_pixels(
+        image,
         {
             "region": point.buffer(scale * patch_size / 2, 1).bounds(1),
             "dimensions": [patch_size, patch_size],
             "format": "NPY",
-        }
+        },
     )
 
+
+class TokenBucket:
+    """Limits the rate of requests, while allowing short bursts.
+
+    Tokens are added at `rate` per second up to `capacity`, and every
+    request takes one, waiting for it if there are none left.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Waits until a token is available and takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class FetchClient:
+    """Downloads pixels from Earth Engine, shared by all the threads of a process.
+
+    Every download attempt, including retries, waits for the rate limiter,
+    so retries don't all hit Earth Engine at once after a quota error.
+    Retries wait with exponential backoff and full jitter. HTTP connections
+    are pooled and reused across downloads.
+
+    The number of requests, "429: Too Many Requests" responses and request
+    latencies are counted, see `stats`. `on_response` is also called with
+    the (latency_seconds, status_code) of every response, for example to
+    export them to a metrics system.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = REQUESTS_PER_SECOND,
+        max_connections: int = MAX_CONNECTIONS,
+        on_response: Callable[[float, int], None] | None = None,
+    ) -> None:
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections)
+        self.session.mount("https://", adapter)
+        self.on_response = on_response
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.too_many_requests = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
     # If we get "429: Too Many Requests" errors, it's safe to retry the request.
-    # The Retry library only works with `google.api_core` exceptions.
-    response = requests.get(url)
-    if response.status_code == 429:
-        raise exceptions.TooManyRequests(response.text)
-
-    # Still raise any other exceptions to make sure we got valid data.
-    response.raise_for_status()
-    return np.load(io.BytesIO(response.content), allow_pickle=True)
+    # The Retry library only works with `google.api_core` exceptions, and waits
+    # a random time of up to `initial * multiplier ** attempt` seconds.
+    @retry.Retry(initial=1.0, maximum=60.0, multiplier=2.0, deadline=10 * 60)
+    def get_pixels(self, image: ee.Image, params: dict) -> np.ndarray:
+        """Downloads pixels of an image in NumPy format.
+
+        Args:
+            image: Image to get the pixels from.
+            params: Parameters for `ee.Image.getDownloadURL`, with "format" set to "NPY".
+
+        Raises:
+            requests.exceptions.RequestException
+
+        Returns: The pixels as a structured NumPy array.
+        """
+        self.rate_limiter.acquire()
+        start = time.monotonic()
+        url = image.getDownloadURL(params)
+        response = self.session.get(url)
+        self.record(time.monotonic() - start, response.status_code)
+        if response.status_code == 429:
+            raise exceptions.TooManyRequests(response.text)
+
+        # Still raise any other exceptions to make sure we got valid data.
+        response.raise_for_status()
+        return np.load(io.BytesIO(response.content), allow_pickle=True)
+
+    def record(self, latency: float, status_code: int) -> None:
+        with self.lock:
+            self.requests += 1
+            self.too_many_requests += status_code == 429
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+        if self.on_response:
+            self.on_response(latency, status_code)
+
+    def stats(self) -> dict:
+        """Returns the request counts and latencies since the client was created."""
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "too_many_requests": self.too_many_requests,
+                "too_many_requests_rate": self.too_many_requests
+                / max(self.requests, 1),
+                "latency_mean_seconds": self.latency_total / max(self.requests, 1),
+                "latency_max_seconds": self.latency_max,
+            }
+
+
+fetch_client: FetchClient | None = None
+fetch_client_lock = threading.Lock()
+
+
+def get_fetch_client() -> FetchClient:
+    """Gets the default client of the process, shared by all its threads.
+
+    Its rate limit can be set with the EE_REQUESTS_PER_SECOND environment variable.
+    """
+    global fetch_client
+    with fetch_client_lock:
+        if fetch_client is None:
+            rate = float(os.environ.get("EE_REQUESTS_PER_SECOND", REQUESTS_PER_SECOND))
+            fetch_client = FetchClient(rate)
+        return fetch_client
@@ -41,6 +41,12 @@ def ping() -> dict:
     }
 
 
+@app.route("/metrics")
+def metrics() -> dict:
+    """Returns the Earth Engine request counts and latencies of this instance."""
+    return data.get_fetch_client().stats()
+
+
 @app.route("/predict/<float(signed=True):lon>/<float(signed=True):lat>/<int:year>")
 def predict(lon: float, lat: float, year: int) -> flask.Response:
     """Gets a prediction from the model.
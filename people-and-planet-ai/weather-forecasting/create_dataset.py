@@ -17,7 +17,9 @@
 from __future__ import annotations
 
 from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import functools
 import logging
 import random
 import uuid
@@ -32,6 +34,7 @@ import requests
 # Default values.
 NUM_DATES = 100
 MAX_REQUESTS = 20  # default EE request quota
+REQUESTS_PER_WORKER = 4
 MIN_BATCH_SIZE = 100
 
 # Constants.
@@ -42,6 +45,7 @@ PATCH_SIZE = 5
 START_DATE = datetime(2017, 7, 10)
 END_DATE = datetime.now() - timedelta(days=30)
 POLYGON = [(-140.0, 60.0), (-140.0, -60.0), (-10.0, -60.0), (-10.0, 60.0)]
+MAX_FEATURES = 5000  # maximum number of features Earth Engine returns at once
 
 
 def sample_points(date: datetime, num_bins: int = NUM_BINS) -> Iterator[tuple]:
@@ -67,31 +71,64 @@ def sample_points(date: datetime, num_bins: int = NUM_BINS) -> Iterator[tuple]:
 
     Yields: (date, lon_lat) pairs.
     """
+    for date, points in sample_points_batch([date], num_bins):
+        for point in points:
+            yield (date, point)
+
+
+def sample_points_batch(
+    dates: list[datetime], num_bins: int = NUM_BINS
+) -> Iterator[tuple[datetime, list]]:
+    """Selects points for many dates with a single Earth Engine request.
+
+    See `sample_points` for how the points are selected. There are at most
+    `num_bins ** 2` points per date, and Earth Engine returns at most
+    `MAX_FEATURES` points per request, so pass at most
+    `MAX_FEATURES // num_bins ** 2` dates.
+
+    Args:
+        dates: The dates of interest.
+        num_bins: Number of bins to bucketize values.
+
+    Yields: (date, lon_lats) pairs, with the list of points for each date.
+    """
     from weather import data
 
-    precipitation_bins = (
-        data.get_gpm(date)
-        .clamp(0, MAX_PRECIPITATION)
-        .divide(MAX_PRECIPITATION)
-        .multiply(num_bins - 1)
-        .uint8()
-    )
-    elevation_bins = (
-        data.get_elevation()
-        .clamp(0, MAX_ELEVATION)
-        .divide(MAX_ELEVATION)
-        .multiply(num_bins - 1)
-        .uint8()
-    )
-    unique_bins = elevation_bins.multiply(num_bins).add(precipitation_bins)
-    points = unique_bins.stratifiedSample(
-        numPoints=1,
-        region=ee.Geometry.Polygon(POLYGON),
-        scale=data.SCALE,
-        geometries=True,
-    )
-    for point in points.toList(points.size()).getInfo():
-        yield (date, point["geometry"]["coordinates"])
+    def stratified_sample(date: datetime, i: int) -> ee.FeatureCollection:
+        precipitation_bins = (
+            data.get_gpm(date)
+            .clamp(0, MAX_PRECIPITATION)
+            .divide(MAX_PRECIPITATION)
+            .multiply(num_bins - 1)
+            .uint8()
+        )
+        elevation_bins = (
+            data.get_elevation()
+            .clamp(0, MAX_ELEVATION)
+            .divide(MAX_ELEVATION)
+            .multiply(num_bins - 1)
+            .uint8()
+        )
+        unique_bins = elevation_bins.multiply(num_bins).add(precipitation_bins)
+        points = unique_bins.stratifiedSample(
+            numPoints=1,
+            region=ee.Geometry.Polygon(POLYGON),
+            scale=data.SCALE,
+            geometries=True,
+        )
+        # Tag every point with the date it was sampled for.
+        return points.map(lambda point: point.set("date_index", i))
+
+    samples = [stratified_sample(date, i) for i, date in enumerate(dates)]
+    features = ee.FeatureCollection(samples).flatten().getInfo()["features"]
+    points_by_date = [[] for _ in dates]
+    for feature in features:
+        points_by_date[feature["properties"]["date_index"]].append(
+            feature["geometry"]["coordinates"]
+        )
+    for date, points in zip(dates, points_by_date):
+        if points:
+            yield (date, points)
 
 
 def get_training_example(
@@ -108,19 +145,55 @@ def get_training_example(
     """
     from weather import data
 
-    return (
-        data.get_inputs_patch(date, point, patch_size),
-        data.get_labels_patch(date, point, patch_size),
-    )
+    return data.get_training_patches(date, [point], patch_size)[0]
+
 
+def try_get_examples(date: datetime, points: list) -> list[tuple]:
+    """Gets the training examples of nearby points with a single download.
+
+    Errors are logged instead of crashing the pipeline.
+    """
+    from weather import data
 
-def try_get_example(date: datetime, point: tuple) -> Iterator[tuple]:
-    """Wrapper over `get_training_examples` that allows it to simply log errors instead of crashing."""
     try:
-        yield get_training_example(date, point)
+        return data.get_training_patches(date, points, PATCH_SIZE)
     except (requests.exceptions.HTTPError, ee.ee_exception.EEException) as e:
-        logging.error(f"🛑 failed to get example: {date} {point}")
+        logging.error(f"🛑 failed to get examples: {date} {points}")
         logging.exception(e)
+        return []
+
+
+@functools.cache
+def get_executor(max_workers: int) -> ThreadPoolExecutor:
+    """Gets a thread pool shared by all the bundles of a worker process."""
+    return ThreadPoolExecutor(max_workers)
+
+
+def get_examples(
+    date: datetime, points: list, requests_per_worker: int = REQUESTS_PER_WORKER
+) -> Iterator[tuple]:
+    """Gets the training examples for the points sampled for a date.
+
+    Nearby points are grouped so that each group is fetched with a single
+    download of both the inputs and the labels. Groups are fetched on a thread
+    pool shared across the worker process, so there are never more than
+    `requests_per_worker` requests to Earth Engine per worker.
+
+    Args:
+        date: The date of interest.
+        points: List of (longitude, latitude) coordinates.
+        requests_per_worker: Limit of concurrent requests to Earth Engine per worker.
+
+    Yields: (inputs, labels) pairs of NumPy arrays.
+    """
+    from weather import data
+
+    executor = get_executor(requests_per_worker)
+    groups = [
+        [points[i] for i in group] for group in data.group_points(points, PATCH_SIZE)
+    ]
+    for examples in executor.map(lambda group: try_get_examples(date, group), groups):
+        yield from examples
 
 
 def write_npz(batch: list[tuple[np.ndarray, np.ndarray]], data_path: str) -> str:
@@ -146,6 +219,7 @@ def run(
     num_dates: int = NUM_DATES,
     num_bins: int = NUM_BINS,
     max_requests: int = MAX_REQUESTS,
+    requests_per_worker: int = REQUESTS_PER_WORKER,
     min_batch_size: int = MIN_BATCH_SIZE,
     beam_args: list[str] | None = None,
 ) -> None:
@@ -154,32 +228,43 @@ def run(
     This fetches data from Earth Engine and writes compressed NumPy files.
     We use `max_requests` to limit the number of concurrent requests to Earth Engine
     to avoid quota issues. You can request for an increas of quota if you need it.
+    Each worker makes up to `requests_per_worker` of them concurrently, so the
+    number of workers is limited to `max_requests // requests_per_worker`.
 
     Args:
         data_path: Directory path to save the data files.
         num_dates: Number of dates to extract data points from.
         num_bins: Number of bins to bucketize values.
         max_requests: Limit the number of concurrent requests to Earth Engine.
+        requests_per_worker: Limit of concurrent requests to Earth Engine per worker.
         min_batch_size: Minimum number of examples to write per data file.
         beam_args: Apache Beam command line arguments to parse as pipeline options.
     """
     random_dates = [
         START_DATE + (END_DATE - START_DATE) * random.random() for _ in range(num_dates)
     ]
+    # Sample the points of as many dates as possible with each request.
+    dates_per_request = max(MAX_FEATURES // num_bins**2, 1)
+    date_batches = [
+        random_dates[i : i + dates_per_request]
+        for i in range(0, len(random_dates), dates_per_request)
+    ]
 
+    requests_per_worker = min(requests_per_worker, max_requests)
+    num_workers = max(max_requests // requests_per_worker, 1)
     beam_options = PipelineOptions(
         beam_args,
         save_main_session=True,
-        direct_num_workers=max(max_requests, MAX_REQUESTS),  # direct runner
-        max_num_workers=max_requests,  # distributed runners
+        direct_num_workers=num_workers,  # direct runner
+        max_num_workers=num_workers,  # distributed runners
     )
     with beam.Pipeline(options=beam_options) as pipeline:
         (
             pipeline
-            | "📆 Random dates" >> beam.Create(random_dates)
-            | "📌 Sample points" >> beam.FlatMap(sample_points, num_bins)
+            | "📆 Random dates" >> beam.Create(date_batches)
+            | "📌 Sample points" >> beam.FlatMap(sample_points_batch, num_bins)
             | "🃏 Reshuffle" >> beam.Reshuffle()
-            | "📑 Get example" >> beam.FlatMapTuple(try_get_example)
+            | "📑 Get examples" >> beam.FlatMapTuple(get_examples, requests_per_worker)
             | "🗂️ Batch examples" >> beam.BatchElements(min_batch_size)
             | "📝 Write NPZ files" >> beam.Map(write_npz, data_path)
         )
@@ -214,6 +299,12 @@ def main() -> None:
         default=MAX_REQUESTS,
         help="Limit the number of concurrent requests to Earth Engine.",
     )
+    parser.add_argument(
+        "--requests-per-worker",
+        type=int,
+        default=REQUESTS_PER_WORKER,
+        help="Limit the number of concurrent requests to Earth Engine per worker.",
+    )
     parser.add_argument(
         "--min-batch-size",
         type=int,
@@ -227,6 +318,7 @@ def main() -> None:
         num_dates=args.num_dates,
         num_bins=args.num_bins,
         max_requests=args.max_requests,
+        requests_per_worker=args.requests_per_worker,
         min_batch_size=args.min_batch_size,
         beam_args=beam_args,
     )
@@ -12,23 +12,72 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import annotations
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import io
 import os
+import threading
+from typing import TYPE_CHECKING
+
+from flask import abort, Flask, request, Response
+import numpy as np
 
-from flask import Flask, request
+from weather.data import PatchCache
 
-from weather.data import get_inputs_patch
-from weather.model import WeatherModel
+if TYPE_CHECKING:
+    from weather.model import WeatherModel
 
 app = Flask(__name__)
 
-MODEL = WeatherModel.from_pretrained("model")
+# Maximum number of points for a single /predict-batch request.
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 64))
+
+# Input patches are cached in memory, and on disk if PATCH_CACHE_DIR is set,
+# so repeated and nearby predictions don't download them again.
+PATCH_CACHE = PatchCache(os.environ.get("PATCH_CACHE_DIR"))
+
+# The model is loaded on the first prediction, so the service starts fast.
+model = None
+model_lock = threading.Lock()
+
+
+def get_model() -> WeatherModel:
+    """Loads the model once, even if called from multiple threads."""
+    global model
+    if model is None:
+        with model_lock:
+            if model is None:
+                # Importing PyTorch is slow, so it's only done when needed.
+                from weather.model import WeatherModel
+
+                model = WeatherModel.from_pretrained("model")
+    return model
 
 
 def to_bool(x: str) -> bool:
     return x.lower() == "true"
 
 
+def make_response(arrays: dict[str, np.ndarray]) -> Response | dict:
+    """Formats the response as requested by the "format" parameter.
+
+    "json" (default) returns the arrays as nested lists in a JSON object.
+    "npz" returns them as a NumPy .npz file, which is much smaller and
+    faster to parse; load it with `np.load(io.BytesIO(response.content))`.
+    """
+    response_format = request.args.get("format", "json")
+    if response_format == "json":
+        return {name: values.tolist() for name, values in arrays.items()}
+    if response_format == "npz":
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return Response(buffer.getvalue(), mimetype="application/octet-stream")
+    abort(400, f"Unsupported format: {response_format}")
+
+
 @app.route("/")
 def ping() -> dict:
     """Checks that we can communicate with the service and get arguments."""
@@ -39,19 +88,68 @@ def ping() -> dict:
 
 
 @app.route("/predict/<iso_date>/<float(signed=True):lat>,<float(signed=True):lon>")
-def predict(iso_date: str, lat: float, lon: float) -> dict:
+def predict(iso_date: str, lat: float, lon: float) -> Response | dict:
     # Optional HTTP request parameters.
     #   https://en.wikipedia.org/wiki/Query_string
     patch_size = request.args.get("patch-size", 128, type=int)
     include_inputs = request.args.get("include-inputs", False, type=to_bool)
 
     date = datetime.fromisoformat(iso_date)
-    inputs = get_inputs_patch(date, (lon, lat), patch_size).tolist()
-    predictions = MODEL.predict(inputs).tolist()
+    inputs = PATCH_CACHE.get_inputs_patch(date, (lon, lat), patch_size)
+    predictions = get_model().predict(inputs)
+
+    if include_inputs:
+        return make_response({"inputs": inputs, "predictions": predictions})
+    return make_response({"predictions": predictions})
+
+
+@app.route("/predict-batch", methods=["POST"])
+def predict_batch() -> Response | dict:
+    """Predicts many points with a single forward pass of the model.
+
+    The request body is a JSON list of {"date": iso_date, "lat": lat, "lon": lon}
+    objects, and the predictions are returned in the same order. It takes the
+    same optional parameters as /predict.
+    """
+    patch_size = request.args.get("patch-size", 128, type=int)
+    include_inputs = request.args.get("include-inputs", False, type=to_bool)
+
+    points = request.get_json()
+    if not isinstance(points, list) or not points:
+        abort(400, "Expected a JSON list of points")
+    if len(points) > MAX_BATCH_SIZE:
+        abort(400, f"Too many points, the maximum is {MAX_BATCH_SIZE}")
+    try:
+        points = [
+            (datetime.fromisoformat(p["date"]), (float(p["lon"]), float(p["lat"])))
+            for p in points
+        ]
+    except (KeyError, TypeError, ValueError) as e:
+        abort(400, f"Invalid point: {e}")
+
+    # Points of the same date share the same image, so fetch them together,
+    # and different dates concurrently.
+    indices_by_date = defaultdict(list)
+    for i, (date, _) in enumerate(points):
+        indices_by_date[date].append(i)
+
+    def get_patches(date: datetime) -> list[np.ndarray]:
+        lon_lats = [points[i][1] for i in indices_by_date[date]]
+        return PATCH_CACHE.get_inputs_patches(date, lon_lats, patch_size)
+
+    inputs = [None] * len(points)
+    with ThreadPoolExecutor(min(len(indices_by_date), 8)) as executor:
+        for date, patches in zip(
+            indices_by_date, executor.map(get_patches, indices_by_date)
+        ):
+            for i, patch in zip(indices_by_date[date], patches):
+                inputs[i] = patch
+    inputs = np.stack(inputs)
+    predictions = get_model().predict_batch(inputs)
 
     if include_inputs:
-        return {"inputs": inputs, "predictions": predictions}
-    return {"predictions": predictions}
+        return make_response({"inputs": inputs, "predictions": predictions})
+    return make_response({"predictions": predictions})
 
 
 if __name__ == "__main__":
@@ -19,14 +19,22 @@ trained on exactly the same data that will be used for predictions.
 
 from __future__ import annotations
 
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import functools
 import io
+import math
+import os
+import tempfile
+import threading
 
 import ee
 from google.api_core import exceptions, retry
 import google.auth
 import numpy as np
 from numpy.lib.recfunctions import structured_to_unstructured
+import pyproj
 import requests
 
 # Constants.
@@ -34,22 +42,46 @@ SCALE = 10000  # meters per pixel
 INPUT_HOUR_DELTAS = [-4, -2, 0]
 OUTPUT_HOUR_DELTAS = [2, 6]
 WINDOW = timedelta(days=1)
+TILE_SIZE = 64  # pixels per side of the tiles cached by PatchCache
+BLOCK_TILES = 4  # tiles per side of the largest area PatchCache downloads at once
+MAX_GROUP_SIZE = 32  # pixels per side of the largest area get_grid_patches downloads
+LABEL_PREFIX = "label_"  # prefix of the label bands in get_training_image
+
+# Earth Engine is initialized on first use, so importing this module is fast.
+initialized = False
+initialize_lock = threading.Lock()
 
-# Authenticate and initialize Earth Engine with the default credentials.
-credentials, project = google.auth.default(
-    scopes=[
-        "https://www.googleapis.com/auth/cloud-platform",
-        "https://www.googleapis.com/auth/earthengine",
-    ]
-)
 
-# Use the Earth Engine High Volume endpoint.
-#   https://developers.google.com/earth-engine/cloud/highvolume
-ee.Initialize(
-    credentials.with_quota_project(None),
-    project=project,
-    opt_url="https://earthengine-highvolume.googleapis.com",
-)
+def initialize() -> None:
+    """Authenticates and initializes Earth Engine with the default credentials.
+
+    It's safe to call from multiple threads, and only initializes once.
+    """
+    global initialized
+    if initialized:
+        return
+    with initialize_lock:
+        if initialized:
+            return
+        credentials, project = google.auth.default(
+            scopes=[
+                "https://www.googleapis.com/auth/cloud-platform",
+                "https://www.googleapis.com/auth/earthengine",
+            ]
+        )
+
+        # Use the Earth Engine High Volume endpoint.
+        #   https://developers.google.com/earth-engine/cloud/highvolume
+        ee.Initialize(
+            credentials.with_quota_project(None),
+            project=project,
+            opt_url="https://earthengine-highvolume.googleapis.com",
+        )
+        initialized = True
+
+
+# Reuse the HTTP connections across downloads.
+session = requests.Session()
 
 
 def get_gpm(date: datetime) -> ee.Image:
@@ -63,6 +95,7 @@ def get_gpm(date: datetime) -> ee.Image:
 
     Returns: An Earth Engine image.
     """
+    initialize()
     window_start = (date - WINDOW).isoformat()
     window_end = date.isoformat()
     return (
@@ -99,6 +132,7 @@ def get_goes16(date: datetime) -> ee.Image:
 
     Returns: An Earth Engine image.
     """
+    initialize()
     window_start = (date - WINDOW).isoformat()
     window_end = date.isoformat()
     return (
@@ -124,6 +158,7 @@ def get_goes16_sequence(dates: list[datetime]) -> ee.Image:
     return ee.ImageCollection(images).toBands()
 
 
+@functools.cache
 def get_elevation() -> ee.Image:
     """Gets a digital elevation map.
 
@@ -132,12 +167,16 @@ def get_elevation() -> ee.Image:
 
     Returns: An Earth Engine image.
     """
+    initialize()
     return ee.Image("MERIT/DEM/v1_0_3").rename("elevation").unmask(0).float()
 
 
+@functools.lru_cache(maxsize=256)
 def get_inputs_image(date: datetime) -> ee.Image:
     """Gets an Earth Engine image with all the inputs for the model.
 
+    The image is memoized, so the graph is only built once for every date.
+
     Args:
         date: Date to take a snapshot from.
 
@@ -150,9 +189,12 @@ def get_inputs_image(date: datetime) -> ee.Image:
     return ee.Image([precipitation, cloud_and_moisture, elevation])
 
 
+@functools.lru_cache(maxsize=256)
 def get_labels_image(date: datetime) -> ee.Image:
     """Gets an Earth Engine image with the labels to train the model.
 
+    The image is memoized, so the graph is only built once for every date.
+
     Args:
         date: Date to take a snapshot from.
 
@@ -162,6 +204,38 @@ def get_labels_image(date: datetime) -> ee.Image:
     return get_gpm_sequence(dates)
 
 
+@functools.lru_cache(maxsize=256)
+def get_training_image(date: datetime) -> ee.Image:
+    """Gets an Earth Engine image with both the inputs and the labels.
+
+    The label bands are prefixed with `LABEL_PREFIX`, so both can be
+    downloaded at once and told apart with `split_training_patch`.
+
+    Args:
+        date: Date to take a snapshot from.
+
+    Returns: An Earth Engine image.
+    """
+    labels = get_labels_image(date).regexpRename("^", LABEL_PREFIX)
+    return ee.Image([get_inputs_image(date), labels])
+
+
+def split_training_patch(patch: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Splits a patch of `get_training_image` into (inputs, labels) arrays.
+
+    Args:
+        patch: Structured NumPy array with the bands of both images.
+
+    Returns: An (inputs, labels) pair of NumPy arrays.
+    """
+    inputs = [name for name in patch.dtype.names if not name.startswith(LABEL_PREFIX)]
+    labels = [name for name in patch.dtype.names if name.startswith(LABEL_PREFIX)]
+    return (
+        structured_to_unstructured(patch[inputs]),
+        structured_to_unstructured(patch[labels]),
+    )
+
+
 def get_inputs_patch(date: datetime, point: tuple, patch_size: int) -> np.ndarray:
     """Gets the patch of pixels for the inputs.
 
@@ -192,12 +266,9 @@ def get_labels_patch(date: datetime, point: tuple, patch_size: int) -> np.ndarra
     return structured_to_unstructured(patch)
 
 
-@retry.Retry()
 def get_patch(image: ee.Image, point: tuple, patch_size: int, scale: int) -> np.ndarray:
     """Fetches a patch of pixels from Earth Engine.
 
-    It retries if we get error "429: Too Many Requests".
-
     Args:
         image: Image to get the patch from.
         point: A (longitude, latitude) pair for the point of interest.
@@ -211,21 +282,430 @@ def get_patch(image: ee.Image, point: tuple, patch_size: int, scale: int) -> np.
         The requested patch of pixels as a structured
         NumPy array with shape (width, height).
     """
+    initialize()
     geometry = ee.Geometry.Point(point)
-    url = image.getDownloadURL(
+    return download_npy(
+        image,
         {
             "region": geometry.buffer(scale * patch_size / 2, 1).bounds(1),
             "dimensions": [patch_size, patch_size],
             "format": "NPY",
-        }
+        },
+    )
+
+
+def get_grid_pixels(
+    image: ee.Image, crs: str, scale: int, col: int, row: int, width: int, height: int
+) -> np.ndarray:
+    """Fetches a rectangle of pixels of a grid from Earth Engine.
+
+    The grid has square pixels of `scale` units of the coordinate reference
+    system, with pixel (0, 0) at the origin of the CRS, and rows going south.
+
+    Args:
+        image: Image to get the pixels from.
+        crs: Coordinate reference system of the grid, like "EPSG:32618".
+        scale: Number of CRS units (meters for UTM) per pixel.
+        col: Column of the top left pixel.
+        row: Row of the top left pixel.
+        width: Number of columns.
+        height: Number of rows.
+
+    Raises:
+        requests.exceptions.RequestException
+
+    Returns:
+        The requested pixels as a structured NumPy array with shape (height, width).
+    """
+    return download_npy(
+        image,
+        {
+            "crs": crs,
+            "crs_transform": [scale, 0, col * scale, 0, -scale, -row * scale],
+            "dimensions": [width, height],
+            "format": "NPY",
+        },
     )
 
+
+@retry.Retry()
+def download_npy(image: ee.Image, params: dict) -> np.ndarray:
+    """Downloads pixels of an image from Earth Engine in NumPy format.
+
+    It retries if we get error "429: Too Many Requests".
+
+    Args:
+        image: Image to get the pixels from.
+        params: Parameters for `ee.Image.getDownloadURL`, with "format" set to "NPY".
+
+    Raises:
+        requests.exceptions.RequestException
+
+    Returns: The pixels as a structured NumPy array.
+    """
+    initialize()
+    url = image.getDownloadURL(params)
+
     # If we get "429: Too Many Requests" errors, it's safe to retry the request.
     # The Retry library only works with `google.api_core` exceptions.
-    response = requests.get(url)
+    response = session.get(url)
     if response.status_code == 429:
         raise exceptions.TooManyRequests(response.text)
 
     # Still raise any other exceptions to make sure we got valid data.
     response.raise_for_status()
     return np.load(io.BytesIO(response.content), allow_pickle=True)
+
+
+def get_utm_crs(point: tuple) -> str:
+    """Gets the Universal Transverse Mercator zone of a point.
+
+    Args:
+        point: A (longitude, latitude) coordinate.
+
+    Returns: The EPSG code of the zone, like "EPSG:32618".
+    """
+    (lon, lat) = point
+    zone = min(int((lon + 180) // 6) + 1, 60)
+    return f"EPSG:{(32600 if lat >= 0 else 32700) + zone}"
+
+
+@functools.cache
+def get_transformer(crs: str) -> pyproj.Transformer:
+    """Gets a transformer from (longitude, latitude) coordinates to a CRS."""
+    return pyproj.Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+
+
+def get_pixel_window(point: tuple, patch_size: int, scale: int) -> tuple[str, int, int]:
+    """Gets the pixel grid position of the patch around a point.
+
+    The grid has `scale` meter pixels in the UTM zone of the point.
+
+    Args:
+        point: A (longitude, latitude) coordinate.
+        patch_size: Size in pixels of the surrounding square patch.
+        scale: Number of meters per pixel.
+
+    Returns: The (crs, col, row) of the top left pixel of the patch.
+    """
+    crs = get_utm_crs(point)
+    (x, y) = get_transformer(crs).transform(*point)
+    col = math.floor(x / scale) - patch_size // 2
+    row = math.floor(-y / scale) - patch_size // 2
+    return (crs, col, row)
+
+
+def group_points(
+    points: list[tuple],
+    patch_size: int,
+    max_size: int = MAX_GROUP_SIZE,
+    scale: int = SCALE,
+) -> list[list[int]]:
+    """Groups points whose patches fit together in a small area of the grid.
+
+    Each group can be downloaded at once with `get_grid_patches`, in an area
+    of at most `max_size` pixels per side, or `patch_size` if it's larger.
+
+    Args:
+        points: List of (longitude, latitude) coordinates.
+        patch_size: Size in pixels of the surrounding square patches.
+        max_size: Maximum size in pixels of the area of a group.
+        scale: Number of meters per pixel.
+
+    Returns: The groups, as lists of indices into `points`.
+    """
+    max_size = max(max_size, patch_size)
+    windows = [get_pixel_window(point, patch_size, scale) for point in points]
+    # Each group is [crs, left, top, right, bottom, indices].
+    groups: list[list] = []
+    for i in sorted(range(len(points)), key=lambda i: windows[i]):
+        (crs, col, row) = windows[i]
+        for group in groups:
+            left = min(group[1], col)
+            top = min(group[2], row)
+            right = max(group[3], col + patch_size)
+            bottom = max(group[4], row + patch_size)
+            if (
+                group[0] == crs
+                and right - left <= max_size
+                and bottom - top <= max_size
+            ):
+                group[1:5] = [left, top, right, bottom]
+                group[5].append(i)
+                break
+        else:
+            groups.append([crs, col, row, col + patch_size, row + patch_size, [i]])
+    return [group[5] for group in groups]
+
+
+def get_grid_patches(
+    image: ee.Image, points: list[tuple], patch_size: int, scale: int = SCALE
+) -> list[np.ndarray]:
+    """Fetches the patches around nearby points with a single download.
+
+    The patches are snapped to the same grid as `PatchCache`. Use
+    `group_points` to get points that can be fetched together.
+
+    Args:
+        image: Image to get the patches from.
+        points: List of (longitude, latitude) coordinates in the same UTM zone.
+        patch_size: Size in pixels of the surrounding square patches.
+        scale: Number of meters per pixel.
+
+    Raises:
+        requests.exceptions.RequestException
+
+    Returns:
+        The patches as structured NumPy arrays with shape
+        (patch_size, patch_size), in the same order as the points.
+    """
+    windows = [get_pixel_window(point, patch_size, scale) for point in points]
+    crs = windows[0][0]
+    if any(window_crs != crs for (window_crs, _, _) in windows):
+        raise ValueError(f"points must be in the same UTM zone: {points}")
+    left = min(col for (_, col, _) in windows)
+    top = min(row for (_, _, row) in windows)
+    right = max(col for (_, col, _) in windows) + patch_size
+    bottom = max(row for (_, _, row) in windows) + patch_size
+    pixels = get_grid_pixels(image, crs, scale, left, top, right - left, bottom - top)
+    return [
+        pixels[row - top : row - top + patch_size, col - left : col - left + patch_size]
+        for (_, col, row) in windows
+    ]
+
+
+def get_training_patches(
+    date: datetime, points: list[tuple], patch_size: int
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Gets the (inputs, labels) patches around nearby points.
+
+    The inputs and labels of all the points are fetched with a single
+    download, see `get_grid_patches`.
+
+    Args:
+        date: The date of interest.
+        points: List of (longitude, latitude) coordinates in the same UTM zone.
+        patch_size: Size in pixels of the surrounding square patches.
+
+    Returns: A list of (inputs, labels) pairs of NumPy arrays.
+    """
+    patches = get_grid_patches(get_training_image(date), points, patch_size)
+    return [split_training_patch(patch) for patch in patches]
+
+
+class PatchCache:
+    """Caches patches of pixels from Earth Engine in tiles.
+
+    Patches are snapped to a grid of `SCALE` meter pixels in the UTM zone of
+    their point, which is split into tiles of `TILE_SIZE` pixels. The tiles
+    are kept in memory, with the least recently used ones dropped past
+    `max_tiles`, and optionally as NumPy files in `cache_dir`. Repeated and
+    nearby patches are sliced from the cached tiles instead of downloaded.
+
+    The missing tiles of a request are downloaded together: all the ones
+    within the same block of `BLOCK_TILES` tiles per side in one download,
+    and different blocks concurrently.
+
+    Because of the snapping, a patch can be shifted by up to a pixel from the
+    one `get_patch` returns for the same point.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | None = None,
+        max_tiles: int = 4096,
+        max_workers: int = 8,
+    ) -> None:
+        """Creates an empty cache.
+
+        Args:
+            cache_dir: Directory to store the tiles in, or None to keep them
+                only in memory.
+            max_tiles: Maximum number of tiles to keep in memory.
+            max_workers: Maximum number of concurrent downloads.
+        """
+        self.cache_dir = cache_dir
+        self.max_tiles = max_tiles
+        self.max_workers = max_workers
+        self.tiles: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_inputs_patch(
+        self, date: datetime, point: tuple, patch_size: int
+    ) -> np.ndarray:
+        """Gets the patch of pixels for the inputs, like `get_inputs_patch`."""
+        return self.get_inputs_patches(date, [point], patch_size)[0]
+
+    def get_inputs_patches(
+        self, date: datetime, points: list[tuple], patch_size: int
+    ) -> list[np.ndarray]:
+        """Gets the patches of pixels for the inputs at many points."""
+        patches = self.get_patches(
+            f"inputs-{date:%Y%m%dT%H%M%S}", get_inputs_image(date), points, patch_size
+        )
+        return [structured_to_unstructured(patch) for patch in patches]
+
+    def get_labels_patches(
+        self, date: datetime, points: list[tuple], patch_size: int
+    ) -> list[np.ndarray]:
+        """Gets the patches of pixels for the labels at many points."""
+        patches = self.get_patches(
+            f"labels-{date:%Y%m%dT%H%M%S}", get_labels_image(date), points, patch_size
+        )
+        return [structured_to_unstructured(patch) for patch in patches]
+
+    def get_patches(
+        self,
+        name: str,
+        image: ee.Image,
+        points: list[tuple],
+        patch_size: int,
+        scale: int = SCALE,
+    ) -> list[np.ndarray]:
+        """Gets patches of pixels of an image, downloading only the missing tiles.
+
+        Args:
+            name: Unique name of the image, used as part of the cache keys.
+            image: Image to get the patches from.
+            points: List of (longitude, latitude) coordinates.
+            patch_size: Size in pixels of the surrounding square patches.
+            scale: Number of meters per pixel.
+
+        Raises:
+            requests.exceptions.RequestException
+
+        Returns:
+            The patches as structured NumPy arrays with shape
+            (patch_size, patch_size), in the same order as the points.
+        """
+        # Get the top left pixel of every patch.
+        windows = [get_pixel_window(point, patch_size, scale) for point in points]
+
+        # Look up the tiles covering the patches.
+        tiles = {}
+        missing_blocks = defaultdict(list)
+        for crs, col, row in windows:
+            for tile_row in range(
+                row // TILE_SIZE, (row + patch_size - 1) // TILE_SIZE + 1
+            ):
+                for tile_col in range(
+                    col // TILE_SIZE, (col + patch_size - 1) // TILE_SIZE + 1
+                ):
+                    tile_id = (crs, tile_col, tile_row)
+                    if tile_id in tiles:
+                        continue
+                    tiles[tile_id] = self.get_tile((name, scale, *tile_id))
+                    if tiles[tile_id] is None:
+                        block = (crs, tile_col // BLOCK_TILES, tile_row // BLOCK_TILES)
+                        missing_blocks[block].append(tile_id)
+
+        # Download the missing tiles, one download per block.
+        def download(tile_ids: list[tuple]) -> dict[tuple, np.ndarray]:
+            crs = tile_ids[0][0]
+            min_col = min(tile_col for (_, tile_col, _) in tile_ids)
+            min_row = min(tile_row for (_, _, tile_row) in tile_ids)
+            max_col = max(tile_col for (_, tile_col, _) in tile_ids)
+            max_row = max(tile_row for (_, _, tile_row) in tile_ids)
+            pixels = get_grid_pixels(
+                image,
+                crs,
+                scale,
+                min_col * TILE_SIZE,
+                min_row * TILE_SIZE,
+                (max_col - min_col + 1) * TILE_SIZE,
+                (max_row - min_row + 1) * TILE_SIZE,
+            )
+            downloaded = {}
+            for tile_row in range(min_row, max_row + 1):
+                for tile_col in range(min_col, max_col + 1):
+                    i = (tile_row - min_row) * TILE_SIZE
+                    j = (tile_col - min_col) * TILE_SIZE
+                    tile = pixels[i : i + TILE_SIZE, j : j + TILE_SIZE].copy()
+                    self.put_tile((name, scale, crs, tile_col, tile_row), tile)
+                    downloaded[(crs, tile_col, tile_row)] = tile
+            return downloaded
+
+        if missing_blocks:
+            with ThreadPoolExecutor(min(self.max_workers, len(missing_blocks))) as pool:
+                for downloaded in pool.map(download, missing_blocks.values()):
+                    tiles.update(downloaded)
+
+        # Slice the patches from the tiles.
+        return [
+            slice_patch(tiles, crs, col, row, patch_size) for (crs, col, row) in windows
+        ]
+
+    def get_tile(self, key: tuple) -> np.ndarray | None:
+        """Gets a tile from memory or disk, or None if it's not cached."""
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+        if self.cache_dir is None:
+            return None
+        try:
+            tile = np.load(self.tile_path(key))
+        except FileNotFoundError:
+            return None
+        self.remember_tile(key, tile)
+        return tile
+
+    def put_tile(self, key: tuple, tile: np.ndarray) -> None:
+        """Adds a tile to memory and disk."""
+        self.remember_tile(key, tile)
+        if self.cache_dir is None:
+            return
+        path = self.tile_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial tile.
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), suffix=".npy", delete=False
+        ) as f:
+            np.save(f, tile)
+        os.replace(f.name, path)
+
+    def remember_tile(self, key: tuple, tile: np.ndarray) -> None:
+        with self.lock:
+            self.tiles[key] = tile
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+
+    def tile_path(self, key: tuple) -> str:
+        (name, scale, crs, tile_col, tile_row) = key
+        grid = f"{crs.replace(':', '-')}-{scale}m"
+        return os.path.join(self.cache_dir, name, grid, f"{tile_col}_{tile_row}.npy")
+
+
+def slice_patch(
+    tiles: dict[tuple, np.ndarray], crs: str, col: int, row: int, patch_size: int
+) -> np.ndarray:
+    """Copies a patch of pixels out of the tiles that cover it.
+
+    Args:
+        tiles: Tiles by (crs, tile_col, tile_row).
+        crs: Coordinate reference system of the grid.
+        col: Column of the top left pixel of the patch.
+        row: Row of the top left pixel of the patch.
+        patch_size: Size in pixels of the square patch.
+
+    Returns: The patch as a structured NumPy array with shape (patch_size, patch_size).
+    """
+    patch = None
+    for tile_row in range(row // TILE_SIZE, (row + patch_size - 1) // TILE_SIZE + 1):
+        for tile_col in range(
+            col // TILE_SIZE, (col + patch_size - 1) // TILE_SIZE + 1
+        ):
+            tile = tiles[(crs, tile_col, tile_row)]
+            if patch is None:
+                patch = np.empty((patch_size, patch_size), tile.dtype)
+            # Overlap of the patch and the tile, in pixels of the grid.
+            top = max(row, tile_row * TILE_SIZE)
+            bottom = min(row + patch_size, (tile_row + 1) * TILE_SIZE)
+            left = max(col, tile_col * TILE_SIZE)
+            right = min(col + patch_size, (tile_col + 1) * TILE_SIZE)
+            patch[top - row : bottom - row, left - col : right - col] = tile[
+                top - tile_row * TILE_SIZE : bottom - tile_row * TILE_SIZE,
+                left - tile_col * TILE_SIZE : right - tile_col * TILE_SIZE,
+            ]
+    return patch
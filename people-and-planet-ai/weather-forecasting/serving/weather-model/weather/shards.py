@@ -0,0 +1,267 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reads datasets larger than memory from memory-mapped NumPy shards.
+
+The compressed `.npz` data files are converted once into uncompressed `.npy`
+shards, which are memory-mapped so only the examples of each batch are read.
+Batches are shuffled, augmented and assembled in a background thread while
+the model trains on the previous ones.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+# Default values.
+EXAMPLES_PER_SHARD = 50000
+PREFETCH_BATCHES = 4
+
+# Constants.
+NUM_TRANSFORMS = 8  # 4 rotations, each with and without flipping
+NUM_READ_THREADS = 16  # number of threads to read data files in parallel
+INDEX_FILE = "shards.json"
+
+
+def write_shards(
+    data_path: str, shards_path: str, examples_per_shard: int = EXAMPLES_PER_SHARD
+) -> None:
+    """Converts the `.npz` data files into uncompressed `.npy` shards.
+
+    The shards are written as `inputs-00000.npy` and `labels-00000.npy` pairs,
+    and `shards.json` is written last, with the data path and files they were
+    converted from. If it already exists for the same data files, the shards
+    are reused, otherwise they are rebuilt.
+
+    Args:
+        data_path: Directory path to read data files from.
+        shards_path: Local directory path to write the shards to.
+        examples_per_shard: Number of examples in every shard but the last one.
+    """
+    files = sorted(glob(os.path.join(data_path, "*.npz")))
+    index_path = os.path.join(shards_path, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get("data_path") == data_path and index.get("files") == files:
+            return
+        # Remove the stale shards, and the index first in case we're interrupted.
+        os.remove(index_path)
+        for path in glob(os.path.join(shards_path, "*-?????.npy")):
+            os.remove(path)
+    os.makedirs(shards_path, exist_ok=True)
+
+    def read_data_file(filename: str) -> tuple[np.ndarray, np.ndarray]:
+        with open(filename, "rb") as f:
+            npz = np.load(f)
+            return (npz["inputs"], npz["labels"])
+
+    sizes = []
+    buffer: list[tuple[np.ndarray, np.ndarray]] = []
+
+    def write_shard() -> None:
+        name = f"{len(sizes):05d}.npy"
+        inputs = np.concatenate([x for (x, _) in buffer])
+        labels = np.concatenate([y for (_, y) in buffer])
+        np.save(os.path.join(shards_path, f"inputs-{name}"), inputs)
+        np.save(os.path.join(shards_path, f"labels-{name}"), labels)
+        sizes.append(len(inputs))
+        buffer.clear()
+
+    # Decompress the data files in parallel, but only a few at a time so they
+    # don't all have to fit in memory.
+    with ThreadPoolExecutor(NUM_READ_THREADS) as executor:
+        for i in range(0, len(files), NUM_READ_THREADS):
+            chunk = files[i : i + NUM_READ_THREADS]
+            for inputs, labels in executor.map(read_data_file, chunk):
+                buffer.append((inputs, labels))
+                if sum(len(x) for (x, _) in buffer) >= examples_per_shard:
+                    write_shard()
+    if buffer:
+        write_shard()
+
+    with open(os.path.join(shards_path, INDEX_FILE), "w") as f:
+        json.dump({"data_path": data_path, "files": files, "sizes": sizes}, f)
+
+
+class ShardedDataset:
+    """An (inputs, labels) dataset stored in memory-mapped `.npy` shards."""
+
+    def __init__(self, shards_path: str) -> None:
+        with open(os.path.join(shards_path, INDEX_FILE)) as f:
+            sizes = json.load(f)["sizes"]
+        self.inputs = []
+        self.labels = []
+        for i in range(len(sizes)):
+            name = f"{i:05d}.npy"
+            path = os.path.join(shards_path, f"inputs-{name}")
+            self.inputs.append(np.load(path, mmap_mode="r"))
+            path = os.path.join(shards_path, f"labels-{name}")
+            self.labels.append(np.load(path, mmap_mode="r"))
+        # Index of the first example of every shard, and the total at the end.
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def split(
+        self, train_test_ratio: float, seed: int = 0
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Randomly splits the example indices into train and test indices."""
+        indices = np.random.default_rng(seed).permutation(len(self))
+        train_size = int(len(self) * train_test_ratio)
+        return (np.sort(indices[:train_size]), np.sort(indices[train_size:]))
+
+    def get_batch(self, indices: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Reads the examples at the given sorted indices.
+
+        Only the rows of each shard that are needed are read from disk.
+        """
+        shards = np.searchsorted(self.offsets, indices, side="right") - 1
+        inputs = []
+        labels = []
+        for shard in np.unique(shards):
+            rows = indices[shards == shard] - self.offsets[shard]
+            inputs.append(self.inputs[shard][rows])
+            labels.append(self.labels[shard][rows])
+        return (np.concatenate(inputs), np.concatenate(labels))
+
+    def mean_std(
+        self, indices: np.ndarray, batch_size: int = EXAMPLES_PER_SHARD
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Computes the mean and standard deviation of every input channel.
+
+        The examples are read a batch at a time, so they don't all have to
+        fit in memory.
+
+        Returns: The (mean, std) pair, each with shape (1, 1, 1, channels).
+        """
+        count = 0
+        total = 0.0
+        total_squares = 0.0
+        for i in range(0, len(indices), batch_size):
+            (inputs, _) = self.get_batch(indices[i : i + batch_size])
+            values = inputs.reshape(-1, inputs.shape[-1]).astype(np.float64)
+            count += len(values)
+            total += values.sum(axis=0)
+            total_squares += np.square(values).sum(axis=0)
+        mean = total / count
+        std = np.sqrt(np.maximum(total_squares / count - np.square(mean), 0))
+        return (
+            mean[None, None, None, :].astype(np.float32),
+            std[None, None, None, :].astype(np.float32),
+        )
+
+    def iter_batches(
+        self,
+        indices: np.ndarray,
+        batch_size: int,
+        shuffle: bool = False,
+        augment: bool = False,
+        seed: int | None = None,
+        prefetch: int = PREFETCH_BATCHES,
+    ) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """Yields (inputs, labels) batches of the examples at the given indices.
+
+        Batches are read in a background thread, up to `prefetch` batches
+        ahead of the caller.
+
+        Args:
+            indices: Indices of the examples to read.
+            batch_size: Number of examples per batch.
+            shuffle: Whether to read the examples in a random order.
+            augment: Whether to go through every example in each of its 8
+                rotated and flipped versions, as if the dataset had been
+                augmented with them. The transforms are applied per batch.
+            seed: Random seed for the shuffling.
+            prefetch: Maximum number of batches read ahead.
+        """
+        num_transforms = NUM_TRANSFORMS if augment else 1
+        # Every "virtual" example is an (example, transform) pair.
+        virtual_size = len(indices) * num_transforms
+        if shuffle:
+            order = np.random.default_rng(seed).permutation(virtual_size)
+        else:
+            order = np.arange(virtual_size)
+
+        def read_batch(start: int) -> tuple[np.ndarray, np.ndarray]:
+            batch = order[start : start + batch_size]
+            (transforms, positions) = np.divmod(batch, len(indices))
+            # Sort by example index so the shards are read sequentially.
+            sort = np.argsort(indices[positions], kind="stable")
+            (inputs, labels) = self.get_batch(indices[positions[sort]])
+            if augment:
+                transform_batch(inputs, labels, transforms[sort])
+            return (inputs, labels)
+
+        batches: queue.Queue = queue.Queue(maxsize=prefetch)
+        done = threading.Event()
+
+        def put(item: object) -> bool:
+            # Waits for room in the queue, unless the caller stopped early.
+            while not done.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce() -> None:
+            try:
+                for start in range(0, virtual_size, batch_size):
+                    if not put(read_batch(start)):
+                        return
+                put(None)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while (item := batches.get()) is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Stops the producer if the caller stops early.
+            done.set()
+            thread.join()
+
+
+def transform_batch(
+    inputs: np.ndarray, labels: np.ndarray, transforms: np.ndarray
+) -> None:
+    """Rotates and flips every example in place by its transform number.
+
+    Transform `t` rotates by `t % 4` quarter turns, and flips if `t >= 4`.
+    The examples are square, so they keep their shape.
+    """
+    for t in np.unique(transforms):
+        if t == 0:
+            continue
+        selected = transforms == t
+        for values in (inputs, labels):
+            transformed = np.rot90(values[selected], t % 4, (1, 2))
+            if t >= 4:
+                transformed = np.flip(transformed, axis=1)
+            values[selected] = transformed
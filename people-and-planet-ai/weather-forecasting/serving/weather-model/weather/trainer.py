@@ -16,21 +16,25 @@
 
 from __future__ import annotations
 
+from collections.abc import Iterator
 from glob import glob
 import os
 
 from datasets.arrow_dataset import Dataset
 from datasets.dataset_dict import DatasetDict
 import numpy as np
+import torch
 from transformers import Trainer, TrainingArguments
 
-from weather.model import WeatherModel
+from weather.model import WeatherConfig, WeatherModel
+from weather.shards import NUM_TRANSFORMS, ShardedDataset, write_shards
 
 
 # Default values.
 EPOCHS = 100
 BATCH_SIZE = 512
 TRAIN_TEST_RATIO = 0.9
+SHARDS_PATH = "data-shards"
 
 # Constants.
 NUM_DATASET_READ_PROC = 16  # number of processes to read data files in parallel
@@ -61,27 +65,44 @@ def read_dataset(data_path: str, train_test_ratio: float) -> DatasetDict:
     return dataset.train_test_split(train_size=train_test_ratio, shuffle=True)
 
 
-def augmented(dataset: Dataset) -> Dataset:
-    """Augments dataset by rotating and flipping the examples."""
-
-    def augment(values: list) -> np.ndarray:
-        transformed = [
-            np.rot90(values, 0, (1, 2)),
-            np.rot90(values, 1, (1, 2)),
-            np.rot90(values, 2, (1, 2)),
-            np.rot90(values, 3, (1, 2)),
-            np.flip(np.rot90(values, 0, (1, 2)), axis=1),
-            np.flip(np.rot90(values, 1, (1, 2)), axis=1),
-            np.flip(np.rot90(values, 2, (1, 2)), axis=1),
-            np.flip(np.rot90(values, 3, (1, 2)), axis=1),
-        ]
-        return np.concatenate(transformed)
-
-    return dataset.map(
-        lambda batch: {key: augment(values) for key, values in batch.items()},
-        batched=True,
-        num_proc=NUM_DATASET_PROC,
-    )
+class StreamingDataset(torch.utils.data.IterableDataset):
+    """Streams examples from memory-mapped shards to a Trainer.
+
+    Every pass reads the examples in a new random order if `shuffle` is set,
+    and goes through all their rotated and flipped versions if `augment` is
+    set. Nothing but the batches being read is held in memory.
+    """
+
+    def __init__(
+        self,
+        dataset: ShardedDataset,
+        indices: np.ndarray,
+        batch_size: int,
+        shuffle: bool = False,
+        augment: bool = False,
+    ) -> None:
+        self.dataset = dataset
+        self.indices = indices
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        self.epoch = 0
+
+    def __len__(self) -> int:
+        return len(self.indices) * (NUM_TRANSFORMS if self.augment else 1)
+
+    def __iter__(self) -> Iterator[dict[str, np.ndarray]]:
+        batches = self.dataset.iter_batches(
+            self.indices,
+            self.batch_size,
+            shuffle=self.shuffle,
+            augment=self.augment,
+            seed=self.epoch,
+        )
+        self.epoch += 1
+        for inputs_batch, labels_batch in batches:
+            for inputs, labels in zip(inputs_batch, labels_batch):
+                yield {"inputs": inputs, "labels": labels}
 
 
 def run(
@@ -91,6 +112,7 @@ def run(
     batch_size: int = BATCH_SIZE,
     train_test_ratio: float = TRAIN_TEST_RATIO,
     from_checkpoint: bool = False,
+    shards_path: str = SHARDS_PATH,
 ) -> None:
     """Trains a new WeatherModel.
 
@@ -101,6 +123,7 @@ def run(
         batch_size: Number of training examples to learn from at once.
         train_test_ratio: Ratio of examples to use for training and for testing.
         from_checkpoint: Whether or not to resume from latest checkpoint.
+        shards_path: Local directory path to convert the data files into shards.
     """
 
     print(f"data_path: {data_path}")
@@ -108,12 +131,17 @@ def run(
     print(f"epochs: {epochs}")
     print(f"batch_size: {batch_size}")
     print(f"train_test_ratio: {train_test_ratio}")
+    print(f"shards_path: {shards_path}")
     print("-" * 40)
 
-    dataset = read_dataset(data_path, train_test_ratio)
-    print(dataset)
+    write_shards(data_path, shards_path)
+    dataset = ShardedDataset(shards_path)
+    (train_indices, test_indices) = dataset.split(train_test_ratio)
+    print(f"train examples: {len(train_indices)}")
+    print(f"test examples: {len(test_indices)}")
 
-    model = WeatherModel.create(dataset["train"]["inputs"])
+    (mean, std) = dataset.mean_std(train_indices)
+    model = WeatherModel(WeatherConfig(mean.tolist(), std.tolist()))
     print(model.config)
     print(model)
 
@@ -128,8 +156,10 @@ def run(
     trainer = Trainer(
         model,
         training_args,
-        train_dataset=augmented(dataset["train"]),
-        eval_dataset=dataset["test"],
+        train_dataset=StreamingDataset(
+            dataset, train_indices, batch_size, shuffle=True, augment=True
+        ),
+        eval_dataset=StreamingDataset(dataset, test_indices, batch_size),
     )
     trainer.train(resume_from_checkpoint=from_checkpoint)
     trainer.save_model(model_path)
@@ -172,6 +202,11 @@ def main() -> None:
         action="store_true",
         help="Whether or not to resume from latest checkpoint.",
     )
+    parser.add_argument(
+        "--shards-path",
+        default=SHARDS_PATH,
+        help="Local directory path to convert the data files into shards.",
+    )
     args = parser.parse_args()
 
     run(**vars(args))
@@ -0,0 +1,162 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+from unittest import mock
+
+import numpy as np
+import pytest
+
+from weather import data
+
+PATCH_SIZE = 16
+POINTS = [(-73.9, 40.7), (-73.8, 40.8), (-122.4, 37.8)]
+
+
+def grid_pixels(
+    image: object, crs: str, scale: int, col: int, row: int, width: int, height: int
+) -> np.ndarray:
+    """Fake `data.get_grid_pixels` where every pixel holds its own position."""
+    (rows, cols) = np.mgrid[row : row + height, col : col + width]
+    pixels = np.empty((height, width), dtype=[("row", np.int64), ("col", np.int64)])
+    pixels["row"] = rows
+    pixels["col"] = cols
+    return pixels
+
+
+def expected_patch(point: tuple, patch_size: int = PATCH_SIZE) -> np.ndarray:
+    (crs, col, row) = data.get_pixel_window(point, patch_size, data.SCALE)
+    return grid_pixels(None, crs, data.SCALE, col, row, patch_size, patch_size)
+
+
+@pytest.fixture
+def get_grid_pixels(monkeypatch: pytest.MonkeyPatch) -> mock.Mock:
+    get_grid_pixels = mock.Mock(side_effect=grid_pixels)
+    monkeypatch.setattr(data, "get_grid_pixels", get_grid_pixels)
+    return get_grid_pixels
+
+
+def test_slice_patch_across_tiles() -> None:
+    size = data.TILE_SIZE
+    tiles = {
+        ("EPSG:32618", tile_col, tile_row): grid_pixels(
+            None, "EPSG:32618", data.SCALE, tile_col * size, tile_row * size, size, size
+        )
+        for tile_col in range(-1, 2)
+        for tile_row in range(-1, 2)
+    }
+    # The patch overlaps the corners of 4 tiles, on both sides of the origin.
+    (col, row) = (-10, size - 5)
+    patch = data.slice_patch(tiles, "EPSG:32618", col, row, 20)
+
+    expected = grid_pixels(None, "EPSG:32618", data.SCALE, col, row, 20, 20)
+    np.testing.assert_array_equal(patch, expected)
+
+
+def test_patch_cache_downloads_missing_tiles_once(get_grid_pixels: mock.Mock) -> None:
+    cache = data.PatchCache()
+
+    patches = cache.get_patches("inputs", None, POINTS, PATCH_SIZE)
+
+    for point, patch in zip(POINTS, patches):
+        np.testing.assert_array_equal(patch, expected_patch(point))
+    # The two New York points share a block, San Francisco is in another zone.
+    assert get_grid_pixels.call_count == 2
+
+    get_grid_pixels.reset_mock()
+    patches = cache.get_patches("inputs", None, POINTS[::-1], PATCH_SIZE)
+
+    for point, patch in zip(POINTS[::-1], patches):
+        np.testing.assert_array_equal(patch, expected_patch(point))
+    get_grid_pixels.assert_not_called()
+
+    # Tiles are cached per image.
+    cache.get_patches("labels", None, POINTS[:1], PATCH_SIZE)
+    get_grid_pixels.assert_called_once()
+
+
+def test_patch_cache_evicts_least_recently_used_tiles() -> None:
+    cache = data.PatchCache(max_tiles=2)
+    cache.put_tile(("inputs", data.SCALE, "EPSG:32618", 0, 0), np.zeros(1))
+    cache.put_tile(("inputs", data.SCALE, "EPSG:32618", 1, 0), np.zeros(1))
+    assert cache.get_tile(("inputs", data.SCALE, "EPSG:32618", 0, 0)) is not None
+
+    cache.put_tile(("inputs", data.SCALE, "EPSG:32618", 2, 0), np.zeros(1))
+
+    assert cache.get_tile(("inputs", data.SCALE, "EPSG:32618", 1, 0)) is None
+    assert cache.get_tile(("inputs", data.SCALE, "EPSG:32618", 0, 0)) is not None
+    assert cache.get_tile(("inputs", data.SCALE, "EPSG:32618", 2, 0)) is not None
+
+
+def test_patch_cache_reads_tiles_from_disk(
+    get_grid_pixels: mock.Mock, tmp_path: os.PathLike
+) -> None:
+    data.PatchCache(str(tmp_path)).get_patches("inputs", None, POINTS, PATCH_SIZE)
+    get_grid_pixels.reset_mock()
+
+    # A new cache, like in another process, finds the tiles on disk.
+    patches = data.PatchCache(str(tmp_path)).get_patches(
+        "inputs", None, POINTS, PATCH_SIZE
+    )
+
+    for point, patch in zip(POINTS, patches):
+        np.testing.assert_array_equal(patch, expected_patch(point))
+    get_grid_pixels.assert_not_called()
+
+
+def test_group_points() -> None:
+    points = [
+        (-73.9, 40.7),
+        (-122.4, 37.8),
+        (-73.8, 40.8),  # about 14 km from the first point
+        (-74.9, 40.7),  # about 85 km west of the first point
+    ]
+
+    groups = data.group_points(points, PATCH_SIZE, max_size=24)
+
+    assert sorted(sorted(group) for group in groups) == [[0, 2], [1], [3]]
+    for group in groups:
+        windows = [
+            data.get_pixel_window(points[i], PATCH_SIZE, data.SCALE) for i in group
+        ]
+        assert len({crs for (crs, _, _) in windows}) == 1
+        cols = [col for (_, col, _) in windows]
+        rows = [row for (_, _, row) in windows]
+        assert max(cols) - min(cols) + PATCH_SIZE <= 24
+        assert max(rows) - min(rows) + PATCH_SIZE <= 24
+
+
+def test_group_points_patches_larger_than_max_size() -> None:
+    # Patches of the same pixel window still fit together.
+    points = [(-73.9, 40.7), (-73.9, 40.7), (-73.8, 40.8)]
+
+    groups = data.group_points(points, patch_size=64, max_size=24)
+
+    assert sorted(sorted(group) for group in groups) == [[0, 1], [2]]
+
+
+def test_get_grid_patches(get_grid_pixels: mock.Mock) -> None:
+    patches = data.get_grid_patches(None, POINTS[:2], PATCH_SIZE)
+
+    for point, patch in zip(POINTS[:2], patches):
+        np.testing.assert_array_equal(patch, expected_patch(point))
+    get_grid_pixels.assert_called_once()
+
+
+def test_get_grid_patches_different_zones(get_grid_pixels: mock.Mock) -> None:
+    with pytest.raises(ValueError):
+        data.get_grid_patches(None, POINTS, PATCH_SIZE)
+    get_grid_pixels.assert_not_called()
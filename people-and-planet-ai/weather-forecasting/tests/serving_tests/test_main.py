@@ -0,0 +1,139 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+from datetime import datetime
+import io
+import os
+import sys
+
+from flask.testing import FlaskClient
+import numpy as np
+import pytest
+
+# The service runs main.py from the serving directory, it's not a package.
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "serving"))
+import main  # noqa: E402, I100
+
+PATCH_SIZE = 2
+POINTS = [
+    {"date": "2019-09-02T18:00", "lat": 25.5, "lon": -78.5},
+    {"date": "2019-09-03T18:00", "lat": 26.5, "lon": -79.5},
+    {"date": "2019-09-02T18:00", "lat": 27.5, "lon": -80.5},
+    {"date": "2019-09-04T18:00", "lat": 28.5, "lon": -81.5},
+    {"date": "2019-09-03T18:00", "lat": 29.5, "lon": -82.5},
+]
+
+
+def fake_patch(date: datetime, point: tuple, patch_size: int) -> np.ndarray:
+    """An inputs patch whose values identify its date and point."""
+    (lon, lat) = point
+    return np.full((patch_size, patch_size, 2), [date.day, lon * 100 + lat])
+
+
+class FakeModel:
+    def predict_batch(self, inputs: np.ndarray) -> np.ndarray:
+        return inputs[..., :1] * 2
+
+
+@pytest.fixture
+def patch_requests(monkeypatch: pytest.MonkeyPatch) -> list:
+    patch_requests = []
+
+    def get_inputs_patches(
+        date: datetime, points: list[tuple], patch_size: int
+    ) -> list[np.ndarray]:
+        patch_requests.append((date, points))
+        return [fake_patch(date, point, patch_size) for point in points]
+
+    monkeypatch.setattr(main.PATCH_CACHE, "get_inputs_patches", get_inputs_patches)
+    monkeypatch.setattr(main, "get_model", FakeModel)
+    return patch_requests
+
+
+@pytest.fixture
+def client(patch_requests: list) -> FlaskClient:
+    return main.app.test_client()
+
+
+def expected_inputs(points: list[dict]) -> np.ndarray:
+    return np.stack(
+        [
+            fake_patch(
+                datetime.fromisoformat(p["date"]), (p["lon"], p["lat"]), PATCH_SIZE
+            )
+            for p in points
+        ]
+    )
+
+
+def test_predict_batch_in_request_order(
+    client: FlaskClient, patch_requests: list
+) -> None:
+    response = client.post(
+        f"/predict-batch?patch-size={PATCH_SIZE}&include-inputs=true", json=POINTS
+    )
+
+    assert response.status_code == 200
+    inputs = expected_inputs(POINTS)
+    np.testing.assert_array_equal(response.json["inputs"], inputs)
+    np.testing.assert_array_equal(response.json["predictions"], inputs[..., :1] * 2)
+    # The points of each date are fetched together.
+    assert sorted((date.day, len(points)) for (date, points) in patch_requests) == [
+        (2, 2),
+        (3, 2),
+        (4, 1),
+    ]
+
+
+def test_predict_batch_npz(client: FlaskClient) -> None:
+    response = client.post(
+        f"/predict-batch?patch-size={PATCH_SIZE}&include-inputs=true&format=npz",
+        json=POINTS,
+    )
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/octet-stream"
+    arrays = np.load(io.BytesIO(response.data))
+    inputs = expected_inputs(POINTS)
+    np.testing.assert_array_equal(arrays["inputs"], inputs)
+    np.testing.assert_array_equal(arrays["predictions"], inputs[..., :1] * 2)
+
+
+@pytest.mark.parametrize(
+    "points",
+    [
+        [],
+        {"date": "2019-09-02T18:00", "lat": 25.5, "lon": -78.5},
+        POINTS * 2,
+        [{"date": "2019-09-02T18:00", "lat": 25.5}],
+        [{"date": "not a date", "lat": 25.5, "lon": -78.5}],
+    ],
+    ids=["empty", "not a list", "too many points", "missing key", "invalid date"],
+)
+def test_predict_batch_invalid_points(
+    client: FlaskClient, monkeypatch: pytest.MonkeyPatch, points: object
+) -> None:
+    monkeypatch.setattr(main, "MAX_BATCH_SIZE", len(POINTS))
+
+    response = client.post("/predict-batch", json=points)
+
+    assert response.status_code == 400
+
+
+def test_predict_batch_unknown_format(client: FlaskClient) -> None:
+    response = client.post("/predict-batch?format=xml", json=POINTS)
+
+    assert response.status_code == 400
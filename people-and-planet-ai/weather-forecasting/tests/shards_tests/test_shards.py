@@ -0,0 +1,195 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from weather.shards import ShardedDataset, transform_batch, write_shards
+
+EXAMPLES_PER_FILE = 4
+EXAMPLES_PER_SHARD = 6
+
+
+def write_data_file(data_path: str, name: str, seed: int) -> tuple:
+    rng = np.random.default_rng(seed)
+    inputs = rng.random((EXAMPLES_PER_FILE, 5, 5, 2), dtype=np.float32)
+    labels = rng.random((EXAMPLES_PER_FILE, 5, 5, 1), dtype=np.float32)
+    with open(os.path.join(data_path, name), "wb") as f:
+        np.savez(f, inputs=inputs, labels=labels)
+    return (inputs, labels)
+
+
+@pytest.fixture
+def data_path(tmp_path: os.PathLike) -> str:
+    path = os.path.join(tmp_path, "data")
+    os.makedirs(path)
+    for i in range(3):
+        write_data_file(path, f"{i}.npz", seed=i)
+    return path
+
+
+@pytest.fixture
+def shards_path(tmp_path: os.PathLike, data_path: str) -> str:
+    path = os.path.join(tmp_path, "shards")
+    write_shards(data_path, path, EXAMPLES_PER_SHARD)
+    return path
+
+
+def read_examples(data_path: str) -> tuple[np.ndarray, np.ndarray]:
+    """Reads all the examples of the data files, in the order of the shards."""
+    files = sorted(os.listdir(data_path))
+    data = [np.load(os.path.join(data_path, name)) for name in files]
+    return (
+        np.concatenate([npz["inputs"] for npz in data]),
+        np.concatenate([npz["labels"] for npz in data]),
+    )
+
+
+def old_augmentation(values: np.ndarray, transform: int) -> np.ndarray:
+    """The augmentation of the trainer before the shards, for one transform."""
+    rotated = np.rot90(values, transform % 4, (1, 2))
+    return np.flip(rotated, axis=1) if transform >= 4 else rotated
+
+
+def test_write_shards(data_path: str, shards_path: str) -> None:
+    dataset = ShardedDataset(shards_path)
+
+    # Data files are added to a shard until it has at least 6 examples.
+    assert [len(x) for x in dataset.inputs] == [8, 4]
+    (inputs, labels) = read_examples(data_path)
+    np.testing.assert_array_equal(np.concatenate(dataset.inputs), inputs)
+    np.testing.assert_array_equal(np.concatenate(dataset.labels), labels)
+
+
+def test_write_shards_reuses_shards(data_path: str, shards_path: str) -> None:
+    index_file = os.path.join(shards_path, "shards.json")
+    modified = os.path.getmtime(index_file)
+
+    write_shards(data_path, shards_path, EXAMPLES_PER_SHARD)
+
+    assert os.path.getmtime(index_file) == modified
+
+
+def test_write_shards_rebuilds_when_files_change(
+    tmp_path: os.PathLike, data_path: str, shards_path: str
+) -> None:
+    write_data_file(data_path, "3.npz", seed=3)
+    write_shards(data_path, shards_path, EXAMPLES_PER_SHARD)
+
+    dataset = ShardedDataset(shards_path)
+    assert len(dataset) == 4 * EXAMPLES_PER_FILE
+    np.testing.assert_array_equal(
+        np.concatenate(dataset.inputs), read_examples(data_path)[0]
+    )
+
+    # Another data path with fewer files, which leaves no stale shards.
+    other_path = os.path.join(tmp_path, "other")
+    os.makedirs(other_path)
+    write_data_file(other_path, "0.npz", seed=10)
+    write_shards(other_path, shards_path, EXAMPLES_PER_SHARD)
+
+    dataset = ShardedDataset(shards_path)
+    assert len(dataset) == EXAMPLES_PER_FILE
+    np.testing.assert_array_equal(dataset.inputs[0], read_examples(other_path)[0])
+    assert sorted(os.listdir(shards_path)) == [
+        "inputs-00000.npy",
+        "labels-00000.npy",
+        "shards.json",
+    ]
+
+
+def test_get_batch_across_shards(data_path: str, shards_path: str) -> None:
+    dataset = ShardedDataset(shards_path)
+    (inputs, labels) = read_examples(data_path)
+    indices = np.array([0, 6, 7, 8, 11])
+
+    (batch_inputs, batch_labels) = dataset.get_batch(indices)
+
+    np.testing.assert_array_equal(batch_inputs, inputs[indices])
+    np.testing.assert_array_equal(batch_labels, labels[indices])
+
+
+def test_iter_batches_in_index_order(data_path: str, shards_path: str) -> None:
+    dataset = ShardedDataset(shards_path)
+    (inputs, labels) = read_examples(data_path)
+    indices = np.array([1, 2, 5, 7, 8, 9, 10])
+
+    batches = list(dataset.iter_batches(indices, batch_size=3))
+
+    assert [len(x) for (x, _) in batches] == [3, 3, 1]
+    np.testing.assert_array_equal(
+        np.concatenate([x for (x, _) in batches]), inputs[indices]
+    )
+    np.testing.assert_array_equal(
+        np.concatenate([y for (_, y) in batches]), labels[indices]
+    )
+
+
+def test_iter_batches_augment_yields_every_transform_once(
+    data_path: str, shards_path: str
+) -> None:
+    dataset = ShardedDataset(shards_path)
+    (inputs, labels) = read_examples(data_path)
+    indices = np.array([0, 3, 6, 9, 11])
+    # Every (example, transform) pair by the bytes of its transformed inputs.
+    pairs = {
+        old_augmentation(inputs[[i]], t).tobytes(): (i, t)
+        for i in indices
+        for t in range(8)
+    }
+    assert len(pairs) == len(indices) * 8
+
+    yielded = []
+    for batch_inputs, batch_labels in dataset.iter_batches(
+        indices, batch_size=7, shuffle=True, augment=True, seed=1
+    ):
+        for x, y in zip(batch_inputs, batch_labels):
+            (i, t) = pairs[x[None].tobytes()]
+            np.testing.assert_array_equal(y[None], old_augmentation(labels[[i]], t))
+            yielded.append((i, t))
+
+    assert sorted(yielded) == sorted(pairs.values())
+
+
+@pytest.mark.parametrize("transform", range(8))
+def test_transform_batch(transform: int) -> None:
+    rng = np.random.default_rng(transform)
+    inputs = rng.random((3, 5, 5, 2), dtype=np.float32)
+    labels = rng.random((3, 5, 5, 1), dtype=np.float32)
+    # Copies, since the batch is transformed in place.
+    expected_inputs = old_augmentation(inputs, transform).copy()
+    expected_labels = old_augmentation(labels, transform).copy()
+
+    transform_batch(inputs, labels, np.full(3, transform))
+
+    np.testing.assert_array_equal(inputs, expected_inputs)
+    np.testing.assert_array_equal(labels, expected_labels)
+
+
+def test_iter_batches_stops_when_abandoned(shards_path: str) -> None:
+    dataset = ShardedDataset(shards_path)
+    threads = set(threading.enumerate())
+
+    batches = dataset.iter_batches(np.arange(len(dataset)), batch_size=1, prefetch=1)
+    next(batches)
+    assert set(threading.enumerate()) != threads
+    # The producer is blocked on the full queue until the generator is closed.
+    batches.close()
+
+    assert set(threading.enumerate()) == threads
@@ -15,46 +15,111 @@
 # [START pubsub_to_gcs]
 import argparse
 from datetime import datetime
+import gzip
+import json
 import logging
+import math
 import random
 
 from apache_beam import (
+    CombineGlobally,
     DoFn,
     GroupByKey,
     io,
+    Map,
     ParDo,
     Pipeline,
     PTransform,
     WindowInto,
     WithKeys,
 )
+from apache_beam.coders import StrUtf8Coder, TupleCoder, VarIntCoder
 from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.pvalue import AsSingleton
+from apache_beam.transforms.timeutil import TimeDomain
+from apache_beam.transforms.userstate import (
+    BagStateSpec,
+    CombiningValueStateSpec,
+    on_timer,
+    TimerSpec,
+)
 from apache_beam.transforms.window import FixedWindows
 
+# Supported output file formats and compressions with their file name extensions.
+OUTPUT_FORMATS = {"text": "", "json": ".json", "avro": ".avro", "parquet": ".parquet"}
+COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
 
-class GroupMessagesByFixedWindows(PTransform):
-    """A composite transform that groups Pub/Sub messages based on publish time
-    and outputs a list of tuples, each containing a message and its publish time.
+# Schema of the records written to Avro and Parquet files.
+RECORD_FIELDS = ["message_body", "publish_time"]
+AVRO_SCHEMA = {
+    "type": "record",
+    "name": "Message",
+    "fields": [{"name": name, "type": "string"} for name in RECORD_FIELDS],
+}
+
+
+class ShardMessagesByFixedWindows(PTransform):
+    """A composite transform that windows Pub/Sub messages based on publish time
+    and outputs tuples of a shard ID and a tuple of a message and its publish time.
     """
 
-    def __init__(self, window_size, num_shards=5):
+    def __init__(self, window_size, num_shards=5, target_shard_bytes=None):
         # Set window size to 60 seconds.
         self.window_size = int(window_size * 60)
         self.num_shards = num_shards
+        # If set, the number of shards in each window is derived from
+        # the window's byte volume instead of using a fixed `num_shards`.
+        self.target_shard_bytes = target_shard_bytes
 
     def expand(self, pcoll):
-        return (
+        windowed = (
             pcoll
             # Bind window info to each element using element timestamp (or publish time).
             | "Window into fixed intervals"
             >> WindowInto(FixedWindows(self.window_size))
             | "Add timestamp to windowed elements" >> ParDo(AddTimestamp())
-            # Assign a random key to each windowed element based on the number of shards.
-            | "Add key" >> WithKeys(lambda _: random.randint(0, self.num_shards - 1))
-            # Group windowed elements by key. All the elements in the same window must fit
-            # memory for this. If not, you need to use `beam.util.BatchElements`.
-            | "Group by key" >> GroupByKey()
         )
+        if self.target_shard_bytes:
+            # Sum up the size of the messages in each window, so each window
+            # gets enough shards for files of about `target_shard_bytes`.
+            window_bytes = (
+                windowed
+                | "Get message size"
+                >> Map(lambda element: len(element[0].encode("utf-8")))
+                | "Sum window bytes" >> CombineGlobally(sum).without_defaults()
+            )
+            keyed = windowed | "Add key" >> ParDo(
+                AddShardKey(self.target_shard_bytes), AsSingleton(window_bytes)
+            )
+        else:
+            # Assign a random key to each windowed element based on the number of shards.
+            keyed = windowed | "Add key" >> WithKeys(
+                lambda _: random.randint(0, self.num_shards - 1)
+            )
+        return keyed
+
+
+class GroupMessagesByFixedWindows(ShardMessagesByFixedWindows):
+    """A composite transform that groups Pub/Sub messages based on publish time
+    and outputs a list of tuples, each containing a message and its publish time.
+    """
+
+    def expand(self, pcoll):
+        # Group windowed elements by key. All the elements in the same window must fit
+        # memory for this. If not, use `SpillToGCS` that does not group the elements.
+        return super().expand(pcoll) | "Group by key" >> GroupByKey()
+
+
+class AddShardKey(DoFn):
+    def __init__(self, target_shard_bytes):
+        self.target_shard_bytes = target_shard_bytes
+
+    def process(self, element, window_bytes):
+        """Assigns a random shard key to the element. The number of shards
+        is proportional to the total size of the messages in the window.
+        """
+        num_shards = max(1, math.ceil(window_bytes / self.target_shard_bytes))
+        yield random.randint(0, num_shards - 1), element
 
 
 class AddTimestamp(DoFn):
@@ -71,40 +136,291 @@ class AddTimestamp(DoFn):
 
 
 class WriteToGCS(DoFn):
-    def __init__(self, output_path):
+    def __init__(
+        self,
+        output_path,
+        output_format="text",
+        compression=None,
+        buffer_size=8 * 1024 * 1024,
+    ):
         self.output_path = output_path
+        self.output_format = output_format
+        self.compression = compression
+        self.buffer_size = buffer_size
 
-    def process(self, key_value, window=DoFn.WindowParam):
-        """Write messages in a batch to Google Cloud Storage."""
+    def _open_compressed(self, f):
+        """Wraps the file in a stream that compresses the written bytes."""
+        if self.compression == "gzip":
+            return gzip.GzipFile(fileobj=f, mode="wb")
+        if self.compression == "zstd":
+            import zstandard
+
+            return zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+        return None
+
+    def _write_lines(self, f, lines):
+        """Writes encoded lines through a large buffer to reduce the number
+        of writes to the underlying GCS stream.
+        """
+        compressed = self._open_compressed(f)
+        out = compressed or f
+        buffer = bytearray()
+        for line in lines:
+            buffer += line.encode()
+            if len(buffer) >= self.buffer_size:
+                out.write(buffer)
+                buffer.clear()
+        if buffer:
+            out.write(buffer)
+        if compressed:
+            compressed.close()
+
+    def _write_avro(self, f, batch):
+        import fastavro
 
+        codec = {"gzip": "deflate", "zstd": "zstandard"}.get(self.compression, "null")
+        records = (dict(zip(RECORD_FIELDS, message)) for message in batch)
+        fastavro.writer(f, AVRO_SCHEMA, records, codec=codec)
+
+    def _write_parquet(self, f, batch, row_group_size=100000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([(name, pa.string()) for name in RECORD_FIELDS])
+
+        def to_table(rows):
+            columns = [pa.array(column, pa.string()) for column in zip(*rows)]
+            return pa.Table.from_arrays(columns, schema=schema)
+
+        writer = pq.ParquetWriter(f, schema, compression=self.compression or "none")
+        try:
+            rows = []
+            for message in batch:
+                rows.append(message)
+                if len(rows) == row_group_size:
+                    writer.write_table(to_table(rows))
+                    rows = []
+            if rows:
+                writer.write_table(to_table(rows))
+        finally:
+            writer.close()
+
+    def _filename(self, shard_id, window):
         ts_format = "%H:%M"
         window_start = window.start.to_utc_datetime().strftime(ts_format)
         window_end = window.end.to_utc_datetime().strftime(ts_format)
-        shard_id, batch = key_value
         filename = "-".join([self.output_path, window_start, window_end, str(shard_id)])
+        if self.output_format in ("text", "json"):
+            filename += (
+                OUTPUT_FORMATS[self.output_format] + COMPRESSIONS[self.compression]
+            )
+        else:
+            # Avro and Parquet files are compressed internally.
+            filename += OUTPUT_FORMATS[self.output_format]
+        return filename
 
+    def process(self, key_value, window=DoFn.WindowParam):
+        """Write messages in a batch to Google Cloud Storage."""
+
+        shard_id, batch = key_value
+        self._write_file(self._filename(shard_id, window), batch)
+
+    def _write_file(self, filename, batch):
         with io.gcsio.GcsIO().open(filename=filename, mode="w") as f:
-            for message_body, publish_time in batch:
-                f.write(f"{message_body},{publish_time}\n".encode())
+            if self.output_format == "avro":
+                self._write_avro(f, batch)
+            elif self.output_format == "parquet":
+                self._write_parquet(f, batch)
+            elif self.output_format == "json":
+                self._write_lines(
+                    f,
+                    (
+                        json.dumps(dict(zip(RECORD_FIELDS, message))) + "\n"
+                        for message in batch
+                    ),
+                )
+            else:
+                self._write_lines(
+                    f,
+                    (
+                        f"{message_body},{publish_time}\n"
+                        for message_body, publish_time in batch
+                    ),
+                )
+
+
+class SpillToGCS(WriteToGCS):
+    """Writes messages to Google Cloud Storage as they arrive, without grouping
+    all messages of a window in memory.
+
+    Messages of each window and shard are buffered in state until the buffer
+    reaches `max_buffered_messages` or `max_buffered_bytes`. Then the buffer is
+    spilled to a part file. When the window closes, the part files are
+    concatenated into the same file that `WriteToGCS` writes for the window and shard.
+    """
+
+    BUFFER = BagStateSpec("buffer", TupleCoder([StrUtf8Coder(), StrUtf8Coder()]))
+    BUFFERED_MESSAGES = CombiningValueStateSpec("buffered_messages", VarIntCoder(), sum)
+    BUFFERED_BYTES = CombiningValueStateSpec("buffered_bytes", VarIntCoder(), sum)
+    PARTS = CombiningValueStateSpec("parts", VarIntCoder(), sum)
+    WINDOW_END = TimerSpec("window_end", TimeDomain.WATERMARK)
 
+    def __init__(
+        self,
+        output_path,
+        output_format="text",
+        compression=None,
+        max_buffered_messages=10000,
+        max_buffered_bytes=16 * 1024 * 1024,
+    ):
+        if output_format not in ("text", "json"):
+            # Only line based files (and gzip and zstd streams) can be concatenated.
+            raise ValueError(f"Spilling is not supported for {output_format} files")
+        super().__init__(output_path, output_format, compression)
+        self.max_buffered_messages = max_buffered_messages
+        self.max_buffered_bytes = max_buffered_bytes
+
+    @staticmethod
+    def _part_filename(filename, part):
+        return f"{filename}.part-{part:05}"
+
+    def _spill(self, filename, buffer, buffered_messages, buffered_bytes, parts):
+        part = parts.read()
+        self._write_file(self._part_filename(filename, part), buffer.read())
+        parts.add(1)
+        buffer.clear()
+        buffered_messages.clear()
+        buffered_bytes.clear()
+
+    def process(
+        self,
+        key_value,
+        window=DoFn.WindowParam,
+        buffer=DoFn.StateParam(BUFFER),
+        buffered_messages=DoFn.StateParam(BUFFERED_MESSAGES),
+        buffered_bytes=DoFn.StateParam(BUFFERED_BYTES),
+        parts=DoFn.StateParam(PARTS),
+        window_end=DoFn.TimerParam(WINDOW_END),
+    ):
+        """Buffer a message and spill the buffer to a part file when it is full."""
+
+        shard_id, message = key_value
+        window_end.set(window.max_timestamp())
+        buffer.add(message)
+        buffered_messages.add(1)
+        buffered_bytes.add(len(message[0].encode("utf-8")))
+        if (
+            buffered_messages.read() >= self.max_buffered_messages
+            or buffered_bytes.read() >= self.max_buffered_bytes
+        ):
+            self._spill(
+                self._filename(shard_id, window),
+                buffer,
+                buffered_messages,
+                buffered_bytes,
+                parts,
+            )
+
+    @on_timer(WINDOW_END)
+    def on_window_end(
+        self,
+        shard_id=DoFn.KeyParam,
+        window=DoFn.WindowParam,
+        buffer=DoFn.StateParam(BUFFER),
+        buffered_messages=DoFn.StateParam(BUFFERED_MESSAGES),
+        buffered_bytes=DoFn.StateParam(BUFFERED_BYTES),
+        parts=DoFn.StateParam(PARTS),
+    ):
+        """Write the window's file for the shard from the part files and the buffer."""
+
+        filename = self._filename(shard_id, window)
+        if not parts.read():
+            # Nothing was spilled, so the buffer holds all messages of the window.
+            self._write_file(filename, buffer.read())
+        else:
+            if buffered_messages.read():
+                self._spill(filename, buffer, buffered_messages, buffered_bytes, parts)
+            part_filenames = [
+                self._part_filename(filename, part) for part in range(parts.read())
+            ]
+            gcs = io.gcsio.GcsIO()
+            with gcs.open(filename=filename, mode="w") as f:
+                for part_filename in part_filenames:
+                    with gcs.open(filename=part_filename, mode="r") as part_file:
+                        for chunk in iter(
+                            lambda: part_file.read(self.buffer_size), b""
+                        ):
+                            f.write(chunk)
+            gcs.delete_batch(part_filenames)
+        buffer.clear()
+        buffered_messages.clear()
+        buffered_bytes.clear()
+        parts.clear()
+
+
+def run(
+    input_topic,
+    output_path,
+    window_size=1.0,
+    num_shards=5,
+    pipeline_args=None,
+    output_format="text",
+    compression=None,
+    target_shard_bytes=None,
+    max_buffered_messages=None,
+    max_buffered_bytes=None,
+):
+    if (max_buffered_messages or max_buffered_bytes) and target_shard_bytes:
+        # The window's byte volume is only known when the window closes,
+        # so spilled messages could not be assigned to shards before that.
+        raise ValueError(
+            "target_shard_bytes cannot be combined with max_buffered_messages "
+            "or max_buffered_bytes, use num_shards instead"
+        )
 
-def run(input_topic, output_path, window_size=1.0, num_shards=5, pipeline_args=None):
     # Set `save_main_session` to True so DoFns can access globally imported modules.
     pipeline_options = PipelineOptions(
         pipeline_args, streaming=True, save_main_session=True
     )
 
     with Pipeline(options=pipeline_options) as pipeline:
-        (
+        messages = (
             pipeline
             # Because `timestamp_attribute` is unspecified in `ReadFromPubSub`, Beam
             # binds the publish time returned by the Pub/Sub server for each message
             # to the element's timestamp parameter, accessible via `DoFn.TimestampParam`.
             # https://beam.apache.org/releases/pydoc/current/apache_beam.io.gcp.pubsub.html#apache_beam.io.gcp.pubsub.ReadFromPubSub
             | "Read from Pub/Sub" >> io.ReadFromPubSub(topic=input_topic)
-            | "Window into" >> GroupMessagesByFixedWindows(window_size, num_shards)
-            | "Write to GCS" >> ParDo(WriteToGCS(output_path))
         )
+        if max_buffered_messages or max_buffered_bytes:
+            # Stream the messages to GCS so worker memory does not depend on window size.
+            (
+                messages
+                | "Window into"
+                >> ShardMessagesByFixedWindows(
+                    window_size, num_shards, target_shard_bytes
+                )
+                | "Spill to GCS"
+                >> ParDo(
+                    SpillToGCS(
+                        output_path,
+                        output_format,
+                        compression,
+                        max_buffered_messages or 10000,
+                        max_buffered_bytes or 16 * 1024 * 1024,
+                    )
+                )
+            )
+        else:
+            (
+                messages
+                | "Window into"
+                >> GroupMessagesByFixedWindows(
+                    window_size, num_shards, target_shard_bytes
+                )
+                | "Write to GCS"
+                >> ParDo(WriteToGCS(output_path, output_format, compression))
+            )
 
 
 if __name__ == "__main__":
@@ -132,7 +448,47 @@ if __name__ == "__main__":
         default=5,
         help="Number of shards to use when writing windowed elements to GCS.",
     )
+    parser.add_argument(
+        "--target_shard_bytes",
+        type=int,
+        default=None,
+        help="If set, the number of shards in each window is chosen to write "
+        "files of about this size instead of using `num_shards`.",
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=list(OUTPUT_FORMATS),
+        default="text",
+        help="Format of the output files.",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=[c for c in COMPRESSIONS if c],
+        default=None,
+        help="Compression of the output files.",
+    )
+    parser.add_argument(
+        "--max_buffered_messages",
+        type=int,
+        default=None,
+        help="If set, messages are streamed to GCS without grouping whole windows "
+        "in memory, spilling to part files after this number of messages per shard.",
+    )
+    parser.add_argument(
+        "--max_buffered_bytes",
+        type=int,
+        default=None,
+        help="If set, messages are streamed to GCS without grouping whole windows "
+        "in memory, spilling to part files after this number of bytes per shard.",
+    )
     known_args, pipeline_args = parser.parse_known_args()
+    if known_args.target_shard_bytes and (
+        known_args.max_buffered_messages or known_args.max_buffered_bytes
+    ):
+        parser.error(
+            "--target_shard_bytes cannot be combined with --max_buffered_messages "
+            "or --max_buffered_bytes"
+        )
 
     run(
         known_args.input_topic,
@@ -140,5 +496,10 @@ if __name__ == "__main__":
         known_args.window_size,
         known_args.num_shards,
         pipeline_args,
+        known_args.output_format,
+        known_args.compression,
+        known_args.target_shard_bytes,
+        known_args.max_buffered_messages,
+        known_args.max_buffered_bytes,
     )
 # [END pubsub_to_gcs]
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
+import json
 import os
 from unittest import mock
 import uuid
@@ -21,7 +23,7 @@ from apache_beam.testing.test_pipeline import TestPipeline
 from apache_beam.testing.test_stream import TestStream
 from apache_beam.testing.test_utils import TempDir
 from apache_beam.transforms.window import TimestampedValue
-
+import pytest
 
 import PubSubToGCS
 
@@ -66,3 +68,100 @@ def test_pubsub_to_gcs():
 
     # Clean up.
     gcs_client.delete_batch(list(files))
+
+
+@mock.patch("apache_beam.Pipeline", TestPipeline)
+@mock.patch(
+    "apache_beam.io.ReadFromPubSub",
+    lambda topic: (
+        TestStream()
+        .advance_watermark_to(0)
+        .advance_processing_time(30)
+        .add_elements([TimestampedValue(b"a", 1575937195)])
+        .advance_processing_time(30)
+        .add_elements([TimestampedValue(b"b", 1575937225)])
+        .advance_watermark_to_infinity()
+    ),
+)
+def test_pubsub_to_gcs_compressed_json():
+    PubSubToGCS.run(
+        input_topic="unused",  # mocked by TestStream
+        output_path=f"gs://{BUCKET}/pubsub/{UUID}/json/output",
+        window_size=1,  # 1 minute
+        pipeline_args=[
+            "--project",
+            PROJECT,
+            "--temp_location",
+            TempDir().get_path(),
+        ],
+        output_format="json",
+        compression="gzip",
+        target_shard_bytes=1024,
+    )
+
+    # Check the content of the output files on GCS.
+    gcs_client = GcsIO()
+    files = gcs_client.list_prefix(f"gs://{BUCKET}/pubsub/{UUID}/json")
+    assert len(files) > 0
+    messages = []
+    for file in files:
+        assert file.endswith(".json.gz")
+        with gcs_client.open(file) as f:
+            lines = gzip.decompress(f.read()).decode().splitlines()
+        messages.extend(json.loads(line)["message_body"] for line in lines)
+    assert sorted(messages) == ["a", "b"]
+
+    # Clean up.
+    gcs_client.delete_batch(list(files))
+
+
+@mock.patch("apache_beam.Pipeline", TestPipeline)
+@mock.patch(
+    "apache_beam.io.ReadFromPubSub",
+    lambda topic: (
+        TestStream()
+        .advance_watermark_to(0)
+        .advance_processing_time(30)
+        .add_elements([TimestampedValue(b"a", 1575937195)])
+        .advance_processing_time(30)
+        .add_elements([TimestampedValue(b"b", 1575937196)])
+        .advance_processing_time(30)
+        .add_elements([TimestampedValue(b"c", 1575937197)])
+        .advance_watermark_to_infinity()
+    ),
+)
+def test_pubsub_to_gcs_spill():
+    PubSubToGCS.run(
+        input_topic="unused",  # mocked by TestStream
+        output_path=f"gs://{BUCKET}/pubsub/{UUID}/spill/output",
+        window_size=1,  # 1 minute
+        num_shards=1,
+        pipeline_args=[
+            "--project",
+            PROJECT,
+            "--temp_location",
+            TempDir().get_path(),
+        ],
+        max_buffered_messages=2,
+    )
+
+    # Check that the parts were concatenated into a single file per window.
+    gcs_client = GcsIO()
+    files = gcs_client.list_prefix(f"gs://{BUCKET}/pubsub/{UUID}/spill")
+    assert len(files) == 1
+    with gcs_client.open(list(files)[0]) as f:
+        lines = f.read().decode().splitlines()
+    assert sorted(line.split(",")[0] for line in lines) == ["a", "b", "c"]
+
+    # Clean up.
+    gcs_client.delete_batch(list(files))
+
+
+def test_pubsub_to_gcs_spill_rejects_target_shard_bytes():
+    with pytest.raises(ValueError):
+        PubSubToGCS.run(
+            input_topic="unused",
+            output_path=f"gs://{BUCKET}/pubsub/{UUID}/unused/output",
+            target_shard_bytes=1024,
+            max_buffered_messages=2,
+        )
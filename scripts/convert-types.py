@@ -20,30 +20,42 @@ For more information, see https://peps.python.org/pep-0585
 
 To run from the repository's root directory:
     python convert-types.py
+
+Files are converted in parallel processes. The files that were converted or
+had nothing to convert are recorded in a cache file, so they are skipped on
+the next run unless they change.
 """
 
 from __future__ import annotations
 
+import ast
 from collections.abc import Callable, Iterator
+from concurrent import futures
+from contextlib import nullcontext
 import difflib
 from glob import glob
+import hashlib
+import json
 import logging
+import os
 import re
 import sys
-from typing import NamedTuple, TypeVar
+from typing import NamedTuple
 
 # TODO:
-# - False positives with lambdas and dict comprehensions due to the `:` misinterpreted as a type hint
 # - Sort imports case insensitive (e.g. PIL, Flask)
-# - Type hint arguments can be lists like `Callable[[a, b], c]`
 
 # Cases not covered:
 # - Multi-line imports like `from M import (\nA,\nB,\n)`
 # - Importing `typing` directly like `import typing` and `x: typing.Any`
-# - Parsing types with `|` syntax like Union or Optional
 # - typing.re.Match --> re.Match
 # - typing.re.Pattern --> re.Pattern
 
+# Files without a `from typing import` line have nothing to convert.
+TYPING_IMPORT = re.compile(rb"^from typing import ", re.MULTILINE)
+
+DEFAULT_CACHE_FILE = ".convert-types-cache.json"
+
 
 BUILTIN_TYPES = {"Tuple", "List", "Dict", "Set", "FrozenSet", "Type"}
 COLLECTIONS_TYPES = {"Deque", "DefaultDict", "OrderedDict", "Counter", "ChainMap"}
@@ -89,67 +101,86 @@ RENAME_TYPES = {
     "AsyncContextManager": "AbstractAsyncContextManager",  # contextlib
 }
 
-# Parser a = String -> (a, String)
-a = TypeVar("a")
-Parser = Callable[[str], tuple[a, str]]
+# Changes to this script invalidate the cache.
+with open(__file__, "rb") as f:
+    SCRIPT_DIGEST = hashlib.sha256(f.read()).hexdigest()
 
 
-class TypeHint(NamedTuple):
-    name: str
-    args: list[TypeHint]
+class FileResult(NamedTuple):
+    file_path: str
+    # The digest of the file's content, None if the file couldn't be processed.
+    digest: str | None
+    # The converted content, None if there is nothing to convert.
+    after: str | None
 
-    def __repr__(self) -> str:
-        match (self.name, self.args):
-            case ("Optional", [x]):
-                return f"{x} | None"
-            case ("Union", args):
-                return " | ".join(map(str, args))
-            case (name, []):
-                return name
-            case (name, args):
-                return f"{name}[{', '.join(map(str, args))}]"
 
-    def patch(self, types: set[str]) -> TypeHint:
-        if self.name in types:
-            name = RENAME_TYPES.get(self.name, self.name)
-        else:
-            name = self.name
-        return TypeHint(name, [arg.patch(types) for arg in self.args])
+def convert(before: str) -> str:
+    """Returns the source with the type hints converted to follow PEP-0585."""
+    lines = [line.rstrip() for line in before.splitlines()]
+    if types := find_typing_imports(lines):
+        lines = insert_import_annotations(lines)
+        lines = [patched for line in lines for patched in patch_imports(line)]
+        lines = sort_imports(lines)
+        return patch_type_hints("\n".join(lines), types) + "\n"
+    return before
 
 
-def patch_file(file_path: str, dry_run: bool = False, quiet: bool = False) -> None:
-    with open(file_path) as f:
-        before = f.read()
+def check_file(file_path: str, cached_digest: str | None = None) -> FileResult:
+    """Converts the file's content without writing it.
+
+    Files whose digest matches cached_digest are not converted again.
+    """
     try:
-        lines = [line.rstrip() for line in before.splitlines()]
-        if types := find_typing_imports(lines):
-            lines = insert_import_annotations(lines)
-            lines = [patched for line in lines for patched in patch_imports(line)]
-            lines = sort_imports(lines)
-            after = patch_type_hints("\n".join(lines), types) + "\n"
-            if before == after:
-                return
-
-            if not dry_run:
-                with open(file_path, "w") as f:
-                    f.write(after)
-                print(file_path)
-            elif not quiet:
-                print(f"| {file_path}")
-                print(f"+--{'-' * len(file_path)}")
-                diffs = difflib.context_diff(
-                    before.splitlines(keepends=True),
-                    after.splitlines(keepends=True),
-                    fromfile="Before changes",
-                    tofile="After changes",
-                    n=1,
-                )
-                sys.stdout.writelines(diffs)
-                print(f"+{'=' * 100}")
-                print("| Press [ENTER] to continue to the next file")
-                input()
+        with open(file_path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if digest == cached_digest or not TYPING_IMPORT.search(content):
+            return FileResult(file_path, digest, None)
+        before = content.decode()
+        after = convert(before)
+        return FileResult(file_path, digest, after if after != before else None)
     except Exception:
         logging.exception(f"Could not process file: {file_path}")
+        return FileResult(file_path, None, None)
+
+
+def apply_result(
+    result: FileResult, dry_run: bool = False, quiet: bool = False
+) -> bool:
+    """Writes or shows the converted file.
+
+    Returns True if the file is up to date on disk.
+    """
+    file_path, _, after = result
+    if after is None:
+        return result.digest is not None
+
+    if not dry_run:
+        with open(file_path, "w") as f:
+            f.write(after)
+        print(file_path)
+        return True
+    if not quiet:
+        with open(file_path) as f:
+            before = f.read()
+        print(f"| {file_path}")
+        print(f"+--{'-' * len(file_path)}")
+        diffs = difflib.context_diff(
+            before.splitlines(keepends=True),
+            after.splitlines(keepends=True),
+            fromfile="Before changes",
+            tofile="After changes",
+            n=1,
+        )
+        sys.stdout.writelines(diffs)
+        print(f"+{'=' * 100}")
+        print("| Press [ENTER] to continue to the next file")
+        input()
+    return False
+
+
+def patch_file(file_path: str, dry_run: bool = False, quiet: bool = False) -> None:
+    apply_result(check_file(file_path), dry_run, quiet)
 
 
 def insert_import_annotations(lines: list[str]) -> list[str]:
@@ -247,64 +278,152 @@ def patch_imports(line: str) -> Iterator[str]:
         yield f"from typing import {', '.join(names)}"
 
 
-def patch_type_hints(txt: str, types: set[str]) -> str:
-    if m := re.search(rf"(?:->|:) *(\w+)", txt):
-        (typ, left) = parse_type_hint(txt[m.start(1) :])
-        return f"{txt[:m.start(1)]}{typ.patch(types)}{patch_type_hints(left, types)}"
-    return txt
-
-
-# Parser combinators
-def parse_text(src: str, txt: str) -> tuple[str, str]:
-    if src.startswith(txt):
-        return (src[: len(txt)], src[len(txt) :])
-    raise SyntaxError("text")
-
-
-def parse_identifier(src: str) -> tuple[str, str]:
-    if m := re.search(r"[\w\._]+", src):
-        return (m.group(), src[m.end() :])
-    raise SyntaxError("name")
+def render_type_hint(
+    node: ast.expr, types: set[str], segment: Callable[[ast.expr], str]
+) -> str:
+    """Renders the type hint, replacing the imported typing types.
+
+    The parts of the type hint that don't need to change are rendered with
+    segment, which returns their source code.
+    """
+
+    def render(node: ast.expr) -> str:
+        return render_type_hint(node, types, segment)
+
+    match node:
+        case ast.Name(id=name) if name in types:
+            return RENAME_TYPES.get(name, name)
+        case ast.Subscript(value=ast.Name(id="Optional"), slice=arg) if (
+            "Optional" in types
+        ):
+            return f"{render(arg)} | None"
+        case ast.Subscript(value=ast.Name(id="Union"), slice=ast.Tuple(elts=args)) if (
+            "Union" in types
+        ):
+            return " | ".join(map(render, args))
+        case ast.Subscript(value=value, slice=ast.Tuple(elts=args)):
+            return f"{render(value)}[{', '.join(map(render, args))}]"
+        case ast.Subscript(value=value, slice=arg):
+            return f"{render(value)}[{render(arg)}]"
+        case ast.List(elts=args):
+            return f"[{', '.join(map(render, args))}]"
+    return segment(node)
+
+
+def find_type_hints(tree: ast.AST) -> Iterator[ast.expr]:
+    """Yields the annotations of arguments, return values and variables."""
+    for node in ast.walk(tree):
+        match node:
+            case ast.arg(annotation=ast.expr() as annotation):
+                yield annotation
+            case ast.FunctionDef(returns=ast.expr() as returns):
+                yield returns
+            case ast.AsyncFunctionDef(returns=ast.expr() as returns):
+                yield returns
+            case ast.AnnAssign(annotation=annotation):
+                yield annotation
 
 
-def parse_zero_or_more(src: str, parser: Parser[a]) -> tuple[list[a], str]:
-    try:
-        (x, src) = parser(src)
-        (xs, src) = parse_zero_or_more(src, parser)
-        return ([x] + xs, src)
-    except SyntaxError:
-        return ([], src)
-
-
-def parse_comma_separated(src: str, parser: Parser[a]) -> tuple[list[a], str]:
-    def parse_next(src: str) -> tuple[a, str]:
-        (_, src) = parse_text(src, ",")
-        (_, src) = parse_zero_or_more(src, lambda src: parse_text(src, " "))
-        return parser(src)
-
-    try:
-        (x, src) = parser(src)
-        (xs, src) = parse_zero_or_more(src, parse_next)
-        return ([x] + xs, src)
-    except SyntaxError:
-        return ([], src)
-
-
-def parse_type_hint(src: str) -> tuple[TypeHint, str]:
-    (name, src) = parse_identifier(src)
+def patch_type_hints(txt: str, types: set[str]) -> str:
+    """Converts the type hints in a single pass over the syntax tree.
+
+    Only the type hints that use the imported typing types are rewritten, the
+    rest of the source is kept as it is.
+    """
+    tree = ast.parse(txt)
+    # The AST offsets are in UTF-8 bytes.
+    source = txt.encode()
+    line_offsets = [0]
+    for line in source.splitlines(keepends=True):
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    def span(node: ast.expr) -> tuple[int, int]:
+        return (
+            line_offsets[node.lineno - 1] + node.col_offset,
+            line_offsets[node.end_lineno - 1] + node.end_col_offset,
+        )
+
+    def segment(node: ast.expr) -> str:
+        start, end = span(node)
+        return source[start:end].decode()
+
+    replacements = []
+    for hint in find_type_hints(tree):
+        if any(
+            isinstance(node, ast.Name) and node.id in types for node in ast.walk(hint)
+        ):
+            start, end = span(hint)
+            replacement = render_type_hint(hint, types, segment).encode()
+            replacements.append((start, end, replacement))
+
+    for start, end, replacement in sorted(replacements, reverse=True):
+        source = source[:start] + replacement + source[end:]
+    return source.decode()
+
+
+def load_cache(cache_file: str | None) -> dict:
+    if not cache_file:
+        return {}
     try:
-        (_, src) = parse_text(src, "[")
-        (args, src) = parse_comma_separated(src, parse_type_hint)
-        (_, src) = parse_text(src, "]")
-        return (TypeHint(name, args), src)
-    except SyntaxError:
-        return (TypeHint(name, []), src)
-
-
-def run(patterns: list[str], dry_run: bool = False, quiet: bool = False):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return cache["files"] if cache.get("script") == SCRIPT_DIGEST else {}
+
+
+def save_cache(cache_file: str | None, files: dict) -> None:
+    if cache_file:
+        with open(cache_file, "w") as f:
+            json.dump({"script": SCRIPT_DIGEST, "files": files}, f)
+
+
+def run(
+    patterns: list[str],
+    dry_run: bool = False,
+    quiet: bool = False,
+    jobs: int | None = None,
+    cache_file: str | None = DEFAULT_CACHE_FILE,
+):
+    cache = load_cache(cache_file)
+    file_paths = []
     for pattern in patterns:
         for filename in glob(pattern, recursive=True):
-            patch_file(filename, dry_run, quiet)
+            stat = os.stat(filename)
+            cached = cache.get(filename)
+            # Skips the files that didn't change without reading them.
+            if (
+                cached
+                and cached["mtime"] == stat.st_mtime_ns
+                and cached["size"] == stat.st_size
+            ):
+                continue
+            file_paths.append(filename)
+
+    def check(executor: futures.Executor | None) -> Iterator[FileResult]:
+        args = (file_paths, [cache.get(path, {}).get("digest") for path in file_paths])
+        if executor is None:
+            return map(check_file, *args)
+        return executor.map(check_file, *args, chunksize=32)
+
+    # The diffs of a dry run are shown one at a time, so there's no point in
+    # converting the files in parallel.
+    interactive = dry_run and not quiet
+    with (
+        futures.ProcessPoolExecutor(jobs) if not interactive else nullcontext()
+    ) as executor:
+        for result in check(executor):
+            if apply_result(result, dry_run, quiet):
+                stat = os.stat(result.file_path)
+                digest = result.digest
+                if result.after is not None:
+                    digest = hashlib.sha256(result.after.encode()).hexdigest()
+                cache[result.file_path] = {
+                    "mtime": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "digest": digest,
+                }
+    save_cache(cache_file, cache)
 
 
 if __name__ == "__main__":
@@ -317,6 +436,14 @@ if __name__ == "__main__":
     parser.add_argument("patterns", nargs="*", default=["**/*.py"])
     parser.add_argument("--dry-run", action="store_true")
     parser.add_argument("--quiet", action="store_true")
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Number of processes, defaults to CPUs"
+    )
+    parser.add_argument(
+        "--cache-file",
+        default=DEFAULT_CACHE_FILE,
+        help="File that records the up to date files, empty to disable the cache",
+    )
     args = parser.parse_args()
 
     run(**args.__dict__)
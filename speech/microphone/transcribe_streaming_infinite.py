@@ -20,24 +20,37 @@ To install using pip:
     pip install pyaudio
     pip install termcolor
 
+The audio can also be read from a file or stdin with raw LINEAR16 audio
+sampled at 16kHz, which does not require `pyaudio`.
+
 Example usage:
     python transcribe_streaming_infinite.py
+    python transcribe_streaming_infinite.py --input resources/quit.raw
+    cat resources/quit.raw | python transcribe_streaming_infinite.py --input -
 """
 
 # [START speech_transcribe_infinite_streaming]
 
+import argparse
+import bisect
+from collections import deque
 import queue
 import re
 import sys
+import threading
 import time
 
 from google.cloud import speech
-import pyaudio
 
 # Audio recording parameters
 STREAMING_LIMIT = 240000  # 4 minutes
+STREAM_OVERLAP = 10000  # 10 seconds
 SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2  # 16-bit samples
 CHUNK_SIZE = int(SAMPLE_RATE / 10)  # 100ms
+BYTES_PER_MS = SAMPLE_RATE * SAMPLE_WIDTH // 1000
+# Max size of the audio content in a single request
+MAX_REQUEST_BYTES = 25600
 
 RED = "\033[0;31m"
 GREEN = "\033[0;32m"
@@ -54,249 +67,487 @@ def get_current_time() -> int:
     return int(round(time.time() * 1000))
 
 
-class ResumableMicrophoneStream:
-    """Opens a recording stream as a generator yielding the audio chunks."""
+class AudioRingBuffer:
+    """A preallocated ring buffer of the most recent audio.
+
+    Positions are absolute byte offsets from the start of the audio, so
+    readers can replay the audio of a previous stream as long as it is
+    still in the buffer.
+    """
+
+    def __init__(self: object, capacity: int) -> None:
+        """Creates an empty ring buffer.
+
+        Args:
+        self: The class instance.
+        capacity: The buffer's size in bytes.
+
+        returns: None
+        """
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._condition = threading.Condition()
+        # (end position, time in MS) of the recent writes
+        self._write_times = deque(maxlen=4096)
+        self.end = 0
+        self.closed = False
+
+    @property
+    def start(self: object) -> int:
+        """The position of the oldest audio byte in the buffer."""
+        return max(0, self.end - self.capacity)
+
+    def write(self: object, data: bytes) -> None:
+        """Appends the audio data to the buffer, overwriting the oldest audio.
+
+        Args:
+        self: The class instance.
+        data: The audio data.
+
+        returns: None
+        """
+        size = len(data)
+        # Only the last `capacity` bytes of the data fit in the buffer.
+        data = memoryview(data)[-self.capacity :]
+        with self._condition:
+            offset = (self.end + size - len(data)) % self.capacity
+            first = min(len(data), self.capacity - offset)
+            self._view[offset : offset + first] = data[:first]
+            self._view[: len(data) - first] = data[first:]
+            self.end += size
+            self._write_times.append((self.end, get_current_time()))
+            self._condition.notify_all()
+
+    def close(self: object) -> None:
+        """Marks the end of the audio.
+
+        Args:
+        self: The class instance.
+
+        returns: None
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def read(
+        self: object, position: int, max_bytes: int, timeout: float = None
+    ) -> memoryview:
+        """Returns the audio that follows the position without copying it.
+
+        The view is valid until the buffer wraps around, so it should be
+        consumed right away.
+
+        Args:
+        self: The class instance.
+        position: The position to read from.
+        max_bytes: The max size of the returned audio.
+        timeout: Time in seconds to wait for new audio.
+
+        returns:
+            A view of up to max_bytes bytes, empty if there is no new audio
+            before timeout, or None if the buffer is closed and fully read.
+        """
+        with self._condition:
+            if self.end <= position and not self.closed:
+                self._condition.wait(timeout)
+            if self.end <= position:
+                return None if self.closed else self._view[:0]
+            if position < self.start:
+                raise ValueError("The audio at the position was overwritten.")
+            offset = position % self.capacity
+            size = min(max_bytes, self.end - position, self.capacity - offset)
+            return self._view[offset : offset + size]
+
+    def capture_time(self: object, position: int) -> int:
+        """Estimates the time in MS when the audio at the position was written.
+
+        Args:
+        self: The class instance.
+        position: The position of the audio.
+
+        returns:
+            The time in MS.
+        """
+        with self._condition:
+            write_times = list(self._write_times)
+        if not write_times:
+            return get_current_time()
+        index = bisect.bisect_left(write_times, (position,))
+        end, written = write_times[min(index, len(write_times) - 1)]
+        return written - (end - position) // BYTES_PER_MS
+
+
+class MicrophoneSource:
+    """Records audio from the microphone into the buffer."""
 
     def __init__(
         self: object,
+        buffer: AudioRingBuffer,
         rate: int,
         chunk_size: int,
     ) -> None:
-        """Creates a resumable microphone stream.
+        """Creates a microphone source.
 
         Args:
         self: The class instance.
-        rate: The audio file's sampling rate.
-        chunk_size: The audio file's chunk size.
+        buffer: The buffer to write the audio to.
+        rate: The audio's sampling rate.
+        chunk_size: The audio's chunk size.
 
         returns: None
         """
-        self._rate = rate
-        self.chunk_size = chunk_size
-        self._num_channels = 1
-        self._buff = queue.Queue()
-        self.closed = True
-        self.start_time = get_current_time()
-        self.restart_counter = 0
-        self.audio_input = []
-        self.last_audio_input = []
-        self.result_end_time = 0
-        self.is_final_end_time = 0
-        self.final_request_end_time = 0
-        self.bridging_offset = 0
-        self.last_transcript_was_final = False
-        self.new_stream = True
+        import pyaudio
+
+        self._pyaudio = pyaudio
+        self._buffer = buffer
         self._audio_interface = pyaudio.PyAudio()
         self._audio_stream = self._audio_interface.open(
             format=pyaudio.paInt16,
-            channels=self._num_channels,
-            rate=self._rate,
+            channels=1,
+            rate=rate,
             input=True,
-            frames_per_buffer=self.chunk_size,
+            frames_per_buffer=chunk_size,
             # Run the audio stream asynchronously to fill the buffer object.
             # This is necessary so that the input device's buffer doesn't
             # overflow while the calling thread makes network requests, etc.
             stream_callback=self._fill_buffer,
         )
 
-    def __enter__(self: object) -> object:
-        """Opens the stream.
+    def _fill_buffer(
+        self: object,
+        in_data: object,
+        *args: object,
+        **kwargs: object,
+    ) -> object:
+        """Continuously collect data from the audio stream, into the buffer.
 
         Args:
         self: The class instance.
+        in_data: The audio data as a bytes object.
+        args: Additional arguments.
+        kwargs: Additional arguments.
 
         returns: None
         """
-        self.closed = False
-        return self
+        self._buffer.write(in_data)
+        return None, self._pyaudio.paContinue
 
-    def __exit__(
-        self: object,
-        type: object,
-        value: object,
-        traceback: object,
-    ) -> object:
-        """Closes the stream and releases resources.
+    def close(self: object) -> None:
+        """Stops recording and releases resources.
 
         Args:
         self: The class instance.
-        type: The exception type.
-        value: The exception value.
-        traceback: The exception traceback.
 
         returns: None
         """
         self._audio_stream.stop_stream()
         self._audio_stream.close()
-        self.closed = True
-        # Signal the generator to terminate so that the client's
-        # streaming_recognize method will not block the process termination.
-        self._buff.put(None)
         self._audio_interface.terminate()
+        self._buffer.close()
 
-    def _fill_buffer(
+
+class FileSource:
+    """Reads raw audio from a file into the buffer."""
+
+    def __init__(
         self: object,
-        in_data: object,
-        *args: object,
-        **kwargs: object,
-    ) -> object:
-        """Continuously collect data from the audio stream, into the buffer.
+        buffer: AudioRingBuffer,
+        audio_file: object,
+        chunk_size: int,
+        realtime: bool = True,
+    ) -> None:
+        """Creates a file source that reads the file in a background thread.
 
         Args:
         self: The class instance.
-        in_data: The audio data as a bytes object.
-        args: Additional arguments.
-        kwargs: Additional arguments.
+        buffer: The buffer to write the audio to.
+        audio_file: The binary file with raw LINEAR16 audio.
+        chunk_size: The audio's chunk size in frames.
+        realtime: Whether to read the audio at the speed it was recorded.
 
         returns: None
         """
-        self._buff.put(in_data)
-        return None, pyaudio.paContinue
+        self._buffer = buffer
+        self._audio_file = audio_file
+        self._chunk_bytes = chunk_size * SAMPLE_WIDTH
+        self._realtime = realtime
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._fill_buffer, daemon=True)
+        self._thread.start()
+
+    def _fill_buffer(self: object) -> None:
+        chunk_ms = self._chunk_bytes / BYTES_PER_MS
+        started = get_current_time()
+        position = 0
+        while not self._closed.is_set():
+            chunk = self._audio_file.read(self._chunk_bytes)
+            if not chunk:
+                break
+            if self._realtime:
+                time.sleep(
+                    max(0, started + position * chunk_ms - get_current_time()) / 1000
+                )
+            self._buffer.write(chunk)
+            position += 1
+        self._buffer.close()
 
-    def generator(self: object) -> object:
-        """Stream Audio from microphone to API and to local buffer
+    def close(self: object) -> None:
+        """Stops reading the file.
 
         Args:
-            self: The class instance.
+        self: The class instance.
 
-        returns:
-            The data from the audio stream.
+        returns: None
         """
-        while not self.closed:
-            data = []
+        self._closed.set()
+        self._buffer.close()
+        # The file may be closed by the caller once the reader has stopped.
+        self._thread.join()
 
-            if self.new_stream and self.last_audio_input:
-                chunk_time = STREAMING_LIMIT / len(self.last_audio_input)
 
-                if chunk_time != 0:
-                    if self.bridging_offset < 0:
-                        self.bridging_offset = 0
+class LatencyHistogram:
+    """Collects latencies in MS and reports their distribution."""
 
-                    if self.bridging_offset > self.final_request_end_time:
-                        self.bridging_offset = self.final_request_end_time
+    BUCKETS = (50, 100, 200, 500, 1000, 2000, 5000)
 
-                    chunks_from_ms = round(
-                        (self.final_request_end_time - self.bridging_offset)
-                        / chunk_time
-                    )
+    def __init__(self: object, name: str) -> None:
+        self.name = name
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.samples = []
 
-                    self.bridging_offset = round(
-                        (len(self.last_audio_input) - chunks_from_ms) * chunk_time
-                    )
+    def add(self: object, latency: int) -> None:
+        self.counts[bisect.bisect_left(self.BUCKETS, latency)] += 1
+        self.samples.append(latency)
 
-                    for i in range(chunks_from_ms, len(self.last_audio_input)):
-                        data.append(self.last_audio_input[i])
+    def percentile(self: object, percent: float) -> int:
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
 
-                self.new_stream = False
+    def report(self: object) -> str:
+        if not self.samples:
+            return f"{self.name}: no results"
+        lines = [
+            f"{self.name}: {len(self.samples)} results, "
+            f"p50 {self.percentile(50)}ms, p90 {self.percentile(90)}ms, "
+            f"p99 {self.percentile(99)}ms"
+        ]
+        lower = 0
+        for upper, count in zip(self.BUCKETS + (None,), self.counts):
+            label = f"{lower}-{upper}ms" if upper else f">{lower}ms"
+            lines.append(f"  {label:>12}: {count}")
+            lower = upper
+        return "\n".join(lines)
 
-            # Use a blocking get() to ensure there's at least one chunk of
-            # data, and stop iteration if the chunk is None, indicating the
-            # end of the audio stream.
-            chunk = self._buff.get()
-            self.audio_input.append(chunk)
 
-            if chunk is None:
-                return
-            data.append(chunk)
-            # Now consume whatever other data's still buffered.
-            while True:
-                try:
-                    chunk = self._buff.get(block=False)
+class RecognitionStream:
+    """A streaming recognition request that sends audio from the buffer."""
 
-                    if chunk is None:
-                        return
-                    data.append(chunk)
-                    self.audio_input.append(chunk)
+    def __init__(
+        self: object,
+        client: speech.SpeechClient,
+        streaming_config: speech.StreamingRecognitionConfig,
+        buffer: AudioRingBuffer,
+        start_time: int,
+        responses: queue.Queue,
+    ) -> None:
+        """Starts the streaming recognition in a background thread.
 
-                except queue.Empty:
-                    break
+        Args:
+        self: The class instance.
+        client: The Speech API client.
+        streaming_config: The streaming recognition config.
+        buffer: The buffer with the audio.
+        start_time: The audio time in MS to start the recognition from.
+        responses: The queue to put tuples of the stream and its responses to.
+            None response marks the end of the stream.
 
-            yield b"".join(data)
+        returns: None
+        """
+        self.start_time = start_time
+        self.created = get_current_time()
+        self._buffer = buffer
+        self._closed = threading.Event()
+        self._thread = threading.Thread(
+            target=self._receive,
+            args=(client, streaming_config, responses),
+            daemon=True,
+        )
+        self._thread.start()
 
+    def _requests(self: object) -> object:
+        position = max(self.start_time * BYTES_PER_MS, self._buffer.start)
+        while not self._closed.is_set():
+            audio = self._buffer.read(position, MAX_REQUEST_BYTES, timeout=0.1)
+            if audio is None:
+                return
+            if audio:
+                position += len(audio)
+                yield speech.StreamingRecognizeRequest(audio_content=bytes(audio))
 
-def listen_print_loop(responses: object, stream: object) -> object:
-    """Iterates through server responses and prints them.
+    def _receive(
+        self: object,
+        client: speech.SpeechClient,
+        streaming_config: speech.StreamingRecognitionConfig,
+        responses: queue.Queue,
+    ) -> None:
+        try:
+            for response in client.streaming_recognize(
+                streaming_config, self._requests()
+            ):
+                responses.put((self, response))
+        except Exception as e:
+            if not self._closed.is_set():
+                sys.stderr.write(f"Stream error: {e}\n")
+        responses.put((self, None))
+
+    def close(self: object) -> None:
+        """Stops sending audio, so the server closes the stream.
 
-    The responses passed is a generator that will block until a response
-    is provided by the server.
+        Args:
+        self: The class instance.
 
-    Each response may contain multiple results, and each result may contain
-    multiple alternatives; for details, see https://goo.gl/tjCPAU.  Here we
-    print only the transcription for the top alternative of the top result.
+        returns: None
+        """
+        self._closed.set()
 
-    In this case, responses are provided for interim results as well. If the
-    response is an interim one, print a line feed at the end of it, to allow
-    the next result to overwrite it, until the response is a final one. For the
-    final one, print a newline to preserve the finalized transcription.
 
-    Arg:
-        responses: The responses returned from the API.
-        stream: The audio stream to be processed.
+def print_result(result: object, corrected_time: int) -> None:
+    """Prints the transcription of the top alternative of the result.
 
-    Returns:
-        The transcript of the result
-    """
-    for response in responses:
-        if get_current_time() - stream.start_time > STREAMING_LIMIT:
-            stream.start_time = get_current_time()
-            break
+    If the result is an interim one, print a line feed at the end of it, to
+    allow the next result to overwrite it, until the result is a final one.
+    For the final one, print a newline to preserve the finalized transcription.
 
-        if not response.results:
-            continue
+    Args:
+        result: The recognition result.
+        corrected_time: The result's end time in MS since the start of audio.
 
-        result = response.results[0]
+    returns: None
+    """
+    transcript = result.alternatives[0].transcript
+    if result.is_final:
+        sys.stdout.write(GREEN)
+        sys.stdout.write("\033[K")
+        sys.stdout.write(str(corrected_time) + ": " + transcript + "\n")
+    else:
+        sys.stdout.write(RED)
+        sys.stdout.write("\033[K")
+        sys.stdout.write(str(corrected_time) + ": " + transcript + "\r")
+
+
+def listen_print_loop(
+    client: speech.SpeechClient,
+    streaming_config: speech.StreamingRecognitionConfig,
+    buffer: AudioRingBuffer,
+    latencies: dict,
+) -> None:
+    """Transcribes the audio in the buffer and prints the results.
+
+    Each stream is replaced before it reaches STREAMING_LIMIT. The new stream
+    starts STREAM_OVERLAP before the limit, from the end of the last final
+    result, so the audio without a final result is sent again. The results of
+    the old stream are printed until the new stream sends its first response.
+
+    Args:
+        client: The Speech API client.
+        streaming_config: The streaming recognition config.
+        buffer: The buffer with the audio.
+        latencies: Latency histograms of the interim and final results.
+
+    returns: None
+    """
+    responses = queue.Queue()
+    stream = RecognitionStream(client, streaming_config, buffer, 0, responses)
+    next_stream = None
+    last_final_time = 0
+
+    while True:
+        if (
+            next_stream is None
+            and get_current_time() - stream.created > STREAMING_LIMIT - STREAM_OVERLAP
+        ):
+            sys.stdout.write(YELLOW)
+            sys.stdout.write("\n" + str(last_final_time) + ": NEW REQUEST\n")
+            next_stream = RecognitionStream(
+                client, streaming_config, buffer, last_final_time, responses
+            )
 
-        if not result.alternatives:
+        try:
+            response_stream, response = responses.get(timeout=0.1)
+        except queue.Empty:
             continue
 
-        transcript = result.alternatives[0].transcript
-
-        result_seconds = 0
-        result_micros = 0
-
-        if result.result_end_time.seconds:
-            result_seconds = result.result_end_time.seconds
+        if response_stream is next_stream:
+            # The new stream is ready, stop sending audio to the old one.
+            stream.close()
+            stream, next_stream = next_stream, None
+        elif response_stream is not stream:
+            # Ignore the rest of a replaced stream.
+            continue
 
-        if result.result_end_time.microseconds:
-            result_micros = result.result_end_time.microseconds
+        if response is None:
+            if next_stream is not None:
+                stream, next_stream = next_stream, None
+            elif buffer.closed:
+                return
+            else:
+                # The stream ended early, e.g. due to an error.
+                stream = RecognitionStream(
+                    client, streaming_config, buffer, last_final_time, responses
+                )
+            continue
 
-        stream.result_end_time = int((result_seconds * 1000) + (result_micros / 1000))
+        if not response.results or not response.results[0].alternatives:
+            continue
+        result = response.results[0]
 
-        corrected_time = (
-            stream.result_end_time
-            - stream.bridging_offset
-            + (STREAMING_LIMIT * stream.restart_counter)
+        result_end_time = int(result.result_end_time.total_seconds() * 1000)
+        corrected_time = stream.start_time + result_end_time
+        latency = get_current_time() - buffer.capture_time(
+            corrected_time * BYTES_PER_MS
         )
-        # Display interim results, but with a carriage return at the end of the
-        # line, so subsequent lines will overwrite them.
+        latencies["final" if result.is_final else "interim"].add(latency)
 
         if result.is_final:
-            sys.stdout.write(GREEN)
-            sys.stdout.write("\033[K")
-            sys.stdout.write(str(corrected_time) + ": " + transcript + "\n")
-
-            stream.is_final_end_time = stream.result_end_time
-            stream.last_transcript_was_final = True
-
-            # Exit recognition if any of the transcribed phrases could be
-            # one of our keywords.
-            if re.search(r"\b(exit|quit)\b", transcript, re.I):
-                sys.stdout.write(YELLOW)
-                sys.stdout.write("Exiting...\n")
-                stream.closed = True
-                break
-        else:
-            sys.stdout.write(RED)
-            sys.stdout.write("\033[K")
-            sys.stdout.write(str(corrected_time) + ": " + transcript + "\r")
-
-            stream.last_transcript_was_final = False
+            if corrected_time <= last_final_time:
+                # Already transcribed by the previous stream.
+                continue
+            last_final_time = corrected_time
+        print_result(result, corrected_time)
+
+        # Exit recognition if any of the transcribed phrases could be
+        # one of our keywords.
+        if result.is_final and re.search(
+            r"\b(exit|quit)\b", result.alternatives[0].transcript, re.I
+        ):
+            sys.stdout.write(YELLOW)
+            sys.stdout.write("Exiting...\n")
+            stream.close()
+            if next_stream:
+                next_stream.close()
+            return
 
-        return transcript
 
+def main(argv: list = None) -> None:
+    """start bidirectional streaming from microphone or file input to speech API"""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--input",
+        help="Raw LINEAR16 16kHz audio file to transcribe, or - for stdin. "
+        "Records from the microphone if not set.",
+    )
+    parser.add_argument(
+        "--no-realtime",
+        action="store_true",
+        help="Read the input file as fast as possible instead of at the "
+        "speed it was recorded.",
+    )
+    args = parser.parse_args(argv)
 
-def main() -> None:
-    """start bidirectional streaming from microphone input to speech API"""
     client = speech.SpeechClient()
     config = speech.RecognitionConfig(
         encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
@@ -309,44 +560,51 @@ def main() -> None:
         config=config, interim_results=True
     )
 
-    mic_manager = ResumableMicrophoneStream(SAMPLE_RATE, CHUNK_SIZE)
-    print(mic_manager.chunk_size)
+    # Keep enough audio to replay everything since the last final result.
+    buffer = AudioRingBuffer((STREAMING_LIMIT + STREAM_OVERLAP) * BYTES_PER_MS)
+    if args.input is None:
+        source = MicrophoneSource(buffer, SAMPLE_RATE, CHUNK_SIZE)
+        transcribe(client, streaming_config, buffer, source)
+    elif args.input == "-":
+        source = FileSource(buffer, sys.stdin.buffer, CHUNK_SIZE, not args.no_realtime)
+        transcribe(client, streaming_config, buffer, source)
+    else:
+        with open(args.input, "rb") as audio_file:
+            source = FileSource(buffer, audio_file, CHUNK_SIZE, not args.no_realtime)
+            transcribe(client, streaming_config, buffer, source)
+
+
+def transcribe(
+    client: speech.SpeechClient,
+    streaming_config: speech.StreamingRecognitionConfig,
+    buffer: AudioRingBuffer,
+    source: object,
+) -> None:
+    """Prints the transcription of the audio source until it ends or is stopped.
+
+    Args:
+    client: The Speech client.
+    streaming_config: The streaming recognition config.
+    buffer: The buffer the source writes the audio to.
+    source: The audio source, closed when the transcription ends.
+
+    returns: None
+    """
+    latencies = {
+        "interim": LatencyHistogram("Interim result latency"),
+        "final": LatencyHistogram("Final result latency"),
+    }
     sys.stdout.write(YELLOW)
     sys.stdout.write('\nListening, say "Quit" or "Exit" to stop.\n\n')
     sys.stdout.write("End (ms)       Transcript Results/Status\n")
     sys.stdout.write("=====================================================\n")
 
-    with mic_manager as stream:
-        while not stream.closed:
-            sys.stdout.write(YELLOW)
-            sys.stdout.write(
-                "\n" + str(STREAMING_LIMIT * stream.restart_counter) + ": NEW REQUEST\n"
-            )
-
-            stream.audio_input = []
-            audio_generator = stream.generator()
-
-            requests = (
-                speech.StreamingRecognizeRequest(audio_content=content)
-                for content in audio_generator
-            )
-
-            responses = client.streaming_recognize(streaming_config, requests)
-
-            # Now, put the transcription responses to use.
-            listen_print_loop(responses, stream)
-
-            if stream.result_end_time > 0:
-                stream.final_request_end_time = stream.is_final_end_time
-            stream.result_end_time = 0
-            stream.last_audio_input = []
-            stream.last_audio_input = stream.audio_input
-            stream.audio_input = []
-            stream.restart_counter = stream.restart_counter + 1
-
-            if not stream.last_transcript_was_final:
-                sys.stdout.write("\n")
-            stream.new_stream = True
+    try:
+        listen_print_loop(client, streaming_config, buffer, latencies)
+    finally:
+        source.close()
+        for histogram in latencies.values():
+            sys.stderr.write(histogram.report() + "\n")
 
 
 if __name__ == "__main__":
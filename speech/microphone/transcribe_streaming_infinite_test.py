@@ -0,0 +1,57 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+
+import pytest
+
+import transcribe_streaming_infinite
+
+RESOURCES = os.path.join(os.path.dirname(__file__), "resources")
+
+
+def test_ring_buffer_wraps_around() -> None:
+    buffer = transcribe_streaming_infinite.AudioRingBuffer(10)
+    buffer.write(b"abcdefgh")
+    buffer.write(b"ijkl")
+
+    assert buffer.start == 2
+    assert bytes(buffer.read(2, 100)) == b"cdefghij"
+    assert bytes(buffer.read(10, 100)) == b"kl"
+    assert bytes(buffer.read(12, 100, timeout=0.01)) == b""
+    with pytest.raises(ValueError):
+        buffer.read(0, 100)
+
+    buffer.close()
+    assert buffer.read(12, 100) is None
+
+
+def test_ring_buffer_write_larger_than_capacity() -> None:
+    buffer = transcribe_streaming_infinite.AudioRingBuffer(10)
+    buffer.write(b"abc")
+    buffer.write(b"0123456789ABCDE")
+
+    assert buffer.end == 18
+    assert buffer.start == 8
+    assert bytes(buffer.read(8, 100)) == b"56"
+    assert bytes(buffer.read(10, 100)) == b"789ABCDE"
+
+
+def test_main(capsys: pytest.CaptureFixture) -> None:
+    transcribe_streaming_infinite.main(["--input", os.path.join(RESOURCES, "quit.raw")])
+    out, err = capsys.readouterr()
+
+    assert re.search(r"quit", out, re.DOTALL | re.I)
+    assert "Final result latency" in err
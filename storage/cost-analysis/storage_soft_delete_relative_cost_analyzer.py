@@ -30,9 +30,22 @@ Relative cost of each bucket = ('soft delete retention duration'
 # [START storage_soft_delete_relative_cost]
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
-from typing import Dict, List
+import os
+from typing import Dict, List, Optional
+
 import google.cloud.monitoring_v3 as monitoring_client
+import pandas as pd
+
+# The price per GB from the https://cloud.google.com/storage/pricing,
+# divided by the standard storage class.
+RELATIVE_COST = {
+    "STANDARD": 0.023 / 0.023,
+    "NEARLINE": 0.013 / 0.023,
+    "COLDLINE": 0.007 / 0.023,
+    "ARCHIVE": 0.0025 / 0.023,
+}
 
 
 def get_relative_cost(storage_class: str) -> float:
@@ -45,14 +58,39 @@ def get_relative_cost(storage_class: str) -> float:
         The price per GB from the https://cloud.google.com/storage/pricing,
         divided by the standard storage class.
     """
-    relative_cost = {
-        "STANDARD": 0.023 / 0.023,
-        "NEARLINE": 0.013 / 0.023,
-        "COLDLINE": 0.007 / 0.023,
-        "ARCHIVE": 0.0025 / 0.023,
-    }
+    return RELATIVE_COST.get(storage_class, 1.0)
+
+
+def query_time_series_frame(
+    project_name: str,
+    query_client: monitoring_client.QueryServiceClient,
+    query: str,
+    label_names: List[str],
+    value_name: str,
+) -> pd.DataFrame:
+    """Runs an MQL query and loads all pages of the result into a data frame.
+
+    Args:
+        project_name: The Google Cloud project name.
+        query_client: Google Cloud's Monitoring Client's QueryServiceClient.
+        query: The MQL query.
+        label_names: Column names for the label values of each time series.
+        value_name: Column name for the first value of the latest point.
 
-    return relative_cost.get(storage_class, 1.0)
+    Returns:
+        A data frame with a row per time series.
+    """
+    columns: Dict[str, list] = {name: [] for name in label_names + [value_name]}
+    # Iterating over the pager fetches the following pages of the result.
+    for time_series in query_client.query_time_series(
+        monitoring_client.QueryTimeSeriesRequest(
+            name=f"projects/{project_name}", query=query
+        )
+    ):
+        for name, label_value in zip(label_names, time_series.label_values):
+            columns[name].append(label_value.string_value)
+        columns[value_name].append(time_series.point_data[0].values[0].double_value)
+    return pd.DataFrame(columns)
 
 
 def get_soft_delete_cost(
@@ -60,7 +98,8 @@ def get_soft_delete_cost(
     soft_delete_window: float,
     agg_days: int,
     lookback_days: int,
-) -> Dict[str, List[Dict[str, float]]]:
+    query_client: Optional[monitoring_client.QueryServiceClient] = None,
+) -> pd.DataFrame:
     """Calculates soft delete costs for buckets in a Google Cloud project.
 
     Args:
@@ -69,68 +108,110 @@ def get_soft_delete_cost(
           soft-deleted objects (default is 7 days).
         agg_days: Aggregate results over a time period, defaults to 30-day period
         lookback_days: Look back up to upto days, defaults to 360 days
+        query_client: A Monitoring API query client, created if not provided.
 
     Returns:
-        A dictionary with bucket names as keys and cost data for each bucket,
-        broken down by storage class.
+        A data frame with the relative cost of each bucket and storage class.
     """
 
-    query_client = monitoring_client.QueryServiceClient()
+    query_client = query_client or monitoring_client.QueryServiceClient()
+
+    # Both queries are independent, so they are paged concurrently.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # Step 1: Get storage class ratios for each bucket.
+        storage_ratios = executor.submit(
+            get_storage_class_ratio,
+            project_name,
+            query_client,
+            agg_days,
+            lookback_days,
+        )
+        # Step 2: Fetch soft-deleted bytes ratios using Monitoring API.
+        soft_delete_ratios = executor.submit(
+            get_soft_delete_ratio,
+            project_name,
+            query_client,
+            soft_delete_window,
+            agg_days,
+            lookback_days,
+        )
 
-    # Step 1: Get storage class ratios for each bucket.
-    storage_ratios_by_bucket = get_storage_class_ratio(
-        project_name, query_client, agg_days, lookback_days
-    )
+        return calculate_soft_delete_costs(
+            soft_delete_ratios.result(), storage_ratios.result()
+        )
 
-    # Step 2: Fetch soft-deleted bytes and calculate costs using Monitoring API.
-    soft_deleted_costs = calculate_soft_delete_costs(
-        project_name,
-        query_client,
-        soft_delete_window,
-        storage_ratios_by_bucket,
-        agg_days,
-        lookback_days,
+
+def calculate_soft_delete_costs(
+    soft_delete_ratios: pd.DataFrame, storage_ratios: pd.DataFrame
+) -> pd.DataFrame:
+    """Calculates the relative cost of enabling soft delete for each bucket and
+       storage class.
+
+    Args:
+        soft_delete_ratios: Soft-deleted bytes ratios per bucket and storage class.
+        storage_ratios: Storage class ratios per bucket and storage class.
+
+    Returns:
+        A data frame with the soft delete ratio, storage class ratio, relative
+        storage class cost and the resulting relative cost of each bucket and
+        storage class.
+    """
+    costs = soft_delete_ratios.merge(
+        storage_ratios, on=["bucket_name", "storage_class"], how="left"
     )
+    missing = costs["storage_class_ratio"].isna()
+    if missing.any():
+        print(
+            "Missing storage class for following buckets:",
+            (costs["bucket_name"] + " - " + costs["storage_class"])[missing].tolist(),
+        )
+        raise ValueError("Cannot proceed with missing storage class ratios.")
 
-    return soft_deleted_costs
+    # To include location-based cost analysis, add `resource.location` to the
+    # queries' labels and factor it in the 'relative_storage_class_cost' column.
+    costs["relative_storage_class_cost"] = (
+        costs["storage_class"].map(RELATIVE_COST).fillna(1.0)
+    )
+    costs["relative_cost"] = (
+        costs["soft_delete_ratio"]
+        * costs["storage_class_ratio"]
+        * costs["relative_storage_class_cost"]
+    )
+    return costs
 
 
-def calculate_soft_delete_costs(
+def get_soft_delete_ratio(
     project_name: str,
     query_client: monitoring_client.QueryServiceClient,
     soft_delete_window: float,
-    storage_ratios_by_bucket: Dict[str, float],
     agg_days: int,
     lookback_days: int,
-) -> Dict[str, List[Dict[str, float]]]:
-    """Calculates the relative cost of enabling soft delete for each bucket in a
-       project for certain time frame in secs.
+) -> pd.DataFrame:
+    """Calculates the ratio of soft-deleted bytes for each bucket and storage
+       class in a project for certain time frame in secs.
 
     Args:
         project_name: The name of the Google Cloud project.
         query_client: A Monitoring API query client.
         soft_delete_window: The time window in seconds for considering
           soft-deleted objects (default is 7 days).
-        storage_ratios_by_bucket: A dictionary of storage class ratios per bucket.
         agg_days: Aggregate results over a time period, defaults to 30-day period
         lookback_days: Look back up to upto days, defaults to 360 days
 
     Returns:
-        A dictionary with bucket names as keys and a list of cost data
-        dictionaries
-        for each bucket, broken down by storage class.
+        A data frame with the soft delete ratio of each bucket and storage class.
     """
-    soft_deleted_bytes_time = query_client.query_time_series(
-        monitoring_client.QueryTimeSeriesRequest(
-            name=f"projects/{project_name}",
-            query=f"""
+    return query_time_series_frame(
+        project_name,
+        query_client,
+        f"""
                     {{  # Fetch 1: Soft-deleted (bytes seconds)
                         fetch gcs_bucket :: storage.googleapis.com/storage/v2/deleted_bytes
                         | value val(0) * {soft_delete_window}\'s\'  # Multiply by soft delete window
                         | group_by [resource.bucket_name, metric.storage_class], window(), .sum;
 
                         # Fetch 2: Total byte-seconds (active objects)
-                        fetch gcs_bucket :: storage.googleapis.com/storage/v2/total_byte_seconds 
+                        fetch gcs_bucket :: storage.googleapis.com/storage/v2/total_byte_seconds
                         | filter metric.type != 'soft-deleted-object'
                         | group_by [resource.bucket_name, metric.storage_class], window(1d), .mean  # Daily average
                         | group_by [resource.bucket_name, metric.storage_class], window(), .sum  # Total over window
@@ -140,51 +221,17 @@ def calculate_soft_delete_costs(
                     | within {lookback_days}d  # Limit data range for analysis
                     | ratio  # Calculate ratio (soft-deleted (bytes seconds)/ total (bytes seconds))
                     """,
-        )
+        ["bucket_name", "storage_class"],
+        "soft_delete_ratio",
     )
 
-    buckets: Dict[str, List[Dict[str, float]]] = {}
-    missing_distribution_storage_class = []
-    for data_point in soft_deleted_bytes_time.time_series_data:
-        bucket_name = data_point.label_values[0].string_value
-        storage_class = data_point.label_values[1].string_value
-        # To include location-based cost analysis:
-        # 1. Uncomment the line below:
-        # location = data_point.label_values[2].string_value
-        # 2. Update how you calculate 'relative_storage_class_cost' to factor in location
-        soft_delete_ratio = data_point.point_data[0].values[0].double_value
-        distribution_storage_class = bucket_name + " - " + storage_class
-        storage_class_ratio = storage_ratios_by_bucket.get(
-            distribution_storage_class
-        )
-        if storage_class_ratio is None:
-            missing_distribution_storage_class.append(
-                distribution_storage_class)
-        buckets.setdefault(bucket_name, []).append({
-            # Include storage class and location data for additional plotting dimensions.
-            # "storage_class": storage_class,
-            # 'location': location,
-            "soft_delete_ratio": soft_delete_ratio,
-            "storage_class_ratio": storage_class_ratio,
-            "relative_storage_class_cost": get_relative_cost(storage_class),
-        })
-
-    if missing_distribution_storage_class:
-        print(
-            "Missing storage class for following buckets:",
-            missing_distribution_storage_class,
-        )
-        raise ValueError("Cannot proceed with missing storage class ratios.")
-
-    return buckets
-
 
 def get_storage_class_ratio(
     project_name: str,
     query_client: monitoring_client.QueryServiceClient,
     agg_days: int,
     lookback_days: int,
-) -> Dict[str, float]:
+) -> pd.DataFrame:
     """Calculates storage class ratios for each bucket in a project.
 
     This information helps determine the relative cost contribution of each
@@ -199,9 +246,10 @@ def get_storage_class_ratio(
     Returns:
         Ratio of Storage classes within a bucket.
     """
-    request = monitoring_client.QueryTimeSeriesRequest(
-        name=f"projects/{project_name}",
-        query=f"""
+    return query_time_series_frame(
+        project_name,
+        query_client,
+        f"""
             {{
             # Fetch total byte-seconds for each bucket and storage class
             fetch gcs_bucket :: storage.googleapis.com/storage/v2/total_byte_seconds
@@ -214,35 +262,77 @@ def get_storage_class_ratio(
             | every {agg_days}d
             | within {lookback_days}d
             """,
+        ["bucket_name", "storage_class"],
+        "storage_class_ratio",
     )
 
-    storage_class_ratio = query_client.query_time_series(request)
 
-    storage_ratios_by_bucket = {}
-    for time_series in storage_class_ratio.time_series_data:
-        bucket_name = time_series.label_values[0].string_value
-        storage_class = time_series.label_values[1].string_value
-        ratio = time_series.point_data[0].values[0].double_value
+def get_soft_delete_costs(
+    project_names: List[str],
+    soft_delete_window: float = 604800,
+    agg_days: int = 30,
+    lookback_days: int = 360,
+    max_workers: int = 8,
+    cache_file: Optional[str] = None,
+) -> pd.DataFrame:
+    """Calculates soft delete costs for buckets in many Google Cloud projects.
+
+    Args:
+        project_names: The names of the Google Cloud projects.
+        soft_delete_window: Time window for calculating soft-delete costs (in
+          seconds).
+        agg_days: Aggregate results over this time period (in days).
+        lookback_days: Look back up to this many days.
+        max_workers: Number of projects queried concurrently.
+        cache_file: If set, a JSON snapshot of the costs. The snapshot is
+          reused when it was made for the same projects and query parameters.
+
+    Returns:
+        A data frame with the relative cost of each bucket and storage class
+        in the projects.
+    """
+    params = {
+        "project_names": sorted(project_names),
+        "soft_delete_window": soft_delete_window,
+        "agg_days": agg_days,
+        "lookback_days": lookback_days,
+    }
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            snapshot = json.load(f)
+        if snapshot["params"] == params:
+            return pd.DataFrame.from_records(snapshot["costs"])
 
-        # Create a descriptive key for the dictionary
-        key = f"{bucket_name} - {storage_class}"
-        storage_ratios_by_bucket[key] = ratio
+    query_client = monitoring_client.QueryServiceClient()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = executor.map(
+            lambda project_name: get_soft_delete_cost(
+                project_name, soft_delete_window, agg_days, lookback_days, query_client
+            ).assign(project_name=project_name),
+            project_names,
+        )
+        costs = pd.concat(list(frames), ignore_index=True)
 
-    return storage_ratios_by_bucket
+    if cache_file:
+        with open(cache_file, "w") as f:
+            json.dump({"params": params, "costs": costs.to_dict("records")}, f)
+    return costs
 
 
 def soft_delete_relative_cost_analyzer(
-    project_name: str,
+    project_name: str | List[str],
     cost_threshold: float = 0.0,
     soft_delete_window: float = 604800,
     agg_days: int = 30,
     lookback_days: int = 360,
     list_buckets: bool = False,
+    max_workers: int = 8,
+    cache_file: Optional[str] = None,
 ) -> str | Dict[str, float]:  # Note potential string output
     """Identifies buckets exceeding the relative cost threshold for enabling soft delete.
 
     Args:
-        project_name: The Google Cloud project name.
+        project_name: The Google Cloud project name or a list of project names.
         cost_threshold: Threshold above which to consider removing soft delete.
         soft_delete_window: Time window for calculating soft-delete costs (in
           seconds).
@@ -250,25 +340,27 @@ def soft_delete_relative_cost_analyzer(
         lookback_days: Look back up to this many days.
         list_buckets: Return a list of bucket names (True) or JSON (False,
           default).
+        max_workers: Number of projects queried concurrently.
+        cache_file: If set, costs are cached in this file, so runs with a
+          different cost threshold do not query Monitoring API again.
 
     Returns:
         JSON formatted results of buckets exceeding the threshold and costs
         *or* a space-separated string of bucket names.
     """
+    project_names = [project_name] if isinstance(project_name, str) else project_name
+    costs = get_soft_delete_costs(
+        project_names,
+        soft_delete_window,
+        agg_days,
+        lookback_days,
+        max_workers,
+        cache_file,
+    )
 
-    buckets: Dict[str, float] = {}
-    for bucket_name, storage_sources in get_soft_delete_cost(
-        project_name, soft_delete_window, agg_days, lookback_days
-    ).items():
-        bucket_cost = 0.0
-        for storage_source in storage_sources:
-            bucket_cost += (
-                storage_source["soft_delete_ratio"]
-                * storage_source["storage_class_ratio"]
-                * storage_source["relative_storage_class_cost"]
-            )
-        if bucket_cost > cost_threshold:
-            buckets[bucket_name] = round(bucket_cost, 4)
+    bucket_costs = costs.groupby("bucket_name", sort=False)["relative_cost"].sum()
+    bucket_costs = bucket_costs[bucket_costs > cost_threshold].round(4)
+    buckets: Dict[str, float] = bucket_costs.to_dict()
 
     if list_buckets:
         return " ".join(buckets.keys())  # Space-separated bucket names
@@ -282,7 +374,9 @@ def soft_delete_relative_cost_analyzer_main() -> None:
         description="Analyze and manage Google Cloud Storage soft-delete costs."
     )
     parser.add_argument(
-        "project_name", help="The name of the Google Cloud project to analyze."
+        "project_name",
+        nargs="+",
+        help="The names of the Google Cloud projects to analyze.",
     )
     parser.add_argument(
         "--cost_threshold",
@@ -319,6 +413,20 @@ def soft_delete_relative_cost_analyzer_main() -> None:
         default=False,
         help="Return the list of bucketnames seperated by space.",
     )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=8,
+        help="Number of projects analyzed concurrently.",
+    )
+    parser.add_argument(
+        "--cache_file",
+        default=None,
+        help=(
+            "File to cache the costs in, so re-runs with a different"
+            " cost threshold do not query Monitoring API again."
+        ),
+    )
 
     args = parser.parse_args()
 
@@ -329,6 +437,8 @@ def soft_delete_relative_cost_analyzer_main() -> None:
         args.agg_days,
         args.lookback_days,
         args.list,
+        args.max_workers,
+        args.cache_file,
     )
     if not args.list:
         print(
@@ -0,0 +1,118 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from types import SimpleNamespace
+from unittest import mock
+
+import pandas as pd
+import pytest
+
+import storage_soft_delete_relative_cost_analyzer as analyzer
+
+# (bucket_name, storage_class, ratio) of the fixed Monitoring API results.
+SOFT_DELETE_RATIOS = [
+    ("bucket-a", "STANDARD", 0.2),
+    ("bucket-a", "NEARLINE", 0.5),
+    ("bucket-b", "COLDLINE", 0.1),
+    ("bucket-c", "ARCHIVE", 0.01),
+    ("bucket-d", "REGIONAL", 0.3),
+]
+STORAGE_CLASS_RATIOS = [
+    ("bucket-a", "STANDARD", 0.75),
+    ("bucket-a", "NEARLINE", 0.25),
+    ("bucket-b", "COLDLINE", 1.0),
+    ("bucket-c", "ARCHIVE", 1.0),
+    ("bucket-d", "REGIONAL", 1.0),
+]
+
+
+def scalar_bucket_costs(cost_threshold: float) -> dict:
+    """The per-bucket costs as the analyzer computed them one series at a time."""
+    storage_ratios_by_bucket = {
+        f"{bucket_name} - {storage_class}": ratio
+        for bucket_name, storage_class, ratio in STORAGE_CLASS_RATIOS
+    }
+    buckets = {}
+    for bucket_name, storage_class, soft_delete_ratio in SOFT_DELETE_RATIOS:
+        buckets.setdefault(bucket_name, 0.0)
+        buckets[bucket_name] += (
+            soft_delete_ratio
+            * storage_ratios_by_bucket[f"{bucket_name} - {storage_class}"]
+            * analyzer.get_relative_cost(storage_class)
+        )
+    return {
+        bucket_name: round(cost, 4)
+        for bucket_name, cost in buckets.items()
+        if cost > cost_threshold
+    }
+
+
+def to_frame(rows: list, value_name: str) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=["bucket_name", "storage_class", value_name])
+
+
+def to_time_series(rows: list) -> list:
+    return [
+        SimpleNamespace(
+            label_values=[
+                SimpleNamespace(string_value=bucket_name),
+                SimpleNamespace(string_value=storage_class),
+            ],
+            point_data=[SimpleNamespace(values=[SimpleNamespace(double_value=ratio)])],
+        )
+        for bucket_name, storage_class, ratio in rows
+    ]
+
+
+def fake_query_time_series(request):
+    if "deleted_bytes" in request.query:
+        return to_time_series(SOFT_DELETE_RATIOS)
+    return to_time_series(STORAGE_CLASS_RATIOS)
+
+
+def test_calculate_soft_delete_costs() -> None:
+    costs = analyzer.calculate_soft_delete_costs(
+        to_frame(SOFT_DELETE_RATIOS, "soft_delete_ratio"),
+        to_frame(STORAGE_CLASS_RATIOS, "storage_class_ratio"),
+    )
+
+    bucket_costs = costs.groupby("bucket_name", sort=False)["relative_cost"].sum()
+    assert bucket_costs.round(4).to_dict() == scalar_bucket_costs(0.0)
+
+
+def test_calculate_soft_delete_costs_missing_storage_class() -> None:
+    with pytest.raises(ValueError):
+        analyzer.calculate_soft_delete_costs(
+            to_frame(SOFT_DELETE_RATIOS, "soft_delete_ratio"),
+            to_frame(STORAGE_CLASS_RATIOS[1:], "storage_class_ratio"),
+        )
+
+
+@pytest.mark.parametrize("cost_threshold", [0.0, 0.05, 0.2])
+def test_soft_delete_relative_cost_analyzer(cost_threshold: float) -> None:
+    with mock.patch.object(
+        analyzer.monitoring_client, "QueryServiceClient"
+    ) as query_client:
+        query_client.return_value.query_time_series.side_effect = fake_query_time_series
+        response = analyzer.soft_delete_relative_cost_analyzer(
+            "test-project", cost_threshold
+        )
+        bucket_names = analyzer.soft_delete_relative_cost_analyzer(
+            "test-project", cost_threshold, list_buckets=True
+        )
+
+    expected = scalar_bucket_costs(cost_threshold)
+    assert json.loads(response) == expected
+    assert bucket_names == " ".join(expected)